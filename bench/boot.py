@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+Boot time benchmark of the rootfs backends of vLab
+
+Unlike scale.py, whose fake Qemu never boots a kernel, this runs real VMs:
+it needs root, KVM and a vm config that boots (configs/vm.json once its
+paths are set). For every rootfs backend, a lab of --hosts hosts on a switch
+is created and started --runs times with the backend set in the 'rootfs'
+section of the vm config, and the start_all time and the boot phases
+recorded by the tracer are reported.
+
+Backends:
+  - 9p:        the guests read the host root over virtio-9p
+  - initramfs: the guests run from the image built by initramfs.py. The
+               first lab builds the image, so its init time is reported as
+               the build time.
+
+Usage:
+  sudo python bench/boot.py --vm-config configs/vm.json --hosts 4
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from vlab.vlab import Vlab
+from vlab.sshpool import default_pool
+from vlab.vmpool import close_pools
+from vlab.tracing import default_tracer
+from scale import quiet, distribution
+
+BACKENDS = ['9p', 'initramfs']
+# Phases of the tracer reported per backend: the whole boot, then the
+# vm_init.sh phases
+PHASES = ['boot', 'guest_kernel', 'guest_mounts', 'guest_network',
+          'guest_sshd']
+
+
+def get_topology(hosts):
+    """Returns a topo.json with hosts hosts on a switch"""
+    topo = {'hosts': [], 'links': [], 'controllers': [], 'version': '2',
+            'switches': [{'number': '1', 'opts': {'hostname': 's1',
+                                                  'nodeNum': 1}}]}
+    for i in xrange(1, hosts + 1):
+        topo['hosts'].append({'number': str(i),
+                              'opts': {'hostname': 'h%d' % i, 'nodeNum': i}})
+        topo['links'].append({'src': 'h%d' % i, 'dest': 's1', 'opts': {}})
+    return topo
+
+
+def get_phases():
+    """Returns the durations of the reported phases recorded since the
+    tracer was cleared, by phase"""
+    durations = dict((phase, []) for phase in PHASES)
+    for _, name, start, end, _ in default_tracer.get_spans():
+        if name in durations:
+            durations[name].append(end - start)
+    return durations
+
+
+def run_backend(profile, backend, args):
+    """Creates, starts and stops the lab args.runs times using the given
+    rootfs backend
+
+    :return The metrics of the backend
+    :rtype dict
+    """
+    workdir = tempfile.mkdtemp(prefix='vlab-boot-')
+    vm_file = os.path.join(workdir, 'vm.json')
+    topo_file = os.path.join(workdir, 'topo.json')
+    rootfs = dict(profile.get('rootfs', {}), backend=backend)
+    # A fresh cache, so the image build is measured
+    rootfs['cache_dir'] = os.path.join(workdir, 'initramfs')
+    with open(vm_file, 'w') as f:
+        json.dump(dict(profile, rootfs=rootfs), f, indent=2)
+    with open(topo_file, 'w') as f:
+        json.dump(get_topology(args.hosts), f, indent=2)
+
+    inits = []
+    starts = []
+    phases = dict((phase, []) for phase in PHASES)
+    try:
+        with quiet(not args.verbose):
+            for _ in xrange(args.runs):
+                default_tracer.clear()
+                start = time.time()
+                lab = Vlab(vm_file, topo_file)
+                inits.append(time.time() - start)
+                start = time.time()
+                lab.start_all()
+                starts.append(time.time() - start)
+                lab.stop_all()
+                for phase, durations in get_phases().iteritems():
+                    phases[phase].extend(durations)
+    finally:
+        close_pools()
+        default_pool.close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # Only the first lab builds the initramfs, the others find it cached
+    return {'backend': backend,
+            'build': inits[0],
+            'init': distribution(inits[1:] or inits),
+            'start_all': distribution(starts),
+            'phases': dict((phase, distribution(durations))
+                           for phase, durations in phases.iteritems()
+                           if durations)}
+
+
+def print_report(results):
+    print('%-10s %8s %8s %10s %10s' % ('backend', 'build', 'init',
+                                        'start p50', 'start p99'))
+    print('%-10s %8s %8s %10s %10s' % ('', 's', 's', 's', 's'))
+    for r in results:
+        print('%-10s %8.3f %8.3f %10.3f %10.3f' % (
+            r['backend'], r['build'], r['init']['p50'],
+            r['start_all']['p50'], r['start_all']['p99']))
+
+    print('')
+    print('%-15s' % 'phase p50 (s)' +
+          ''.join('%12s' % r['backend'] for r in results))
+    for phase in PHASES:
+        row = '%-15s' % phase
+        for r in results:
+            stats = r['phases'].get(phase)
+            row += '%12s' % ('%.3f' % stats['p50'] if stats else '-')
+        print(row)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the boot time of vLab hosts for every '
+                    'rootfs backend')
+    parser.add_argument('--vm-config', required=True,
+                        help='a vm config that boots on this machine')
+    parser.add_argument('--hosts', type=int, default=4,
+                        help='hosts of the lab (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='starts of the lab per backend (default: '
+                             '%(default)s)')
+    parser.add_argument('--backends',
+                        help='comma separated backends to run (default: '
+                             'all)')
+    parser.add_argument('--output', help='also write the results to this '
+                                         'JSON file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of vLab')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.vm_config, 'r') as f:
+        profile = json.load(f)
+    backends = BACKENDS
+    if args.backends:
+        backends = [b for b in BACKENDS if b in args.backends.split(',')]
+
+    results = []
+    for backend in backends:
+        print('Booting with %s...' % backend)
+        results.append(run_backend(profile, backend, args))
+
+    print('')
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
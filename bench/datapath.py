@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+Data path benchmark for vLab
+
+Unlike scale.py, this runs real VMs: it needs root, KVM, a vm config that
+boots (configs/vm.json once its paths are set) and iperf and ping in the
+guests. For every data path variant, a lab of two hosts on a switch is
+started with the variant set in the 'datapath' section of the vm config, and
+Vlab.measure reports the TCP throughput and the RTT between the hosts.
+
+Variants:
+  - base:      one vCPU, no vhost, single queue taps, default offloads
+  - vhost:     vhost-net
+  - vhost-mq:  vhost-net, --smp vCPUs and one queue pair per vCPU
+  - no-tso:    like vhost-mq, with the TSO offloads off, to show what
+               they bring
+
+Usage:
+  sudo python bench/datapath.py --vm-config configs/vm.json --smp 4
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from vlab.vlab import Vlab
+from vlab.sshpool import default_pool
+from scale import quiet
+
+
+def get_variants(smp):
+    """Returns the datapath sections of the benchmarked variants, in order"""
+    return [('base', {'smp': 1, 'vhost': False, 'queues': 1,
+                      'offloads': {}}),
+            ('vhost', {'smp': 1, 'vhost': True, 'queues': 1,
+                       'offloads': {}}),
+            ('vhost-mq', {'smp': smp, 'vhost': True, 'queues': 'auto',
+                          'offloads': {}}),
+            ('no-tso', {'smp': smp, 'vhost': True, 'queues': 'auto',
+                        'offloads': {'host_tso4': False,
+                                     'guest_tso4': False}})]
+
+
+def get_topology():
+    """Returns a topo.json with two hosts on a switch"""
+    topo = {'hosts': [], 'links': [], 'controllers': [], 'version': '2',
+            'switches': [{'number': '1', 'opts': {'hostname': 's1',
+                                                  'nodeNum': 1}}]}
+    for i in (1, 2):
+        topo['hosts'].append({'number': str(i),
+                              'opts': {'hostname': 'h%d' % i, 'nodeNum': i,
+                                       'sched': 'host'}})
+        topo['links'].append({'src': 'h%d' % i, 'dest': 's1', 'opts': {}})
+    return topo
+
+
+def run_variant(profile, datapath, args):
+    """Measures a lab using the given datapath section
+
+    :return The result of Vlab.measure for h1 to h2
+    :rtype dict
+    """
+    workdir = tempfile.mkdtemp(prefix='vlab-datapath-')
+    vm_file = os.path.join(workdir, 'vm.json')
+    topo_file = os.path.join(workdir, 'topo.json')
+    profile = dict(profile, datapath=datapath)
+    with open(vm_file, 'w') as f:
+        json.dump(profile, f, indent=2)
+    with open(topo_file, 'w') as f:
+        json.dump(get_topology(), f, indent=2)
+
+    try:
+        with quiet(not args.verbose):
+            lab = Vlab(vm_file, topo_file)
+            lab.start_all()
+            try:
+                result = lab.measure([('h1', 'h2')], args.time,
+                                     args.count)[0]
+            finally:
+                lab.stop_all()
+    finally:
+        default_pool.close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def print_report(results):
+    print('%-10s %10s %8s %8s %7s' % ('variant', 'Mbit/s', 'rtt p50',
+                                       'rtt p99', 'loss%'))
+    base = results[0][1]['throughput']
+    for name, r in results:
+        if r['error'] is not None:
+            print('%-10s error: %s' % (name, r['error']))
+            continue
+        gain = ''
+        if base and r['throughput']:
+            gain = '  x%.2f' % (r['throughput'] / base)
+        print('%-10s %10.1f %8.3f %8.3f %7.1f%s' % (
+            name, r['throughput'] / 1e6, r['rtt']['p50'], r['rtt']['p99'],
+            r['loss'], gain))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the throughput between two vLab hosts for '
+                    'several data path settings')
+    parser.add_argument('--vm-config', required=True,
+                        help='a vm config that boots on this machine')
+    parser.add_argument('--smp', type=int, default=2,
+                        help='vCPUs of the multiqueue variants (default: '
+                             '%(default)s)')
+    parser.add_argument('--variants',
+                        help='comma separated variants to run (default: '
+                             'all)')
+    parser.add_argument('--time', type=int, default=10,
+                        help='seconds of iperf traffic per variant')
+    parser.add_argument('--count', type=int, default=20,
+                        help='pings per variant')
+    parser.add_argument('--output', help='also write the results to this '
+                                         'JSON file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of vLab')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.vm_config, 'r') as f:
+        profile = json.load(f)
+    variants = get_variants(args.smp)
+    if args.variants:
+        names = args.variants.split(',')
+        variants = [v for v in variants if v[0] in names]
+
+    results = []
+    for name, datapath in variants:
+        print('Measuring %s...' % name)
+        results.append((name, run_variant(profile, datapath, args)))
+
+    print('')
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump([dict(r, variant=name, error=str(r['error'])
+                            if r['error'] is not None else None)
+                       for name, r in results], f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Stand-in for the SSH server of the guests, used by the benchmarks
+
+A FakeGuest is a paramiko SSH server on a local port that accepts any public
+key and answers every command without running it. The answers mimic the
+guest just enough for vLab: the interface configuration script gets its
+'<tap> ok' lines back, and everything else exits with status 0.
+
+All VMs of a benchmark share one FakeGuest: the SshPool is told to connect
+to it instead of the management address of each VM.
+"""
+
+import re
+import socket
+import threading
+
+import paramiko
+from paramiko.common import MSG_CHANNEL_REQUEST
+
+
+def _handle_channel_request(channel, m):
+    paramiko.Channel._handle_request(channel, m)
+    channel.get_transport().server_object.start_answer(channel)
+
+
+class _GuestTransport(paramiko.Transport):
+    """Transport that answers an exec request only once it has replied to
+    it, so the answer may close the channel as sshd does"""
+    _channel_handler_table = dict(paramiko.Transport._channel_handler_table)
+    _channel_handler_table[MSG_CHANNEL_REQUEST] = _handle_channel_request
+
+
+class _GuestServer(paramiko.ServerInterface):
+    """Handles the authentication and the requests of one connection"""
+
+    def __init__(self, guest):
+        self.guest = guest
+        self.pending = {}
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.pending[channel.get_id()] = command
+        return True
+
+    def start_answer(self, channel):
+        """Answers the exec request of channel, if it got one"""
+        command = self.pending.pop(channel.get_id(), None)
+        if command is None:
+            return
+        t = threading.Thread(target=self.guest.answer,
+                             args=(channel, command))
+        t.daemon = True
+        t.start()
+
+
+class FakeGuest(object):
+    """Local SSH server answering for every VM of a benchmark"""
+    # The success marker printed by VmHandler._configure_links
+    CONFIGURE_OK = re.compile(r"echo '(\S+) ok'")
+
+    def __init__(self, host='127.0.0.1', port=0):
+        """Creates a FakeGuest. Port 0 picks a free port.
+
+        :param host: The address to listen on
+        :type host: str
+        """
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.transports = []
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.running = False
+        self.thread = None
+
+    def get_address(self):
+        """Returns the (host, port) the server listens on"""
+        return self.sock.getsockname()
+
+    def start(self):
+        """Starts accepting connections in the background"""
+        self.running = True
+        self.thread = threading.Thread(target=self._accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            # Handshakes of concurrent connections do not wait for each other
+            t = threading.Thread(target=self._serve, args=(client,))
+            t.daemon = True
+            t.start()
+
+    def _serve(self, client):
+        transport = _GuestTransport(client)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=_GuestServer(self))
+        except (paramiko.SSHException, EOFError):
+            transport.close()
+            return
+        with self.lock:
+            self.transports.append(transport)
+        # The transport only holds weak references to its channels, the
+        # accepted ones are kept until the client closes them
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            channels = [c for c in channels if not c.closed]
+            if channel is not None:
+                channels.append(channel)
+
+    def answer(self, channel, command):
+        """Replies to command as the guest would, without running it"""
+        with self.lock:
+            self.commands += 1
+        out = ''.join('%s ok\n' % tap for tap in
+                      FakeGuest.CONFIGURE_OK.findall(command))
+        if out:
+            channel.sendall(out)
+        channel.send_exit_status(0)
+        # As sshd, close right after the exit status
+        channel.close()
+
+    def get_commands(self):
+        """Returns the number of commands answered so far"""
+        with self.lock:
+            return self.commands
+
+    def stop(self):
+        """Stops the server and closes every connection"""
+        self.running = False
+        self.sock.close()
+        with self.lock:
+            transports = self.transports
+            self.transports = []
+        for transport in transports:
+            transport.close()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for qemu-system-x86_64 used by the benchmarks
+
+It understands just enough of the command line built by VmConfig to play a
+booted VM: it serves the chardev sockets (answering QMP on the 'qmp' one),
+and writes the boot message of the hostname given with uts= on the kernel
+command line to the mgmt console, like vm_init.sh does at the end of the
+boot. Once booted, it also answers for the guest agent on the 'agent' one,
+the same way FakeGuest answers over SSH.
+
+With vlab_template=1 on the kernel command line, as for the VMs of a pool,
+it writes the template ready message instead and boots once it reads an
+identity line on the console, taking the hostname from it.
+
+Environment:
+  VLAB_FAKE_BOOT_DELAY  seconds to wait before the boot message, to model the
+                        guest boot time (default 0)
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import errno
+import signal
+import select
+import socket
+
+
+QMP_GREETING = {'QMP': {'version': {'qemu': {'major': 2, 'minor': 0,
+                                             'micro': 0},
+                                    'package': ' (vlab bench)'},
+                        'capabilities': []}}
+# The success marker printed by VmHandler._configure_links
+CONFIGURE_OK = re.compile(r"echo '(\S+) ok'")
+
+
+class FakeQemu(object):
+    """One fake VM, driven by a select loop on its chardev sockets"""
+
+    def __init__(self, argv):
+        self.chardevs = {}
+        self.append = ''
+        self.incoming = False
+        self._parse(argv)
+        self.hostname = self._get_kernel_param('uts') or 'unknown'
+        self.template = self._get_kernel_param('vlab_template') is not None
+        self.waiting_identity = False
+        self.listeners = {}
+        self.clients = {}
+        self.buffers = {}
+        # A restored VM runs as soon as its state is loaded
+        self.status = 'running'
+        self.running = True
+        self.booted = False
+
+    def _parse(self, argv):
+        i = 0
+        while i < len(argv):
+            arg = argv[i]
+            value = argv[i + 1] if i + 1 < len(argv) else ''
+            if arg == '-chardev':
+                opts = dict(o.partition('=')[::2] for o in value.split(','))
+                self.chardevs[opts['id']] = opts['path']
+                i += 1
+            elif arg == '-append':
+                self.append = value
+                i += 1
+            elif arg == '-incoming':
+                self.incoming = True
+                i += 1
+            i += 1
+
+    def _get_kernel_param(self, name):
+        for param in self.append.split():
+            key, _, value = param.partition('=')
+            if key == name:
+                return value
+        return None
+
+    def listen(self):
+        for chardev, path in self.chardevs.items():
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(5)
+            self.listeners[sock] = chardev
+
+    def _write_console(self, line):
+        """Writes line on the mgmt console. Returns False if no one is
+        connected to the console yet."""
+        for client, chardev in self.clients.items():
+            if chardev == 'mgmt':
+                client.sendall(line + '\r\n')
+                return True
+        return False
+
+    def notify_boot(self):
+        """Writes the boot message on the mgmt console. Returns False if no
+        one is connected to the console yet."""
+        return self._write_console('vlab-booted %s' % self.hostname)
+
+    def _boot(self):
+        """Notifies the boot, then serves the agent requests that waited for
+        it"""
+        self.booted = self.notify_boot()
+        if self.booted:
+            for client, chardev in self.clients.items():
+                if chardev == 'agent':
+                    self._serve_lines(client)
+
+    def _send(self, client, msg):
+        try:
+            client.sendall(json.dumps(msg) + '\n')
+        except socket.error:
+            pass
+
+    def _event(self, name, data=None):
+        now = time.time()
+        msg = {'event': name,
+               'timestamp': {'seconds': int(now),
+                             'microseconds': int(now * 1e6) % 1000000}}
+        if data is not None:
+            msg['data'] = data
+        for client, chardev in self.clients.items():
+            if chardev == 'qmp':
+                self._send(client, msg)
+
+    def _handle_qmp(self, client, msg):
+        command = msg.get('execute')
+        args = msg.get('arguments', {})
+        ret = {}
+        events = []
+        if command == 'human-monitor-command':
+            line = args.get('command-line', '')
+            words = line.split()
+            if words and words[0] == 'device_del' and len(words) > 1:
+                events.append(('DEVICE_DELETED', {'device': words[1]}))
+            ret = ''
+        elif command == 'query-status':
+            ret = {'status': self.status,
+                   'running': self.status == 'running',
+                   'singlestep': False}
+        elif command == 'query-cpus-fast':
+            ret = [{'cpu-index': 0, 'thread-id': os.getpid(),
+                    'qom-path': '/machine/unattached/device[0]',
+                    'arch': 'x86'}]
+        elif command == 'query-cpus':
+            ret = [{'CPU': 0, 'current': True, 'halted': False,
+                    'thread_id': os.getpid()}]
+        elif command == 'stop':
+            self.status = 'paused'
+            events.append(('STOP', None))
+        elif command == 'cont':
+            self.status = 'running'
+            events.append(('RESUME', None))
+        elif command == 'system_powerdown':
+            # As with vm_init.sh, nothing in the guest handles the power
+            # button
+            events.append(('POWERDOWN', None))
+        elif command == 'quit':
+            events.append(('SHUTDOWN', {'guest': False}))
+            self.running = False
+        elif command not in ('qmp_capabilities', 'query-migrate'):
+            reply = {'error': {'class': 'CommandNotFound',
+                               'desc': 'The command %s has not been found'
+                                       % command}}
+            if 'id' in msg:
+                reply['id'] = msg['id']
+            self._send(client, reply)
+            return
+        if command == 'query-migrate':
+            ret = {'status': 'completed'}
+
+        reply = {'return': ret}
+        if 'id' in msg:
+            reply['id'] = msg['id']
+        self._send(client, reply)
+        for name, data in events:
+            self._event(name, data)
+
+    def _handle_agent(self, client, msg):
+        reply = {'return': {}}
+        if msg.get('execute') == 'exec':
+            cmd = msg.get('arguments', {}).get('cmd', '')
+            reply['return'] = {'out': ''.join('%s ok\n' % tap for tap in
+                                              CONFIGURE_OK.findall(cmd)),
+                               'err': '', 'status': 0}
+        if 'id' in msg:
+            reply['id'] = msg['id']
+        self._send(client, reply)
+
+    def _serve_lines(self, client):
+        """Handles the complete lines buffered for client"""
+        chardev = self.clients[client]
+        while '\n' in self.buffers[client]:
+            line, self.buffers[client] = self.buffers[client].split('\n', 1)
+            if not line.strip():
+                continue
+            if chardev == 'qmp':
+                self._handle_qmp(client, json.loads(line))
+            else:
+                self._handle_agent(client, json.loads(line))
+
+    def _accept(self, listener):
+        client, _ = listener.accept()
+        chardev = self.listeners[listener]
+        self.clients[client] = chardev
+        self.buffers[client] = ''
+        if chardev == 'qmp':
+            self._send(client, QMP_GREETING)
+
+    def _read(self, client):
+        try:
+            data = client.recv(65536)
+        except socket.error:
+            data = ''
+        if not data:
+            self.clients.pop(client, None)
+            self.buffers.pop(client, None)
+            client.close()
+            return
+        chardev = self.clients[client]
+        if chardev not in ('qmp', 'agent'):
+            # Console input, e.g. the identity line of a restored VM
+            if chardev == 'mgmt' and self.waiting_identity:
+                self.buffers[client] += data
+                if '\n' in self.buffers[client]:
+                    line = self.buffers[client].split('\n', 1)[0].split()
+                    self.buffers[client] = ''
+                    if line:
+                        self.hostname = line[0]
+                    self.waiting_identity = False
+                    self._boot()
+            return
+        self.buffers[client] += data
+        # Like Qemu, requests to the agent wait until the guest runs it
+        if chardev == 'qmp' or self.booted:
+            self._serve_lines(client)
+
+    def run(self):
+        self.listen()
+        boot_at = time.time() + float(
+            os.environ.get('VLAB_FAKE_BOOT_DELAY', '0'))
+        while self.running:
+            timeout = (None if self.booted or self.waiting_identity else
+                       max(0.01, boot_at - time.time()))
+            try:
+                readable, _, _ = select.select(
+                    self.listeners.keys() + self.clients.keys(), [], [],
+                    timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sock in readable:
+                if sock in self.listeners:
+                    self._accept(sock)
+                elif sock in self.clients:
+                    self._read(sock)
+            if (not self.booted and not self.waiting_identity and
+                    time.time() >= boot_at):
+                # Real Qemu drops console output while no one is connected,
+                # but vLab connects right after spawning it
+                if not self.template:
+                    self._boot()
+                elif self._write_console('vlab-template-ready'):
+                    self.waiting_identity = True
+
+    def cleanup(self):
+        for sock in self.clients.keys() + self.listeners.keys():
+            sock.close()
+        for path in self.chardevs.values():
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def main():
+    qemu = FakeQemu(sys.argv[1:])
+
+    def on_term(signum, frame):
+        qemu.running = False
+        qemu.cleanup()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, on_term)
+    try:
+        qemu.run()
+    finally:
+        qemu.cleanup()
+
+
+if __name__ == '__main__':
+    main()
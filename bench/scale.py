@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""
+Scale benchmarks for vLab
+
+Runs vLab against stand-ins, so neither root, KVM nor real taps are needed:
+  - fake_qemu.py replaces the Qemu binary: it serves the chardev sockets,
+    answers QMP and the guest agent, and writes the boot message on the mgmt
+    console
+  - FakeGuest, a local paramiko SSH server, answers the commands of all VMs
+  - the 'dryrun' network backend replaces tunctl/brctl/ip and netlink
+
+For every lab size, a topology of hosts spread over switches is generated and
+the following are measured: Vlab.start_all, send_cmd latency, the CLI fan-out
+of a command to all hosts (Vlab.exec_on) and Vlab.stop_all. The results can
+be saved as a baseline, and later runs are compared to it.
+
+With --pool, the labs keep that many VMs booted in a pool, which is filled
+before start_all is timed.
+
+Usage:
+  python bench/scale.py --sizes 1,10,100 --save-baseline
+  python bench/scale.py --sizes 1,10,100,1000 --baseline bench/baseline.json
+
+Every fake VM is a small Python process, so the 1000 hosts lab needs a few
+GB of memory and a raised open files limit.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from contextlib import contextmanager
+
+import paramiko
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from vlab.vlab import Vlab
+from vlab.sshpool import default_pool
+from vlab.netbackend import get_backend
+from vlab.tracing import default_tracer
+from vlab.vmpool import close_pools
+from fake_guest import FakeGuest
+
+
+FAKE_QEMU = os.path.join(BENCH_DIR, 'fake_qemu.py')
+VM_PROFILE = os.path.join(os.path.dirname(BENCH_DIR), 'configs', 'vm.json')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_SIZES = '1,10,100'
+POOL_TIMEOUT = 120
+
+# Metrics compared against the baseline. Durations regress when they grow,
+# rates when they shrink.
+LOWER_IS_BETTER = ['start_all', 'stop_all', 'send_cmd.p50', 'send_cmd.p90',
+                   'send_cmd.p99', 'fanout.p50', 'fanout.p90', 'fanout.p99']
+HIGHER_IS_BETTER = ['start_rate', 'send_cmd_rate']
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of values, by nearest rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def distribution(values):
+    """Summarizes durations in seconds"""
+    return {'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': max(values) if values else None,
+            'mean': sum(values) / len(values) if values else None,
+            'count': len(values)}
+
+
+@contextmanager
+def quiet(enabled):
+    """Silences the progress output of vLab"""
+    if not enabled:
+        yield
+        return
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class LabFiles(object):
+    """The config files and directories of a generated lab"""
+
+    def __init__(self, hosts, hosts_per_switch, agent=True, scheduler=None,
+                 pool=None):
+        self.workdir = tempfile.mkdtemp(prefix='vlab-bench-')
+        self.home_dir = os.path.join(self.workdir, 'vmrootfs')
+        self.kernel_dir = os.path.join(self.workdir, 'kernel')
+        self.vm_file = os.path.join(self.workdir, 'vm.json')
+        self.topo_file = os.path.join(self.workdir, 'topo.json')
+
+        os.makedirs(os.path.join(self.home_dir, 'root', '.ssh'))
+        os.makedirs(self.kernel_dir)
+        paramiko.RSAKey.generate(2048).write_private_key_file(
+            os.path.join(self.home_dir, 'root', '.ssh', 'id_rsa'))
+        with open(os.path.join(self.kernel_dir, 'linux'), 'w'):
+            pass
+
+        self._write_json(self.vm_file,
+                         self._get_vm_profile(agent, scheduler or {},
+                                              pool or {}))
+        self._write_json(self.topo_file,
+                         self._get_topology(hosts, hosts_per_switch))
+
+    @staticmethod
+    def _write_json(path, data):
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def _get_vm_profile(self, agent, scheduler, pool):
+        """Returns the profile of configs/vm.json, pointed at the stand-ins.
+        Without agent, the guest agent port is left out and commands go over
+        SSH. scheduler and pool override options of the launch scheduler and
+        of the VM pool."""
+        with open(VM_PROFILE, 'r') as f:
+            profile = json.load(f)
+        profile.update({'qemu_binary': FAKE_QEMU,
+                        'base_name': 'bench-vm',
+                        'misc_params': '',
+                        'net_backend': 'dryrun',
+                        'boot_mode': 'cold'})
+        profile['rootfs'] = {'backend': '9p'}
+        profile.setdefault('scheduler', {}).update(scheduler)
+        profile.setdefault('pool', {}).update(pool)
+        profile['kernel_image']['dir'] = self.kernel_dir
+        profile['kernel_image']['image_name'] = 'linux'
+        profile['kernel_image']['init_params']['init'] = os.path.join(
+            os.path.dirname(BENCH_DIR), 'scripts', 'vm_init.sh')
+        if not agent:
+            profile['properties'] = [prop for prop in profile['properties']
+                                     if prop['id'] != 'agent']
+        for prop in profile['properties']:
+            if prop['id'] == 'fsdev-home':
+                prop['path'] = self.home_dir
+            elif prop['id'] == 'fsdev-kernel':
+                prop['path'] = self.kernel_dir
+        return profile
+
+    @staticmethod
+    def _get_topology(hosts, hosts_per_switch):
+        """Returns a topo.json with hosts spread over switches"""
+        switches = int(math.ceil(hosts / float(hosts_per_switch)))
+        topo = {'hosts': [], 'switches': [], 'links': [], 'controllers': [],
+                'version': '2'}
+        for i in xrange(1, switches + 1):
+            topo['switches'].append({'number': str(i),
+                                     'opts': {'hostname': 's%d' % i,
+                                              'nodeNum': i}})
+        for i in xrange(1, hosts + 1):
+            topo['hosts'].append({'number': str(i),
+                                  'opts': {'hostname': 'h%d' % i,
+                                           'nodeNum': i, 'sched': 'host'}})
+            topo['links'].append({'src': 'h%d' % i,
+                                  'dest': 's%d' % ((i - 1) //
+                                                   hosts_per_switch + 1),
+                                  'opts': {}})
+        return topo
+
+    def remove(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def run_size(hosts, args):
+    """Benchmarks a lab of the given number of hosts
+
+    :return The metrics of the run
+    :rtype dict
+    """
+    scheduler = {}
+    if args.max_booting is not None:
+        scheduler['max_booting'] = args.max_booting
+    pool = {'size': args.pool}
+    if args.max_booting is not None:
+        pool['max_booting'] = args.max_booting
+    files = LabFiles(hosts, args.hosts_per_switch, not args.no_agent,
+                     scheduler, pool)
+    default_tracer.clear()
+    try:
+        with quiet(not args.verbose):
+            start = time.time()
+            lab = Vlab(files.vm_file, files.topo_file)
+            init_time = time.time() - start
+
+            pool_time = None
+            if lab.vm_pool is not None:
+                start = time.time()
+                lab.vm_pool.wait_ready(POOL_TIMEOUT)
+                pool_time = time.time() - start
+
+            start = time.time()
+            lab.start_all()
+            start_time = time.time() - start
+
+            latencies = []
+            commands_start = time.time()
+            for i in xrange(args.commands):
+                host = lab.hosts[i % len(lab.hosts)]
+                start = time.time()
+                host.vmhandler.send_cmd('true')
+                latencies.append(time.time() - start)
+            commands_time = time.time() - commands_start
+
+            fanouts = []
+            for _ in xrange(args.fanouts):
+                # Same path as a CLI line like 'all ping h1'
+                start = time.time()
+                lab.exec_on(lab.select_hosts('all'),
+                            lab.substitute_names('true'))
+                fanouts.append(time.time() - start)
+
+            start = time.time()
+            lab.stop_all()
+            stop_time = time.time() - start
+            pool_stats = lab.get_pool_stats()
+    finally:
+        close_pools()
+        default_pool.close_all()
+        files.remove()
+
+    return {'hosts': hosts,
+            'init': init_time,
+            'start_all': start_time,
+            'start_rate': hosts / start_time,
+            'stop_all': stop_time,
+            'send_cmd': distribution(latencies),
+            'send_cmd_rate': len(latencies) / commands_time,
+            'fanout': distribution(fanouts),
+            'pool_fill': pool_time,
+            'pool': pool_stats,
+            'backend': get_backend().get_stats()}
+
+
+def get_metric(result, name):
+    value = result
+    for key in name.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(results, baseline, tolerance):
+    """Returns the metrics that got worse than baseline by more than
+    tolerance, as (size, metric, value, baseline value) tuples"""
+    regressions = []
+    for size, result in sorted(results.items(), key=lambda r: int(r[0])):
+        base = baseline.get(size)
+        if base is None:
+            continue
+        for name in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            value = get_metric(result, name)
+            base_value = get_metric(base, name)
+            if value is None or not base_value:
+                continue
+            if name in LOWER_IS_BETTER:
+                worse = value > base_value * (1 + tolerance)
+            else:
+                worse = value < base_value * (1 - tolerance)
+            if worse:
+                regressions.append((size, name, value, base_value))
+    return regressions
+
+
+def format_ms(value):
+    return '%9.2f' % (value * 1000) if value is not None else '        -'
+
+
+def print_report(results):
+    print('%6s %10s %10s %10s %9s %9s %9s %9s %9s' %
+          ('hosts', 'start_all', 'hosts/s', 'stop_all', 'cmd p50',
+           'cmd p99', 'cmds/s', 'fan p50', 'fan p99'))
+    print('%6s %10s %10s %10s %9s %9s %9s %9s %9s' %
+          ('', 's', '', 's', 'ms', 'ms', '', 'ms', 'ms'))
+    for size, r in sorted(results.items(), key=lambda r: int(r[0])):
+        print('%6d %10.3f %10.1f %10.3f %s %s %9.1f %s %s' %
+              (r['hosts'], r['start_all'], r['start_rate'], r['stop_all'],
+               format_ms(r['send_cmd']['p50']),
+               format_ms(r['send_cmd']['p99']), r['send_cmd_rate'],
+               format_ms(r['fanout']['p50']), format_ms(r['fanout']['p99'])))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks vLab against local Qemu, SSH and network '
+                    'stand-ins')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated numbers of hosts (default: '
+                             '%(default)s)')
+    parser.add_argument('--hosts-per-switch', type=int, default=16)
+    parser.add_argument('--commands', type=int, default=100,
+                        help='send_cmd calls timed per lab')
+    parser.add_argument('--fanouts', type=int, default=5,
+                        help='fan-outs to all hosts timed per lab')
+    parser.add_argument('--no-agent', action='store_true',
+                        help='send commands over SSH instead of the guest '
+                             'agent')
+    parser.add_argument('--max-booting', type=int,
+                        help='VMs booting at once (default: the scheduler '
+                             'default, the number of CPUs)')
+    parser.add_argument('--pool', type=int, default=0,
+                        help='VMs kept booted in the pool (default: no '
+                             'pool)')
+    parser.add_argument('--boot-delay', type=float, default=0.0,
+                        help='seconds each fake VM takes to boot')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='results to compare with (default: '
+                             '%(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--output', help='also write the results to this '
+                                         'JSON file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of vLab')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # The fake guest sees every pooled connection being reset at stop_all
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    guest = FakeGuest()
+    guest.start()
+    host, port = guest.get_address()
+    default_pool.connect_host = host
+    default_pool.port = port
+    os.environ['VLAB_FAKE_BOOT_DELAY'] = str(args.boot_delay)
+
+    results = {}
+    try:
+        for size in sizes:
+            print('Benchmarking %d hosts...' % size)
+            results[str(size)] = run_size(size, args)
+    finally:
+        guest.stop()
+
+    print('')
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    status = 0
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('\nSaved baseline to %s' % args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        print('')
+        for size, name, value, base_value in regressions:
+            print('REGRESSION: %s hosts: %s is %.4g, baseline %.4g' %
+                  (size, name, value, base_value))
+        if not regressions:
+            print('No regression against %s' % args.baseline)
+        status = 1 if regressions else 0
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
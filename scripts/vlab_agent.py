@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+vLab guest agent
+
+Started by vm_init.sh on the 'org.vlab.agent' virtio-serial port. It runs the
+commands vLab sends without the cost of an SSH session.
+
+The protocol is the one of QMP: every message is a JSON object on one line.
+Requests carry an id, which is copied to their reply, so many commands can
+be in flight at once:
+  {"execute": "ping", "id": 1}
+  {"return": {}, "id": 1}
+  {"execute": "exec", "arguments": {"cmd": "ip a"}, "id": 2}
+  {"return": {"out": "...", "err": "...", "status": 0}, "id": 2}
+  {"error": {"class": "...", "desc": "..."}, "id": 3}
+
+Usage: vlab_agent.py <port device>
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import threading
+import subprocess
+
+
+class Agent(object):
+    """Serves the requests arriving on the virtio-serial port"""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR)
+        self.lock = threading.Lock()
+
+    def _write(self, msg):
+        data = (json.dumps(msg) + '\n').encode('utf-8')
+        with self.lock:
+            while data:
+                data = data[os.write(self.fd, data):]
+
+    def _reply(self, msg_id, ret=None, error=None):
+        if error is not None:
+            msg = {'error': {'class': 'GenericError', 'desc': error}}
+        else:
+            msg = {'return': ret if ret is not None else {}}
+        if msg_id is not None:
+            msg['id'] = msg_id
+        self._write(msg)
+
+    def _exec(self, msg_id, cmd):
+        try:
+            p = subprocess.Popen(['/bin/bash', '-c', cmd],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, close_fds=True)
+            out, err = p.communicate()
+        except OSError as e:
+            self._reply(msg_id, error=str(e))
+            return
+        self._reply(msg_id, {'out': out.decode('utf-8', 'replace'),
+                             'err': err.decode('utf-8', 'replace'),
+                             'status': p.returncode})
+
+    def _handle(self, msg):
+        msg_id = msg.get('id')
+        command = msg.get('execute')
+        if command == 'ping':
+            self._reply(msg_id)
+        elif command == 'exec':
+            cmd = msg.get('arguments', {}).get('cmd', '')
+            t = threading.Thread(target=self._exec, args=(msg_id, cmd))
+            t.daemon = True
+            t.start()
+        else:
+            self._reply(msg_id, error='Unknown command %s' % command)
+
+    def run(self):
+        buf = b''
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                # No host is connected to the port, wait for one
+                time.sleep(0.1)
+                continue
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                try:
+                    msg = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                if isinstance(msg, dict):
+                    self._handle(msg)
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.stderr.write('Usage: %s <port device>\n' % sys.argv[0])
+        return 1
+    Agent(sys.argv[1]).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
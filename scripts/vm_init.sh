@@ -17,6 +17,13 @@ error() {
 
 info "Running init script"
 
+# Guest uptime at the end of each phase, sent to vLab with the boot
+# message
+VLAB_TIMES=""
+mark() {
+	VLAB_TIMES="${VLAB_TIMES} $1=$(cut -d' ' -f1 /proc/uptime)"
+}
+
 info "Index of VM is " $1
 VM_INDEX=$1
 
@@ -36,6 +43,25 @@ info 'Mounting proc ...'
 mount -n -t proc proc /proc
 info 'Mounting sysfs ...'
 mount -n -t sysfs sys /sys
+if [ "${vlab_rootfs}" = "initramfs" ]; then
+	info 'Mounting devtmpfs ...'
+	mount -t devtmpfs devtmpfs /dev
+fi
+mark kernel
+
+# A template VM is saved by vLab at this point, before any 9p export is
+# mounted. Every VM restored from it reads its identity from the console:
+# <hostname> <mgmt address/len> <mgmt host address> <mgmt MAC> <index>
+if [ -n "${vlab_template}" ]; then
+	info "Template booted, waiting for identity ..."
+	echo "vlab-template-ready"
+	read -r uts vlab_mgmt vlab_mgmt_host vlab_mgmt_mac VM_INDEX
+	info "Restored as ${uts}"
+	hostname ${uts}
+	ip link set dev eth0 address ${vlab_mgmt_mac}
+fi
+
+mark identity
 
 info 'Mounting root overlayshare ...'
 mkdir -p /tmp/vmroot
@@ -46,12 +72,16 @@ info 'Mounting home dir on /root ...'
 [ ! -d /tmp/vmroot/root ] && error 'root folder not found in vmrootfs.'
 mount -o bind /tmp/vmroot/root /root
 
-info 'Mounting /etc ...'
-# Mount /etc
-[ ! -d /tmp/vmroot/etc ] && error 'etc folder not found in vmrootfs.'
-rm -f /tmp/vmroot/etc/mtab      # Make sure mtab file doesn't exist here
-mount -t tmpfs tmpfs /etc -o rw
-cp -r /tmp/vmroot/etc/* /etc/
+# With an initramfs root, /etc was copied from vmrootfs when the image was
+# built and is already writable
+if [ "${vlab_rootfs}" != "initramfs" ]; then
+	info 'Mounting /etc ...'
+	# Mount /etc
+	[ ! -d /tmp/vmroot/etc ] && error 'etc folder not found in vmrootfs.'
+	rm -f /tmp/vmroot/etc/mtab      # Make sure mtab file doesn't exist here
+	mount -t tmpfs tmpfs /etc -o rw
+	cp -r /tmp/vmroot/etc/* /etc/
+fi
 
 info 'Mounting kernel modules ...'
 # Mount kernel modules
@@ -66,6 +96,8 @@ for fs in /run /var/run /var/tmp /var/log; do
 	mount -t tmpfs tmpfs ${fs} -o rw,nosuid,nodev
 done
 
+mark mounts
+
 info "Setup network interfaces ..."
 for intf in /sys/class/net/*; do
 	intf=$(basename ${intf})
@@ -82,15 +114,44 @@ mkdir -p /dev/pts
 mount -t devpts none /dev/pts
 
 # Set ip address on management interface (it should always be eth0)
-# The corresponding TAP on host machine should have ip 10.0.${VM_INDEX}.1/24
-ip addr add 10.0.${VM_INDEX}.2/24 dev eth0
+# vLab passes the guest address and the address of the corresponding TAP on
+# host machine as vlab_mgmt and vlab_mgmt_host on the kernel command line
+if [ -z "${vlab_mgmt}" ]; then
+	vlab_mgmt=10.0.${VM_INDEX}.2/24
+	vlab_mgmt_host=10.0.${VM_INDEX}.1
+fi
+info "Management address is ${vlab_mgmt}"
+ip addr add ${vlab_mgmt} dev eth0
+
+mark network
+
+# The guest agent runs the commands of vLab without SSH. /dev is not managed
+# here, so the node of its virtio-serial port is made from sysfs.
+for port in /sys/class/virtio-ports/*; do
+	[ "$(cat ${port}/name 2>/dev/null)" = "org.vlab.agent" ] || continue
+	agent=$(dirname $0)/vlab_agent.py
+	if [ -f ${agent} ] && which python &> /dev/null; then
+		info "Starting vLab agent ..."
+		IFS=: read major minor < ${port}/dev
+		mknod /tmp/vlab-agent c ${major} ${minor}
+		python ${agent} /tmp/vlab-agent &
+	fi
+done
 
 info "Starting dropbear server ..."
 # Run dropbear with option -E to log errors to stderr
 dropbear -E
+# dropbear opens its listening socket after going to background, so wait for
+# port 22 (0016) to be in LISTEN (0A) state
+for i in {1..100}; do
+	grep -qs ':0016 [0-9A-F]*:0000 0A' /proc/net/tcp /proc/net/tcp6 && break
+	sleep 0.05
+done
+mark sshd
 
-# Notify host that we have finished booting
-echo "$(hostname) booted!" | nc 10.0.${VM_INDEX}.1 20000
+# Tell vLab that we have finished booting. The console is the mgmt serial
+# port, which vLab watches for this line.
+echo "vlab-booted $(hostname)${VLAB_TIMES}"
 
 # Spawn a hell
 while true; do
@@ -0,0 +1,277 @@
+"""
+Address allocators for the management and test networks
+
+A ManagementAllocator gives every VM its own point-to-point subnet (a /30 or
+/31 by default) out of a pool, with the host side TAP on one end and the guest
+on the other. A SegmentAllocator gives every layer 2 segment of the topology
+(a switch, or a direct host to host link) a subnet and every host attached to
+it an address inside that subnet.
+
+Both allocators compute addresses arithmetically and index them by name, by
+index and by address, so all lookups are O(1).
+"""
+
+import socket
+import struct
+from collections import namedtuple
+
+
+def ip_to_int(addr):
+    """Converts a dotted quad to an int"""
+    return struct.unpack('!I', socket.inet_aton(addr))[0]
+
+
+def int_to_ip(value):
+    """Converts an int to a dotted quad"""
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def parse_cidr(cidr):
+    """Parses 'a.b.c.d/len'
+
+    :return The network address as int and the prefix length
+    :rtype tuple
+    """
+    addr, prefixlen = cidr.split('/')
+    prefixlen = int(prefixlen)
+    mask = (0xffffffff << (32 - prefixlen)) & 0xffffffff
+    return ip_to_int(addr) & mask, prefixlen
+
+
+class AddressError(Exception):
+    """Raised when a pool is exhausted or an address is invalid"""
+    pass
+
+
+# A point-to-point subnet. host_ip is used on the host TAP, guest_ip inside the
+# VM
+MgmtSubnet = namedtuple('MgmtSubnet',
+                        ['index', 'network', 'prefixlen', 'host_ip',
+                         'guest_ip'])
+
+
+class ManagementAllocator(object):
+    """Allocates one point-to-point subnet per VM out of a pool"""
+
+    def __init__(self, pool='172.16.0.0/12', prefixlen=30):
+        """Creates a ManagementAllocator
+
+        :param pool: The network the subnets are taken from
+        :type pool: str
+        :param prefixlen: The prefix length of every subnet
+        :type prefixlen: int
+        """
+        self.pool, pool_prefixlen = parse_cidr(pool)
+        if not pool_prefixlen <= prefixlen <= 31:
+            raise AddressError('Cannot split %s in /%d subnets' %
+                               (pool, prefixlen))
+        self.prefixlen = prefixlen
+        self.subnet_size = 1 << (32 - prefixlen)
+        self.capacity = 1 << (prefixlen - pool_prefixlen)
+        self.by_name = {}
+        self.by_index = {}
+        self.by_address = {}
+
+    def allocate(self, name, index):
+        """Allocates the subnet number index to the VM called name
+
+        :return The allocated subnet
+        :rtype MgmtSubnet
+        """
+        if not 0 <= index < self.capacity:
+            raise AddressError('Management pool holds %d subnets, %s needs '
+                               'number %d' % (self.capacity, name, index))
+        if index in self.by_index:
+            raise AddressError('Management subnet %d is already used by %s' %
+                               (index, self.by_index[index][0]))
+
+        network = self.pool + index * self.subnet_size
+        if self.prefixlen == 31:
+            host_ip, guest_ip = network, network + 1
+        else:
+            host_ip, guest_ip = network + 1, network + 2
+        subnet = MgmtSubnet(index, int_to_ip(network), self.prefixlen,
+                            int_to_ip(host_ip), int_to_ip(guest_ip))
+
+        self.by_name[name] = subnet
+        self.by_index[index] = (name, subnet)
+        self.by_address[subnet.host_ip] = (name, subnet)
+        self.by_address[subnet.guest_ip] = (name, subnet)
+        return subnet
+
+    def release(self, name):
+        """Frees the subnet of the VM called name"""
+        subnet = self.by_name.pop(name, None)
+        if subnet is not None:
+            del self.by_index[subnet.index]
+            del self.by_address[subnet.host_ip]
+            del self.by_address[subnet.guest_ip]
+
+    def lookup_name(self, name):
+        """Returns the subnet of a VM, or None"""
+        return self.by_name.get(name)
+
+    def lookup_index(self, index):
+        """Returns the (name, subnet) pair using subnet number index, or
+        None"""
+        return self.by_index.get(index)
+
+    def lookup_address(self, addr):
+        """Returns the (name, subnet) pair that addr belongs to, or None"""
+        return self.by_address.get(addr)
+
+
+class SegmentAllocator(object):
+    """Allocates test network addresses, one subnet per layer 2 segment"""
+
+    def __init__(self, pool='10.0.0.0/8', prefixlen=24):
+        """Creates a SegmentAllocator
+
+        :param pool: The network the segment subnets are taken from
+        :type pool: str
+        :param prefixlen: The prefix length of every segment subnet
+        :type prefixlen: int
+        """
+        self.pool, pool_prefixlen = parse_cidr(pool)
+        if not pool_prefixlen <= prefixlen <= 30:
+            raise AddressError('Cannot split %s in /%d subnets' %
+                               (pool, prefixlen))
+        self.prefixlen = prefixlen
+        self.subnet_size = 1 << (32 - prefixlen)
+        self.capacity = 1 << (prefixlen - pool_prefixlen)
+        self.mask = (0xffffffff << (32 - prefixlen)) & 0xffffffff
+        self.pool_mask = (0xffffffff << (32 - pool_prefixlen)) & 0xffffffff
+        self.segments = {}
+        self.networks = set()
+        # Subnets of the addresses chosen in the topology config, left to
+        # the segments of these addresses
+        self.claimed_networks = set()
+        self.next_network = 0
+        self.next_host = {}
+        self.by_name = {}
+        self.by_address = {}
+
+    def _get_segment(self, segment, addr=None):
+        """Returns the network of segment, giving it one if it has none yet:
+        the subnet holding addr if it is free, the first free one otherwise
+        """
+        network = self.segments.get(segment)
+        if network is not None:
+            return network
+        if len(self.segments) >= self.capacity:
+            raise AddressError('Test pool holds only %d segments' %
+                               self.capacity)
+        if addr is not None:
+            network = ip_to_int(addr) & self.mask
+            if (network & self.pool_mask != self.pool or
+                    network in self.networks):
+                network = None
+        if network is None:
+            network = self._next_free_network(self.claimed_networks)
+            if network is None:
+                network = self._next_free_network(set())
+        self.segments[segment] = network
+        self.networks.add(network)
+        self.next_host[segment] = 1
+        return network
+
+    def _next_free_network(self, skipped):
+        """Returns the first network not used by a segment nor in skipped,
+        or None if there is none left"""
+        index = self.next_network
+        while index < self.capacity:
+            network = self.pool + index * self.subnet_size
+            if network not in self.networks and network not in skipped:
+                if not skipped:
+                    self.next_network = index
+                return network
+            index += 1
+        return None
+
+    def _check_owner(self, name, addr):
+        owner = self.by_address.get(addr)
+        if owner is not None and owner != name:
+            raise AddressError('%s is used by both %s and %s' %
+                               (addr, owner, name))
+
+    def claim(self, name, addr):
+        """Sets an address chosen in the topology config aside for host
+        name, before any address is allocated, so that allocate never hands
+        it out whatever the order of the links
+
+        :param addr: The address, as 'a.b.c.d'
+        :type addr: str
+        """
+        self._check_owner(name, addr)
+        self.by_address[addr] = name
+        self.claimed_networks.add(ip_to_int(addr) & self.mask)
+
+    def reserve(self, name, segment, cidr):
+        """Records an address chosen in the topology config, so that it is
+        never handed out to another host. A segment without a subnet yet
+        gets the one of the address.
+
+        :return The address, as 'a.b.c.d/len', or None if it is not in the
+        subnet of segment
+        :rtype str
+        """
+        addr = cidr.split('/')[0]
+        network = self._get_segment(segment, addr)
+        if ip_to_int(addr) & self.mask != network:
+            return None
+        self._check_owner(name, addr)
+        self.by_address[addr] = name
+        self.by_name.setdefault(name, []).append(cidr)
+        return cidr
+
+    def allocate(self, name, segment):
+        """Allocates an address for the interface of name on segment
+
+        :param name: The host name
+        :type name: str
+        :param segment: The name of the segment, e.g. the switch name
+        :type segment: str
+        :return The address, as 'a.b.c.d/len'
+        :rtype str
+        """
+        network = self._get_segment(segment)
+        while True:
+            offset = self.next_host[segment]
+            if offset >= self.subnet_size - 1:
+                raise AddressError('Segment %s is full' % segment)
+            self.next_host[segment] = offset + 1
+            addr = int_to_ip(network + offset)
+            if addr not in self.by_address:
+                break
+
+        cidr = '%s/%d' % (addr, self.prefixlen)
+        self.by_address[addr] = name
+        self.by_name.setdefault(name, []).append(cidr)
+        return cidr
+
+    def release(self, name, cidr):
+        """Frees an address given by allocate or reserve"""
+        addr = cidr.split('/')[0]
+        if self.by_address.get(addr) == name:
+            del self.by_address[addr]
+        if cidr in self.by_name.get(name, []):
+            self.by_name[name].remove(cidr)
+
+    def release_segment(self, segment):
+        """Frees the subnet of a segment that has no link left, so that
+        another segment can have it"""
+        network = self.segments.pop(segment, None)
+        if network is None:
+            return
+        self.networks.discard(network)
+        del self.next_host[segment]
+        self.next_network = min(self.next_network,
+                                (network - self.pool) / self.subnet_size)
+
+    def lookup_name(self, name):
+        """Returns the addresses of a host, in allocation order"""
+        return self.by_name.get(name, [])
+
+    def lookup_address(self, addr):
+        """Returns the name of the host using addr, or None"""
+        return self.by_address.get(addr)
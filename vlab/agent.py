@@ -0,0 +1,174 @@
+"""
+Client of the vLab guest agent
+
+The agent (scripts/vlab_agent.py) runs in the guest on a virtio-serial port
+and executes commands without the cost of an SSH session. A GuestAgent keeps
+a connection to the host side of that port for the whole life of the VM.
+Messages are framed as in QMP, one JSON object per line, and carry an id, so
+many commands can be in flight on one connection.
+
+A ping is sent right after connecting. Qemu holds it until the agent opens
+the port, so its reply tells that the agent is up. An agent that does not
+answer a command in time is no longer considered up.
+"""
+
+import json
+import socket
+import threading
+
+from util import Future, connect_unix
+from eventloop import default_loop
+
+
+class AgentError(Exception):
+    """Raised when an agent command fails or the connection is lost"""
+    pass
+
+
+class GuestAgent(object):
+    """Connection to the guest agent of a VM"""
+    CONNECT_TIMEOUT = 10
+    COMMAND_TIMEOUT = 60
+
+    def __init__(self, path, loop=None):
+        """Creates a GuestAgent. No connection is made until connect()
+
+        :param path: Path of the agent port UNIX socket
+        :type path: str
+        :param loop: The loop reading the connection
+        :type loop: EventLoop
+        """
+        self.path = path
+        self.loop = loop if loop is not None else default_loop
+        self.sock = None
+        self.buffer = ''
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {}
+        self.connected = False
+        self.ready = False
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """Connects to the agent port, waiting for Qemu to create its socket
+        if needed. The agent itself may start later.
+
+        :raises AgentError: If the socket cannot be connected in time
+        """
+        try:
+            sock = connect_unix(self.path, timeout)
+        except socket.error, e:
+            raise AgentError('Cannot connect to %s: %s' % (self.path, e))
+
+        self.sock = sock
+        self.buffer = ''
+        self.connected = True
+        self.ready = False
+        self.loop.add_reader(sock, self._on_readable, sock)
+        self.send('ping').add_done_callback(self._on_ping)
+
+    def _on_ping(self, reply):
+        if reply.error is None:
+            self.ready = True
+
+    def _on_readable(self, sock):
+        """Reads the replies that arrived on sock. Runs on the loop thread."""
+        try:
+            data = sock.recv(65536)
+        except socket.error:
+            data = ''
+        if not data:
+            self.loop.remove_reader(sock)
+            self._fail_pending('Agent connection to %s closed' % self.path)
+            return
+
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(msg, dict):
+                self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        with self.lock:
+            reply = self.pending.pop(msg.get('id'), None)
+        if reply is None:
+            return
+        if 'error' in msg:
+            reply.set_error(AgentError('%s: %s' % (
+                msg['error'].get('class'), msg['error'].get('desc'))))
+        else:
+            reply.set_result(msg.get('return'))
+
+    def _fail_pending(self, error):
+        with self.lock:
+            self.connected = False
+            self.ready = False
+            pending = self.pending.values()
+            self.pending = {}
+        for reply in pending:
+            reply.set_error(AgentError(error))
+
+    def send(self, command, arguments=None):
+        """Sends a command without waiting for its reply
+
+        :return The Future of the reply
+        :rtype Future
+        """
+        msg = {'execute': command}
+        if arguments:
+            msg['arguments'] = arguments
+        reply = Future()
+        with self.lock:
+            if not self.connected:
+                raise AgentError('Not connected to %s' % self.path)
+            msg['id'] = self.next_id
+            self.pending[self.next_id] = reply
+            self.next_id += 1
+            self.sock.sendall(json.dumps(msg) + '\n')
+        return reply
+
+    def execute(self, command, arguments=None, timeout=COMMAND_TIMEOUT):
+        """Sends a command and waits for its result. The agent is marked as
+        not ready if no reply came in time.
+
+        :raises AgentError: If the command failed or no reply came in time
+        """
+        reply = self.send(command, arguments)
+        result = reply.wait(timeout)
+        if not reply.is_done():
+            with self.lock:
+                for msg_id, pending in self.pending.items():
+                    if pending is reply:
+                        del self.pending[msg_id]
+                self.ready = False
+            raise AgentError('Timeout waiting for reply to %s' % command)
+        return result
+
+    def run(self, line, timeout=COMMAND_TIMEOUT):
+        """Runs a shell command in the guest and waits for it to exit
+
+        :return A tuple containing out lines, err lines and the exit status
+        :rtype tuple
+        """
+        result = self.execute('exec', {'cmd': line}, timeout)
+        return (result['out'].splitlines(True),
+                result['err'].splitlines(True),
+                result['status'])
+
+    def is_ready(self):
+        """Returns whether the agent answered, so commands can be sent"""
+        return self.ready
+
+    def close(self):
+        """Closes the connection"""
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.loop.remove_reader(self.sock, close=True)
+            self.sock = None
+        self._fail_pending('Agent connection to %s closed' % self.path)
@@ -10,9 +10,17 @@ from cmd import Cmd, IDENTCHARS
 from os import isatty
 import sys
 import os
+import json
+import time
+import socket
 import atexit
 
 from util import run
+from topology import TopologyError
+from qmp import QmpError
+from shaping import SHAPING_OPTS, ShapingError
+from measure import MeasureError, format_results, to_json_results
+from vmpool import close_pools
 
 
 class CLI(Cmd):
@@ -64,6 +72,13 @@ class CLI(Cmd):
         '  <node> command {args}\n'
         'For example:\n'
         '  vLab> h1 ifconfig\n'
+        'or run it on several nodes at once using:\n'
+        '  all command {args}\n'
+        '  <node>,<node>,... command {args}\n'
+        '  <pattern> command {args}\n'
+        'For example:\n'
+        '  vLab> h1,h3 ip a s\n'
+        '  vLab> h* uptime\n'
         '\n'
     )
 
@@ -79,7 +94,8 @@ class CLI(Cmd):
 
     def do_exit(self, _line):
         """Exit"""
-        self.vlab.stop_all()
+        self._print_stopped(self.vlab.stop_all(), False)
+        close_pools()
         return 'Exited by user input'
 
     def do_quit(self, line):
@@ -92,14 +108,67 @@ class CLI(Cmd):
         return self.do_exit(line)
 
     def do_start_all(self, line):
-        """Start All VMs"""
+        """Start All VMs
+        Usage: start_all [background]
+        With background, the prompt comes back right away and the boot can
+        be followed with the status command."""
+        if line.strip() == 'background':
+            started = self.vlab.start_all_async()
+            started.add_done_callback(self._on_started)
+            print('Starting all in background\n')
+            return
         self.vlab.start_all()
         print('Starting all\n')
 
+    @staticmethod
+    def _on_started(started):
+        if started.error is not None:
+            print('\n*** Starting all failed: %s' % started.error)
+            return
+        for name, error in started.result:
+            print('\n*** %s failed to start: %s' % (name, error))
+        print('\nAll VMs started')
+
+    def do_status(self, _line):
+        """Shows how many VMs are still booting"""
+        status = self.vlab.get_boot_status()
+        print('booting: %(booting)d queued: %(queued)d ready: %(ready)d '
+              'paused: %(paused)d total: %(total)d' % status)
+
     def do_stop_all(self, line):
-        """Stop All VMs"""
-        self.vlab.stop_all()
+        """Stop All VMs
+        Usage: stop_all [<timeout>]
+        Qemu is told to quit when a guest does not power off within a
+        second, and killed if it has not exited after timeout seconds."""
+        args = line.split()
+        try:
+            timeout = float(args[0]) if args else None
+        except ValueError:
+            timeout = -1
+        if len(args) > 1 or (timeout is not None and timeout < 0):
+            print('Usage: stop_all [<timeout>]')
+            return
         print('Stopping all\n')
+        if timeout is None:
+            stopped = self.vlab.stop_all()
+        else:
+            stopped = self.vlab.stop_all(timeout)
+        self._print_stopped(stopped, True)
+
+    @staticmethod
+    def _print_stopped(stopped, details):
+        """Prints how the VMs stopped, one line per VM if details is set"""
+        if details:
+            for r in sorted(stopped, key=lambda r: r['name']):
+                print('%-14s %s%s' % (
+                    r['name'], '%.2fs' % r['time']
+                    if r['time'] is not None else '-',
+                    ' (killed)' if r['killed'] else ''))
+        times = [r['time'] for r in stopped if r['time'] is not None]
+        if stopped:
+            print('Stopped %d VMs, %d killed, slowest in %.2fs' %
+                  (len(stopped), len([r for r in stopped if r['killed']]),
+                   max(times) if times else 0))
 
     def do_start_vm_at(self, line):
         """Starts one VM"""
@@ -123,6 +192,220 @@ class CLI(Cmd):
         except ValueError, arg:
             print "The argument does not contain numbers\n", arg
 
+    def do_add_link(self, line):
+        """Adds a link between two nodes of the running lab
+        Usage: add_link <node> <node>"""
+        args = line.split()
+        if len(args) != 2:
+            print('Usage: add_link <node> <node>')
+            return
+        try:
+            link = self.vlab.add_link(args[0], args[1])
+            print('Added %s' % link)
+        except (TopologyError, KeyError, QmpError, ShapingError, OSError,
+                IOError, socket.error), e:
+            print('*** Cannot add link: %s' % e)
+
+    def do_del_link(self, line):
+        """Removes a link between two nodes of the running lab
+        Usage: del_link <node> <node>"""
+        args = line.split()
+        if len(args) != 2:
+            print('Usage: del_link <node> <node>')
+            return
+        try:
+            link = self.vlab.del_link(args[0], args[1])
+            print('Removed %s' % link)
+        except (TopologyError, KeyError, QmpError, ShapingError, OSError,
+                IOError, socket.error), e:
+            print('*** Cannot remove link: %s' % e)
+
+    def do_shape(self, line):
+        """Changes the traffic shaping of links of the running lab
+        Usage: shape <node> <node> | all [clear] [<option>=<value> ...]
+        Options are bw (Mbit/s), delay, jitter (e.g. 10ms), loss (%) and
+        max_queue_size (packets). A value of 'none' removes an option.
+        Without options, shows the current ones."""
+        args = line.split()
+        if not args or (args[0] != 'all' and len(args) < 2):
+            print('Usage: shape <node> <node> | all [clear] '
+                  '[<option>=<value> ...]')
+            return
+        if args[0] == 'all':
+            src, dst, args = 'all', None, args[1:]
+        else:
+            src, dst, args = args[0], args[1], args[2:]
+
+        clear = 'clear' in args
+        opts = {}
+        for arg in args:
+            if arg == 'clear':
+                continue
+            name, sep, value = arg.partition('=')
+            if not sep or name not in SHAPING_OPTS:
+                print('*** Unknown shaping option: %s' % arg)
+                return
+            opts[name] = None if value == 'none' else value
+
+        try:
+            if not opts and not clear:
+                links = (self.vlab.topology.get_links() if src == 'all' else
+                         self.vlab.topology.find_links(src, dst))
+            else:
+                links = self.vlab.shape(src, dst, opts, clear)
+        except (TopologyError, ShapingError, KeyError), e:
+            print('*** Cannot shape links: %s' % e)
+            return
+        for link in links:
+            print('%s: %s' % (link, ' '.join(
+                '%s=%s' % (name, link.opts[name]) for name in SHAPING_OPTS
+                if link.opts.get(name) not in (None, '')) or 'unshaped'))
+
+    def do_measure(self, line):
+        """Measures throughput, RTT percentiles and loss between hosts
+        Usage: measure <node> <node> | <switch> [time=<s>] [count=<n>] [json]
+        With a switch, every pair of hosts on it is measured. Pairs without
+        a common host are measured at once. time=0 only pings."""
+        usage = ('Usage: measure <node> <node> | <switch> [time=<s>] '
+                 '[count=<n>] [json]')
+        names = []
+        opts = {'time': 5, 'count': 20}
+        as_json = False
+        for arg in line.split():
+            name, sep, value = arg.partition('=')
+            if arg == 'json':
+                as_json = True
+            elif sep and name in opts and value.isdigit():
+                opts[name] = int(value)
+            elif not sep:
+                names.append(arg)
+            else:
+                print(usage)
+                return
+
+        try:
+            if len(names) == 1 and names[0] in self.vlab.name_to_switch:
+                pairs = self.vlab.get_switch_pairs(names[0])
+            elif len(names) == 2:
+                pairs = [(names[0], names[1])]
+            else:
+                print(usage)
+                return
+            results = self.vlab.measure(pairs, opts['time'], opts['count'])
+        except (MeasureError, KeyError), e:
+            print('*** Cannot measure: %s' % e)
+            return
+        if as_json:
+            print(json.dumps(to_json_results(results), indent=2))
+        else:
+            print(format_results(results))
+
+    def do_trace(self, line):
+        """Shows where starting the lab spent its time
+        Usage: trace [summary | export <file> | clear]"""
+        args = line.split()
+        tracer = self.vlab.get_tracer()
+        if not args or args[0] == 'summary':
+            print(tracer.format_summary())
+        elif args[0] == 'export' and len(args) == 2:
+            tracer.export_chrome_trace(args[1])
+            print('Wrote Chrome trace to %s' % args[1])
+        elif args[0] == 'clear':
+            tracer.clear()
+        else:
+            print('Usage: trace [summary | export <file> | clear]')
+
+    def do_top(self, line):
+        """Shows the CPU, memory and traffic of every VM and switch,
+        refreshed until Ctrl-C. Starts the telemetry sampler if needed.
+        Usage: top [sort=cpu|rss|rx_bps|tx_bps] [count=<n>]"""
+        opts = {'sort': 'cpu', 'count': None}
+        for arg in line.split():
+            name, sep, value = arg.partition('=')
+            if (name == 'sort' and value in ('cpu', 'rss', 'rx_bps',
+                                             'tx_bps')) or \
+                    (name == 'count' and value.isdigit()):
+                opts[name] = value
+            else:
+                print('Usage: top [sort=cpu|rss|rx_bps|tx_bps] [count=<n>]')
+                return
+        telemetry = self.vlab.get_telemetry()
+        telemetry.start()
+        count = int(opts['count']) if opts['count'] else None
+        try:
+            while count is None or count > 0:
+                stats = telemetry.get_stats()
+                if self.isatty():
+                    # Clears the screen and moves to its top
+                    sys.stdout.write('\033[H\033[2J')
+                print('%s  %d nodes, pass took %.1fms, every %gs\n' % (
+                    time.strftime('%H:%M:%S'), stats['nodes'],
+                    stats['pass_time'] * 1000, stats['interval']))
+                print(telemetry.format_top(opts['sort']))
+                sys.stdout.flush()
+                if count is not None:
+                    count -= 1
+                    if not count:
+                        break
+                time.sleep(stats['interval'])
+        except KeyboardInterrupt:
+            print('')
+
+    def do_telemetry(self, line):
+        """Controls the telemetry sampler
+        Usage: telemetry [start [<interval>] | stop | export <file>]
+        Without arguments, shows its counters."""
+        args = line.split()
+        telemetry = self.vlab.get_telemetry()
+        if not args:
+            stats = telemetry.get_stats()
+            print('running: %s passes: %d nodes: %d last pass: %.1fms '
+                  'interval: %gs' % (telemetry.is_running(), stats['passes'],
+                                     stats['nodes'], stats['pass_time'] * 1000,
+                                     stats['interval']))
+        elif args[0] == 'start' and len(args) <= 2:
+            if len(args) == 2:
+                try:
+                    interval = float(args[1])
+                except ValueError:
+                    interval = 0
+                if interval <= 0:
+                    print('*** Invalid interval: %s' % args[1])
+                    return
+                telemetry.interval = interval
+            telemetry.start()
+        elif args[0] == 'stop' and len(args) == 1:
+            telemetry.stop()
+        elif args[0] == 'export' and len(args) == 2:
+            telemetry.export_json(args[1])
+            print('Wrote telemetry to %s' % args[1])
+        else:
+            print('Usage: telemetry [start [<interval>] | stop | '
+                  'export <file>]')
+
+    def do_ssh_stats(self, _line):
+        """Shows the SSH connection pool counters"""
+        stats = self.vlab.get_ssh_stats()
+        print('hits: %(hits)d misses: %(misses)d reconnects: %(reconnects)d '
+              'open: %(open)d' % stats)
+
+    def do_sched_stats(self, _line):
+        """Shows the launch scheduler counters"""
+        stats = self.vlab.get_scheduler_stats()
+        print('admitted: %(admitted)d rejected: %(rejected)d booting: '
+              '%(booting)d/%(max_booting)d waiting: %(waiting)d peak: '
+              '%(peak_booting)d' % stats)
+
+    def do_pool_stats(self, _line):
+        """Shows the counters of the pool of pre-booted VMs"""
+        stats = self.vlab.get_pool_stats()
+        if stats is None:
+            print('No VM pool: set a size in the pool section of the vm '
+                  'config')
+            return
+        print('ready: %(ready)d/%(size)d booting: %(booting)d claims: '
+              '%(claims)d misses: %(misses)d failures: %(failures)d' % stats)
+
     def do_xterm(self, line):
         """ Run an xterm with a SSH connection to a host"""
         first, args, line = self.parseline(line)
@@ -134,6 +417,12 @@ class CLI(Cmd):
         Overridden to run shell commands when a node is the first CLI argument.
         """
 
+        target, _, rest = line.strip().partition(' ')
+        if (target not in self.vlab.get_vm_names() and
+                (target == 'all' or any(c in target for c in ',*?['))):
+            self.fanout(target, rest.strip())
+            return
+
         first, args, line = self.parseline(line)
 
         print("DEBUG: first: %s args: %s " % (first, args))
@@ -147,14 +436,40 @@ class CLI(Cmd):
             node = self.vlab.get_host_by_name(first)
 
             # Substitute IP addresses for node names in command
-            rest = args.split(' ')
-            rest = [self.vlab.get_host_by_name(arg).get_mgmt_ip()
-                    if arg in self.vlab.get_vm_names() else arg
-                    for arg in rest]
-            rest = ' '.join(rest)
-
-            out_lines, err_lines = node.exec_cmd(rest)
-            for ln in out_lines:
-                print ln,
-            for ln in err_lines:
-                print ln,
+            rest = self.vlab.substitute_names(args)
+
+            stream = node.stream_cmd(rest)
+            try:
+                for name, data in stream:
+                    out = sys.stdout if name == 'out' else sys.stderr
+                    out.write(data)
+                    out.flush()
+            except KeyboardInterrupt:
+                stream.close()
+                print('\nInterrupted, closed the remote command\n')
+                return
+            print('%s: exit %s' % (first, stream.exit_status))
+
+    def fanout(self, selector, args):
+        """Runs a command on all the nodes matched by selector concurrently
+        and prints the output labelled with the node name"""
+        hosts = self.vlab.select_hosts(selector)
+        if not hosts:
+            print('*** No node matches: %s\n' % selector)
+            return
+        if not args:
+            print "*** Enter a command for nodes: %s <cmd>" % selector
+            return
+
+        results = self.vlab.exec_on(hosts, self.vlab.substitute_names(args))
+        for res in results:
+            for ln in res['out'] + res['err']:
+                print '[%s] %s' % (res['name'], ln),
+        for res in results:
+            if res['error'] is not None:
+                status = 'error: %s' % res['error']
+            elif res['status'] is None:
+                status = 'exit unknown'
+            else:
+                status = 'exit %d' % res['status']
+            print('%s: %s (%.3fs)' % (res['name'], status, res['duration']))
@@ -0,0 +1,90 @@
+"""
+Management console of a VM
+
+The mgmt chardev of every VM is its first serial port, which vm_init.sh uses
+as its console. A MgmtConsole keeps a connection to it for the whole life of
+the VM: vm_init.sh reports on it that the VM has booted, and vLab sends on it
+the identity of a VM restored from a template.
+
+Reading is done by the event loop, so the consoles of all VMs share one
+thread, and every message is known to come from the VM the console belongs
+to.
+"""
+
+import socket
+
+from util import connect_unix
+from eventloop import default_loop
+
+
+class MgmtConsole(object):
+    """Connection to the mgmt serial console of a VM"""
+    CONNECT_TIMEOUT = 10
+    # Longer lines are kernel or shell output, not messages for vLab
+    MAX_LINE = 4096
+
+    def __init__(self, path, loop=None):
+        """Creates a MgmtConsole. No connection is made until connect()
+
+        :param path: Path of the mgmt console UNIX socket
+        :type path: str
+        :param loop: The loop reading the console
+        :type loop: EventLoop
+        """
+        self.path = path
+        self.loop = loop if loop is not None else default_loop
+        self.sock = None
+        self.buffer = ''
+        self.handlers = {}
+
+    def on_message(self, marker, handler):
+        """Registers handler to be called with the words following marker,
+        for every console line starting with marker. Handlers run on the
+        loop thread and must not block.
+
+        :param marker: The first word of the line, e.g. 'vlab-booted'
+        :type marker: str
+        """
+        self.handlers.setdefault(marker, []).append(handler)
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """Connects to the console, waiting for Qemu to create its socket if
+        needed
+
+        :raises socket.error: If the console cannot be connected in time
+        """
+        self.sock = connect_unix(self.path, timeout)
+        self.buffer = ''
+        self.loop.add_reader(self.sock, self._on_readable, self.sock)
+
+    def _on_readable(self, sock):
+        try:
+            data = sock.recv(4096)
+        except socket.error:
+            data = ''
+        if not data:
+            self.loop.remove_reader(sock)
+            return
+
+        self.buffer += data
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        if len(self.buffer) > MgmtConsole.MAX_LINE:
+            self.buffer = ''
+        for line in lines:
+            words = line.strip().split(' ')
+            for handler in self.handlers.get(words[0], []):
+                handler(words[1:])
+
+    def send(self, data):
+        """Writes data to the console, as if typed on the serial port"""
+        self.sock.sendall(data)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.loop.remove_reader(self.sock, close=True)
+            self.sock = None
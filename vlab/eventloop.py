@@ -0,0 +1,204 @@
+"""
+Single-threaded event loop for vLab orchestration
+
+The EventLoop runs on one background thread and waits, with poll, on the
+sockets vLab would otherwise block on: the boot notifications and the QMP
+connections of every VM. It also notices Qemu processes that exit. Hundreds
+of VMs are handled without one thread each, and the CLI thread is free while
+a lab boots.
+
+Callbacks run on the loop thread and must not block. Blocking work, like SSH
+commands or tap creation, is handed to a WorkerPool.
+"""
+
+import os
+import time
+import heapq
+import errno
+import fcntl
+import select
+import threading
+import traceback
+
+from util import Future
+
+
+class EventLoop(object):
+    """poll based loop running callbacks on its own thread"""
+    PROCESS_POLL_INTERVAL = 0.2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.poller = select.poll()
+        self.readers = {}
+        self.calls = []
+        self.timers = []
+        self.timer_seq = 0
+        self.processes = []
+        self.last_process_poll = 0
+
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller.register(self.wake_r, select.POLLIN)
+
+    def start(self):
+        """Starts the loop thread, if it is not running yet"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                                           name='vlab-eventloop')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self.thread
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def call_soon(self, func, *args):
+        """Runs func(*args) on the loop thread. Can be called from any
+        thread. The loop is started on first use."""
+        self.start()
+        with self.lock:
+            self.calls.append((func, args))
+        self._wake()
+
+    def call_later(self, delay, func, *args):
+        """Runs func(*args) on the loop thread after delay seconds"""
+        self.call_soon(self._add_timer, time.time() + delay, func, args)
+
+    def _add_timer(self, when, func, args):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (when, self.timer_seq, func, args))
+
+    def add_reader(self, sock, callback, *args):
+        """Calls callback(*args) on the loop thread whenever sock is readable
+        or closed by the peer
+
+        :param sock: A socket, or anything with a fileno() method
+        """
+        self.call_soon(self._add_reader, sock, callback, args)
+
+    def _add_reader(self, sock, callback, args):
+        fd = sock.fileno()
+        self.readers[fd] = (sock, callback, args)
+        self.poller.register(fd, select.POLLIN)
+
+    def remove_reader(self, sock, close=False):
+        """Stops watching sock. With close, sock is closed once the loop
+        does not use it anymore, so its descriptor cannot be reused while
+        it is still registered."""
+        if self.in_loop_thread():
+            self._remove_reader(sock, close)
+        else:
+            self.call_soon(self._remove_reader, sock, close)
+
+    def _remove_reader(self, sock, close):
+        fd = sock.fileno()
+        reader = self.readers.get(fd)
+        if reader is not None and reader[0] is sock:
+            del self.readers[fd]
+            self.poller.unregister(fd)
+        if close:
+            sock.close()
+
+    def watch_process(self, process):
+        """Watches a child process for exit
+
+        :param process: The process, as returned by subprocess.Popen
+        :type process: Popen
+        :return A Future set to the exit code of the process when it exits
+        :rtype Future
+        """
+        exited = Future()
+        self.call_soon(self._add_process, process, exited)
+        return exited
+
+    def _add_process(self, process, exited):
+        # Looked up on the loop thread: _poll_processes replaces the list
+        self.processes.append((process, exited))
+
+    def _poll_processes(self):
+        running = []
+        for process, exited in self.processes:
+            code = process.poll()
+            if code is None:
+                running.append((process, exited))
+            else:
+                self._invoke(exited.set_result, (code,))
+        self.processes = running
+
+    def _get_timeout(self):
+        """Returns how long poll may sleep, in milliseconds, or None"""
+        timeout = None
+        if self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        if self.processes:
+            interval = EventLoop.PROCESS_POLL_INTERVAL
+            timeout = interval if timeout is None else min(timeout, interval)
+        return None if timeout is None else int(timeout * 1000)
+
+    @staticmethod
+    def _invoke(func, args):
+        try:
+            func(*args)
+        except Exception:
+            print('ERROR: event loop callback %s failed' % func)
+            traceback.print_exc()
+
+    def _run(self):
+        while True:
+            try:
+                events = self.poller.poll(self._get_timeout())
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            ready = []
+            for fd, _ in events:
+                if fd == self.wake_r:
+                    try:
+                        while os.read(self.wake_r, 4096):
+                            pass
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                else:
+                    ready.append(fd)
+
+            # Readers go first: the queued calls may register a new socket
+            # under the descriptor of one that was just closed
+            for fd in ready:
+                # An earlier callback may have removed the reader
+                reader = self.readers.get(fd)
+                if reader is not None:
+                    self._invoke(reader[1], reader[2])
+
+            with self.lock:
+                calls = self.calls
+                self.calls = []
+            for func, args in calls:
+                self._invoke(func, args)
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, func, args = heapq.heappop(self.timers)
+                self._invoke(func, args)
+
+            if (self.processes and now - self.last_process_poll >=
+                    EventLoop.PROCESS_POLL_INTERVAL):
+                self.last_process_poll = now
+                self._poll_processes()
+
+
+default_loop = EventLoop()
@@ -0,0 +1,194 @@
+"""
+Initramfs root filesystem backend
+
+An InitramfsBuilder packs the few host binaries a VM needs (with the shared
+libraries they link against), the /etc tree of the vmrootfs and the init
+script into a gzipped cpio archive that Qemu loads with -initrd. The VM then
+runs from memory instead of reading the host root over virtio-9p.
+
+The guest agent, scripts/vlab_agent.py, is packed next to the init script,
+where vm_init.sh looks for it. It only starts if the image also has a python
+able to run it, which the binaries list cannot provide: the standard library
+is not packed. Unless the profile adds one, commands of initramfs VMs go
+over SSH.
+
+The archive is built once and cached, named after a hash of everything it
+contains.
+"""
+
+import os
+import re
+import gzip
+import stat
+import hashlib
+import subprocess
+
+
+class InitramfsError(Exception):
+    """Raised when a file needed in the initramfs cannot be found"""
+    pass
+
+
+class CpioWriter(object):
+    """Writes a cpio archive in the newc format used by the kernel"""
+
+    def __init__(self, f):
+        self.f = f
+        self.ino = 0
+
+    def _pad(self, length):
+        self.f.write('\0' * ((4 - length % 4) % 4))
+
+    def _entry(self, name, mode, data='', rdev=(0, 0)):
+        self.ino += 1
+        name = name.lstrip('/') + '\0'
+        header = ('070701' +
+                  ''.join('%08x' % v for v in
+                          (self.ino, mode, 0, 0, 1, 0, len(data), 0, 0,
+                           rdev[0], rdev[1], len(name), 0)))
+        self.f.write(header + name)
+        self._pad(len(header) + len(name))
+        self.f.write(data)
+        self._pad(len(data))
+
+    def add_dir(self, name):
+        self._entry(name, stat.S_IFDIR | 0755)
+
+    def add_file(self, name, data, mode=0644):
+        self._entry(name, stat.S_IFREG | mode, data)
+
+    def add_symlink(self, name, target):
+        self._entry(name, stat.S_IFLNK | 0777, target)
+
+    def add_chardev(self, name, major, minor):
+        self._entry(name, stat.S_IFCHR | 0600, rdev=(major, minor))
+
+    def close(self):
+        self._entry('TRAILER!!!', 0)
+
+
+class InitramfsBuilder(object):
+    """Builds and caches the initramfs of a vm profile"""
+    CACHE_DIR = os.path.expanduser('~/.cache/vlab/initramfs')
+    DIRS = ['bin', 'sbin', 'usr', 'usr/bin', 'usr/sbin', 'lib', 'lib64',
+            'dev', 'proc', 'sys', 'tmp', 'etc', 'root', 'run', 'var',
+            'var/run', 'var/tmp', 'var/log', 'lib/modules']
+    LDD_LIB = re.compile(r'(/\S+) \(0x')
+    AGENT_SCRIPT = 'vlab_agent.py'
+
+    def __init__(self, rootfs_config, etc_dir, init_script):
+        """Creates an InitramfsBuilder
+
+        :param rootfs_config: The 'rootfs' section of the vm config
+        :type rootfs_config: dict
+        :param etc_dir: The /etc tree copied in the image
+        :type etc_dir: str
+        :param init_script: The script run as /init
+        :type init_script: str
+        """
+        self.binaries = rootfs_config.get('binaries', [])
+        self.busybox_applets = rootfs_config.get('busybox_applets', [])
+        self.cache_dir = os.path.expanduser(
+            rootfs_config.get('cache_dir', InitramfsBuilder.CACHE_DIR))
+        self.etc_dir = etc_dir
+        self.init_script = init_script
+
+    @staticmethod
+    def _which(name):
+        if os.path.isabs(name):
+            return name
+        for d in os.environ.get('PATH', '').split(os.pathsep) + \
+                ['/sbin', '/usr/sbin']:
+            path = os.path.join(d, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+        raise InitramfsError('Binary not found: %s' % name)
+
+    @staticmethod
+    def _get_libs(path):
+        """Returns the shared libraries path links against, including the
+        dynamic loader. Static binaries have none."""
+        p = subprocess.Popen(['ldd', path], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        output, _ = p.communicate()
+        return InitramfsBuilder.LDD_LIB.findall(output)
+
+    def _collect(self):
+        """Returns the (archive path, host path) pairs of all regular files
+        of the image"""
+        files = {}
+        for name in self.binaries:
+            path = self._which(name)
+            files['bin/' + os.path.basename(path)] = path
+            for lib in self._get_libs(path):
+                files[lib.lstrip('/')] = lib
+
+        for root, dirs, names in os.walk(self.etc_dir):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if name == 'mtab' or not os.path.isfile(path):
+                    continue
+                rel = os.path.relpath(path, self.etc_dir)
+                files['etc/' + rel] = path
+
+        init_script = os.path.realpath(self.init_script)
+        files['init'] = init_script
+        # vm_init.sh runs the agent found next to itself, / once it is /init
+        agent = os.path.join(os.path.dirname(init_script),
+                             InitramfsBuilder.AGENT_SCRIPT)
+        if os.path.isfile(agent):
+            files[InitramfsBuilder.AGENT_SCRIPT] = agent
+        return sorted(files.items())
+
+    def _get_key(self, files):
+        h = hashlib.sha1(' '.join(self.busybox_applets))
+        for name, path in files:
+            h.update(name + '\0')
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha1(f.read()).digest())
+        return h.hexdigest()
+
+    def get_image(self):
+        """Returns the path of the initramfs, building it if the cached one
+        does not match the current files"""
+        files = self._collect()
+        path = os.path.join(self.cache_dir,
+                            'initramfs-' + self._get_key(files) + '.cpio.gz')
+        if not os.path.exists(path):
+            self._build(path, files)
+        return path
+
+    def _build(self, path, files):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        print('Building initramfs ' + path)
+
+        tmp_path = path + '.tmp'
+        f = gzip.open(tmp_path, 'wb')
+        try:
+            cpio = CpioWriter(f)
+            dirs = set(InitramfsBuilder.DIRS)
+            for name, _ in files:
+                d = os.path.dirname(name)
+                while d:
+                    dirs.add(d)
+                    d = os.path.dirname(d)
+            for d in sorted(dirs):
+                cpio.add_dir(d)
+
+            cpio.add_chardev('dev/console', 5, 1)
+            cpio.add_chardev('dev/null', 1, 3)
+            names = set()
+            for name, host_path in files:
+                mode = stat.S_IMODE(os.stat(host_path).st_mode)
+                with open(host_path, 'rb') as src:
+                    cpio.add_file(name, src.read(), mode)
+                names.add(name)
+            for applet in self.busybox_applets:
+                if 'bin/' + applet not in names:
+                    cpio.add_symlink('bin/' + applet, 'busybox')
+            cpio.close()
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
@@ -0,0 +1,79 @@
+"""
+Lifecycle of the VMs of a mostly idle lab
+
+The 'lifecycle' section of the vm config holds:
+  - lazy_start: start_all only starts the switches, and every VM is started
+    on its first use (a command, an xterm, a measurement or a new link),
+    together with the hosts it shares a link or a switch with
+  - idle_pause: seconds after which a VM that runs no command is paused
+    with the monitor stop command, 0 to never pause. The next use resumes it
+    with cont.
+
+An IdleMonitor checks all the VMs of a lab from a single thread.
+"""
+
+import threading
+
+
+class IdleMonitor(object):
+    """Pauses the VMs left idle"""
+    MIN_INTERVAL = 0.5
+    MAX_INTERVAL = 5.0
+
+    def __init__(self, get_vms, idle_pause):
+        """Creates an IdleMonitor. Nothing is paused until start()
+
+        :param get_vms: Returns the VmHandlers to watch
+        :type get_vms: function
+        :param idle_pause: Seconds of idleness before a VM is paused
+        :type idle_pause: float
+        """
+        self.get_vms = get_vms
+        self.idle_pause = idle_pause
+        # Checks often enough that a VM is paused soon after the threshold
+        self.interval = max(IdleMonitor.MIN_INTERVAL,
+                            min(IdleMonitor.MAX_INTERVAL, idle_pause / 4.0))
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.paused = 0
+
+    def start(self):
+        """Starts watching, if it is not running yet"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run,
+                                           name='vlab-idle')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stops watching. Paused VMs stay paused."""
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self.stopped.set()
+            thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """Pauses the VMs idle for longer than the threshold
+
+        :return The VMs paused by this call
+        :rtype list(VmHandler)
+        """
+        paused = []
+        for vm in self.get_vms():
+            try:
+                if vm.pause_if_idle(self.idle_pause):
+                    paused.append(vm)
+            except Exception, e:
+                print('ERROR: %s: cannot pause: %s' % (vm.get_vm_name(), e))
+        self.paused += len(paused)
+        return paused
@@ -0,0 +1,197 @@
+"""
+Throughput and latency measurements between hosts
+
+A measurement between two hosts pings the destination, to get the RTT
+percentiles and the loss, then runs an iperf client against an iperf server
+started on the destination for the occasion. Everything runs through
+Host.exec_cmd_status, so it uses the guest agent when it is up. The
+destination is reached on its test address, so the traffic goes through the
+emulated links and not through the management network.
+
+Vlab.measure runs the measurements of pairs without a common host at once,
+each pair with its own iperf port.
+"""
+
+import re
+import math
+
+
+class MeasureError(Exception):
+    """Raised when a measurement tool fails or its output is not understood"""
+    pass
+
+
+PING_TIME = re.compile(r'time[=<]([\d.]+) ms')
+PING_LOSS = re.compile(r'([\d.]+)% packet loss')
+
+# Answered by the server side once iperf listens on the port, checked like
+# vm_init.sh waits for dropbear
+WAIT_LISTEN = ('for i in $(seq 100); do grep -qs ":%04X [0-9A-F]*:0000 0A" '
+               '/proc/net/tcp /proc/net/tcp6 && break; sleep 0.05; done')
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of values, by nearest rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def parse_ping(lines):
+    """Returns the RTTs in ms and the loss in percent from ping output
+
+    :rtype tuple
+    """
+    rtts = []
+    loss = None
+    for line in lines:
+        match = PING_TIME.search(line)
+        if match:
+            rtts.append(float(match.group(1)))
+        match = PING_LOSS.search(line)
+        if match:
+            loss = float(match.group(1))
+    if loss is None:
+        raise MeasureError('No ping summary in: %s' % ''.join(lines))
+    return rtts, loss
+
+
+def parse_iperf(lines):
+    """Returns the throughput in bits/s from iperf -y C output. The last
+    report covers the whole test."""
+    for line in reversed(lines):
+        fields = line.strip().split(',')
+        if len(fields) >= 9:
+            try:
+                return float(fields[8])
+            except ValueError:
+                pass
+    raise MeasureError('No iperf report in: %s' % ''.join(lines))
+
+
+def get_rtt_stats(rtts):
+    """Summarizes RTTs in ms
+
+    :rtype dict
+    """
+    return {'min': min(rtts) if rtts else None,
+            'p50': percentile(rtts, 50),
+            'p90': percentile(rtts, 90),
+            'p99': percentile(rtts, 99),
+            'max': max(rtts) if rtts else None,
+            'mean': sum(rtts) / len(rtts) if rtts else None}
+
+
+class PairMeasurement(object):
+    """Measurement from one host to another"""
+    BASE_PORT = 5201
+    PING_INTERVAL = 0.05
+
+    def __init__(self, src, dst, dst_ip, port=BASE_PORT, duration=5,
+                 count=20):
+        """Creates a PairMeasurement
+
+        :param src: The host running the clients
+        :type src: Host
+        :param dst: The host running the iperf server
+        :type dst: Host
+        :param dst_ip: The address of dst that src sends to
+        :type dst_ip: str
+        :param port: The iperf port
+        :type port: int
+        :param duration: Seconds of iperf traffic, 0 to only ping
+        :type duration: int
+        :param count: Number of pings
+        :type count: int
+        """
+        self.src = src
+        self.dst = dst
+        self.dst_ip = dst_ip
+        self.port = port
+        self.duration = duration
+        self.count = count
+
+    def _exec(self, host, line):
+        out, err, status = host.exec_cmd_status(line)
+        if status != 0:
+            raise MeasureError('%s: "%s" exited with %s: %s' %
+                               (host.get_hostname(), line, status,
+                                ''.join(err).strip()))
+        return out
+
+    def ping(self):
+        """Returns the RTTs in ms and the loss in percent"""
+        out, err, _ = self.src.exec_cmd_status(
+            'ping -n -c %d -i %g -w %d %s' %
+            (self.count, PairMeasurement.PING_INTERVAL,
+             self.count * PairMeasurement.PING_INTERVAL + 5, self.dst_ip))
+        return parse_ping(out + err)
+
+    def iperf(self):
+        """Returns the TCP throughput from src to dst, in bits/s"""
+        # The server stops by itself if the cleanup below never runs
+        self._exec(self.dst,
+                   '(timeout %d iperf -s -p %d > /dev/null 2>&1 &); ' %
+                   (self.duration + 30, self.port) +
+                   WAIT_LISTEN % self.port)
+        try:
+            return parse_iperf(self._exec(
+                self.src, 'iperf -c %s -p %d -t %d -y C' %
+                (self.dst_ip, self.port, self.duration)))
+        finally:
+            # The brackets keep pkill from matching its own shell
+            self.dst.exec_cmd_status('pkill -f "[i]perf -s -p %d"' %
+                                     self.port)
+
+    def run(self):
+        """Runs the measurement
+
+        :return A dict with the keys src, dst, dst_ip, throughput (bits/s),
+        rtt (see get_rtt_stats), loss (%) and error
+        :rtype dict
+        """
+        result = {'src': self.src.get_topo_name(),
+                  'dst': self.dst.get_topo_name(),
+                  'dst_ip': self.dst_ip, 'throughput': None,
+                  'rtt': get_rtt_stats([]), 'loss': None, 'error': None}
+        try:
+            rtts, result['loss'] = self.ping()
+            result['rtt'] = get_rtt_stats(rtts)
+            if self.duration > 0:
+                result['throughput'] = self.iperf()
+        except Exception, e:
+            result['error'] = e
+        return result
+
+
+def format_results(results):
+    """Returns measurement results as a printable table"""
+    def ms(value):
+        return '%8.3f' % value if value is not None else '       -'
+
+    lines = ['%-10s %-10s %10s %8s %8s %8s %8s %7s' %
+             ('src', 'dst', 'Mbit/s', 'rtt p50', 'rtt p90', 'rtt p99',
+              'rtt max', 'loss%')]
+    for r in results:
+        if r['error'] is not None and r['loss'] is None:
+            lines.append('%-10s %-10s error: %s' % (r['src'], r['dst'],
+                                                   r['error']))
+            continue
+        lines.append('%-10s %-10s %10s %s %s %s %s %7.1f' % (
+            r['src'], r['dst'],
+            '%10.2f' % (r['throughput'] / 1e6)
+            if r['throughput'] is not None else '-',
+            ms(r['rtt']['p50']), ms(r['rtt']['p90']), ms(r['rtt']['p99']),
+            ms(r['rtt']['max']), r['loss']))
+        if r['error'] is not None:
+            lines.append('%-10s %-10s error: %s' % (r['src'], r['dst'],
+                                                   r['error']))
+    return '\n'.join(lines)
+
+
+def to_json_results(results):
+    """Returns the results with their errors as strings, for JSON output"""
+    return [dict(r, error=str(r['error']) if r['error'] is not None
+                 else None) for r in results]
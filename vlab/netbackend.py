@@ -0,0 +1,554 @@
+"""
+Host network backends for vLab
+
+A network backend creates and removes the TAP interfaces used by the VMs, the
+bridges used by Switches, and sets addresses on host interfaces.
+
+NetlinkBackend talks to the kernel directly (TUNSETIFF/TUNSETPERSIST for taps,
+rtnetlink for bridges and addresses) and sends the rtnetlink requests of a
+batch in chunks, one socket write each. CommandLineBackend forks tunctl,
+brctl and ip like vLab always did, and is used when netlink is not
+available. DryRunBackend only records the operations, for running vLab
+against stand-in VMs without root.
+Both real backends run tc commands in batches, with one tc process.
+"""
+
+import os
+import re
+import errno
+import fcntl
+import socket
+import struct
+import subprocess
+import threading
+from contextlib import contextmanager
+
+from util import run
+
+
+class NetBackend(object):
+    """Interface of the host network backends"""
+
+    def create_tap(self, name=None, multi_queue=False):
+        """Creates a persistent TAP interface
+
+        :param name: The name requested for the new interface
+        :type name: str
+        :param multi_queue: Whether the tap may be opened several times, once
+        per queue (IFF_MULTI_QUEUE). Such taps need a name.
+        :type multi_queue: bool
+        :return: The name of the newly created TAP interface
+        :rtype: str
+        """
+        raise NotImplementedError
+
+    def delete_tap(self, name, multi_queue=False):
+        """Removes a TAP interface, created with the same multi_queue"""
+        raise NotImplementedError
+
+    def add_bridge(self, name):
+        """Creates a bridge"""
+        raise NotImplementedError
+
+    def del_bridge(self, name):
+        """Removes a bridge"""
+        raise NotImplementedError
+
+    def add_bridge_port(self, bridge, intf):
+        """Enslaves intf to bridge"""
+        raise NotImplementedError
+
+    def del_bridge_port(self, bridge, intf):
+        """Releases intf from bridge"""
+        raise NotImplementedError
+
+    def add_address(self, intf, cidr):
+        """Adds an address given as 'a.b.c.d/len' on intf"""
+        raise NotImplementedError
+
+    def add_ifb(self, name):
+        """Creates an ifb device, up, for shaping the traffic redirected to
+        it"""
+        raise NotImplementedError
+
+    def del_ifb(self, name):
+        """Removes an ifb device"""
+        raise NotImplementedError
+
+    # Printed by tc -batch after the error of a failed command
+    TC_FAILED = re.compile(r'^Command failed -:(\d+)$')
+
+    def run_tc(self, commands):
+        """Runs tc commands, given without the leading 'tc', with a single
+        tc process. A failed command does not stop the ones after it.
+
+        :type commands: list(str)
+        :return The failed commands, as (number from 1, error) pairs
+        :rtype list(tuple)
+        """
+        p = subprocess.Popen(['tc', '-force', '-batch', '-'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, close_fds=True)
+        _, output = p.communicate('\n'.join(commands) + '\n')
+        failed = []
+        error = []
+        for line in output.splitlines():
+            match = NetBackend.TC_FAILED.match(line.strip())
+            if match:
+                failed.append((int(match.group(1)),
+                               ' '.join(error) or 'failed'))
+                error = []
+            elif line.strip():
+                error.append(line.strip())
+        if p.returncode != 0 and not failed:
+            failed.append((len(commands), ' '.join(error) or
+                           'tc exited with %d' % p.returncode))
+        return failed
+
+    @contextmanager
+    def batch(self):
+        """Groups the operations done inside the with block. Backends that
+        support it send them in as few writes as they can when the block
+        ends."""
+        yield self
+
+
+class CommandLineBackend(NetBackend):
+    """Backend that runs tunctl, brctl and ip for every operation"""
+
+    def create_tap(self, name=None, multi_queue=False):
+        if multi_queue:
+            # tunctl knows nothing of multiqueue taps
+            if not name:
+                raise ValueError('A multiqueue tap needs a name')
+            subprocess.call(['ip', 'tuntap', 'add', 'dev', name, 'mode',
+                             'tap', 'multi_queue'])
+            return name
+
+        cmd = ['tunctl', '-b']
+        if name:
+            cmd += ['-t', name]
+
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        output, err = p.communicate()
+        return output[0:-1]
+
+    def delete_tap(self, name, multi_queue=False):
+        if multi_queue:
+            subprocess.call(['ip', 'tuntap', 'del', 'dev', name, 'mode',
+                             'tap', 'multi_queue'])
+            return
+        subprocess.call(['tunctl', '-d', name])
+
+    def add_bridge(self, name):
+        run("brctl addbr " + name)
+
+    def del_bridge(self, name):
+        run("brctl delbr " + name)
+
+    def add_bridge_port(self, bridge, intf):
+        run("brctl addif " + bridge + " " + intf)
+
+    def del_bridge_port(self, bridge, intf):
+        run("brctl delif " + bridge + " " + intf)
+
+    def add_address(self, intf, cidr):
+        subprocess.call(['ip', 'addr', 'add', cidr, 'dev', intf])
+
+    def add_ifb(self, name):
+        run("ip link add name " + name + " type ifb")
+        run("ip link set dev " + name + " up")
+
+    def del_ifb(self, name):
+        run("ip link del dev " + name)
+
+
+class NetlinkBackend(NetBackend):
+    """Backend that uses the tun driver ioctls and rtnetlink directly"""
+    TUN_DEVICE = '/dev/net/tun'
+    TUNSETIFF = 0x400454ca
+    TUNSETPERSIST = 0x400454cb
+    IFF_TAP = 0x0002
+    IFF_NO_PI = 0x1000
+    IFF_MULTI_QUEUE = 0x0100
+
+    NETLINK_ROUTE = 0
+    NLMSG_ERROR = 2
+    RTM_NEWLINK = 16
+    RTM_DELLINK = 17
+    RTM_NEWADDR = 20
+    NLM_F_REQUEST = 0x1
+    NLM_F_ACK = 0x4
+    NLM_F_EXCL = 0x200
+    NLM_F_CREATE = 0x400
+    IFLA_IFNAME = 3
+    IFLA_MASTER = 10
+    IFLA_LINKINFO = 18
+    IFLA_INFO_KIND = 1
+    IFF_UP = 0x1
+    IFA_ADDRESS = 1
+    IFA_LOCAL = 2
+    # Requests written at once before their acks are read, so that the acks
+    # of a large batch do not overflow the receive buffer
+    CHUNK_SIZE = 128
+    RCVBUF_SIZE = 1 << 20
+
+    def __init__(self):
+        self.local = threading.local()
+        self.seq_lock = threading.Lock()
+        self.seq = 0
+
+    @staticmethod
+    def is_supported():
+        """Returns whether netlink and the tun device can be used here"""
+        if not hasattr(socket, 'AF_NETLINK') or os.geteuid() != 0:
+            return False
+        return os.path.exists(NetlinkBackend.TUN_DEVICE)
+
+    # TAP interfaces
+
+    def _tun_ioctl(self, name, persist, multi_queue=False):
+        """Attaches to the tap called name, creating it if needed, and sets its
+        persistence flag. An existing tap is only attached to with the
+        multi_queue it was created with.
+
+        :return The name of the interface as given by the kernel
+        :rtype str
+        """
+        flags = NetlinkBackend.IFF_TAP | NetlinkBackend.IFF_NO_PI
+        if multi_queue:
+            flags |= NetlinkBackend.IFF_MULTI_QUEUE
+        ifr = struct.pack('16sH22x', name, flags)
+        fd = os.open(NetlinkBackend.TUN_DEVICE, os.O_RDWR)
+        try:
+            ifr = fcntl.ioctl(fd, NetlinkBackend.TUNSETIFF, ifr)
+            fcntl.ioctl(fd, NetlinkBackend.TUNSETPERSIST, int(persist))
+        finally:
+            os.close(fd)
+        return ifr[:16].rstrip('\0')
+
+    def create_tap(self, name=None, multi_queue=False):
+        if multi_queue and not name:
+            raise ValueError('A multiqueue tap needs a name')
+        return self._tun_ioctl(name or 'tap%d', True, multi_queue)
+
+    def delete_tap(self, name, multi_queue=False):
+        if getattr(self.local, 'pending', None) is not None:
+            # rtnetlink removes taps of any kind, so they join the batch
+            payload = (NetlinkBackend._ifinfomsg() +
+                       NetlinkBackend._attr(NetlinkBackend.IFLA_IFNAME,
+                                            name + '\0'))
+            self._request(NetlinkBackend.RTM_DELLINK, 0, payload,
+                          'delete tap ' + name)
+            return
+        self._tun_ioctl(name, False, multi_queue)
+
+    # rtnetlink requests
+
+    @staticmethod
+    def _attr(attr_type, data):
+        """Packs a rtattr, padded to 4 bytes"""
+        length = 4 + len(data)
+        return (struct.pack('=HH', length, attr_type) + data +
+                '\0' * ((4 - length % 4) % 4))
+
+    @staticmethod
+    def _ifindex(name):
+        with open('/sys/class/net/%s/ifindex' % name) as f:
+            return int(f.read())
+
+    @staticmethod
+    def _ifinfomsg(index=0, flags=0):
+        """Packs an ifinfomsg changing the given flags of the interface"""
+        return struct.pack('=BxHiII', socket.AF_UNSPEC, 0, index, flags,
+                           flags)
+
+    def _request(self, msg_type, flags, payload, desc):
+        """Sends a rtnetlink request, or queues it if a batch is open
+
+        :param payload: The payload, or a function returning it. A function
+        is called when the request is sent, so the interface indexes it
+        looks up can be of interfaces created earlier in the batch.
+        :type payload: str or function
+        """
+        request = (msg_type, flags, payload, desc)
+        pending = getattr(self.local, 'pending', None)
+        if pending is not None:
+            pending.append(request)
+        else:
+            self._send([request])
+
+    def _pack(self, msg_type, flags, payload):
+        """Returns the sequence number and the message of a request"""
+        with self.seq_lock:
+            self.seq += 1
+            seq = self.seq
+        return seq, struct.pack('=LHHLL', 16 + len(payload), msg_type,
+                                flags | NetlinkBackend.NLM_F_REQUEST |
+                                NetlinkBackend.NLM_F_ACK, seq, 0) + payload
+
+    def _send(self, requests):
+        """Sends requests in chunks of CHUNK_SIZE, each with one write
+        followed by the reads of its acks. A request whose interface does
+        not exist yet is sent once the requests before it are applied. All
+        the requests are sent even if some fail.
+
+        :raises OSError: If the kernel rejected one of the requests
+        """
+        if not requests:
+            return
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NetlinkBackend.NETLINK_ROUTE)
+        errors = []
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            NetlinkBackend.RCVBUF_SIZE)
+            sock.bind((0, 0))
+            chunk = []
+            for msg_type, flags, payload, desc in requests:
+                if callable(payload):
+                    try:
+                        data = payload()
+                    except IOError:
+                        # The interface may come with the requests before
+                        NetlinkBackend._send_chunk(sock, chunk, errors)
+                        chunk = []
+                        try:
+                            data = payload()
+                        except IOError:
+                            errors.append((errno.ENODEV, desc))
+                            continue
+                else:
+                    data = payload
+                seq, msg = self._pack(msg_type, flags, data)
+                chunk.append((seq, msg, desc))
+                if len(chunk) >= NetlinkBackend.CHUNK_SIZE:
+                    NetlinkBackend._send_chunk(sock, chunk, errors)
+                    chunk = []
+            NetlinkBackend._send_chunk(sock, chunk, errors)
+        finally:
+            sock.close()
+
+        if errors:
+            err, desc = errors[0]
+            raise OSError(err, '%s: %s' % (desc, os.strerror(err)))
+
+    @staticmethod
+    def _send_chunk(sock, chunk, errors):
+        """Writes the messages of chunk at once and waits for their acks,
+        adding the (errno, description) of the rejected ones to errors"""
+        if not chunk:
+            return
+        sock.sendall(''.join(msg for _, msg, _ in chunk))
+        descs = dict((seq, desc) for seq, _, desc in chunk)
+        while descs:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msg_type, _, seq, _ = struct.unpack_from(
+                    '=LHHLL', data, offset)
+                if msg_type == NetlinkBackend.NLMSG_ERROR:
+                    err = -struct.unpack_from('=i', data, offset + 16)[0]
+                    desc = descs.pop(seq, None)
+                    if err and desc is not None:
+                        errors.append((err, desc))
+                offset += (length + 3) & ~3
+
+    @contextmanager
+    def batch(self):
+        if getattr(self.local, 'pending', None) is not None:
+            # Nested batches are merged into the outer one
+            yield self
+            return
+        self.local.pending = []
+        try:
+            yield self
+            pending = self.local.pending
+        finally:
+            self.local.pending = None
+        self._send(pending)
+
+    def _new_link(self, name, kind, flags, desc):
+        """Creates an interface of the given kind, e.g. 'bridge'"""
+        linkinfo = NetlinkBackend._attr(NetlinkBackend.IFLA_INFO_KIND, kind)
+        payload = (NetlinkBackend._ifinfomsg(flags=flags) +
+                   NetlinkBackend._attr(NetlinkBackend.IFLA_IFNAME,
+                                        name + '\0') +
+                   NetlinkBackend._attr(NetlinkBackend.IFLA_LINKINFO,
+                                        linkinfo))
+        self._request(NetlinkBackend.RTM_NEWLINK,
+                      NetlinkBackend.NLM_F_CREATE | NetlinkBackend.NLM_F_EXCL,
+                      payload, desc)
+
+    def _del_link(self, name, desc):
+        payload = (NetlinkBackend._ifinfomsg() +
+                   NetlinkBackend._attr(NetlinkBackend.IFLA_IFNAME,
+                                        name + '\0'))
+        self._request(NetlinkBackend.RTM_DELLINK, 0, payload, desc)
+
+    def add_bridge(self, name):
+        self._new_link(name, 'bridge', 0, 'add bridge ' + name)
+
+    def del_bridge(self, name):
+        self._del_link(name, 'delete bridge ' + name)
+
+    def add_ifb(self, name):
+        self._new_link(name, 'ifb', NetlinkBackend.IFF_UP, 'add ifb ' + name)
+
+    def del_ifb(self, name):
+        self._del_link(name, 'delete ifb ' + name)
+
+    def _set_master(self, intf, master, desc):
+        """Enslaves intf to the bridge called master, or releases it if
+        master is None"""
+        def payload():
+            index = NetlinkBackend._ifindex(master) if master else 0
+            return (NetlinkBackend._ifinfomsg(NetlinkBackend._ifindex(intf)) +
+                    NetlinkBackend._attr(NetlinkBackend.IFLA_MASTER,
+                                         struct.pack('=I', index)))
+        self._request(NetlinkBackend.RTM_NEWLINK, 0, payload, desc)
+
+    def add_bridge_port(self, bridge, intf):
+        self._set_master(intf, bridge, 'enslave %s to %s' % (intf, bridge))
+
+    def del_bridge_port(self, bridge, intf):
+        self._set_master(intf, None, 'release %s from %s' % (intf, bridge))
+
+    def add_address(self, intf, cidr):
+        addr, prefixlen = cidr.split('/')
+        packed = socket.inet_aton(addr)
+
+        def payload():
+            return (struct.pack('=BBBBI', socket.AF_INET, int(prefixlen), 0,
+                                0, NetlinkBackend._ifindex(intf)) +
+                    NetlinkBackend._attr(NetlinkBackend.IFA_LOCAL, packed) +
+                    NetlinkBackend._attr(NetlinkBackend.IFA_ADDRESS, packed))
+        self._request(NetlinkBackend.RTM_NEWADDR,
+                      NetlinkBackend.NLM_F_CREATE | NetlinkBackend.NLM_F_EXCL,
+                      payload, 'add address %s on %s' % (cidr, intf))
+
+
+class DryRunBackend(NetBackend):
+    """Backend that touches nothing on the host and only counts the
+    operations it is asked for"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_tap = 0
+        self.taps = set()
+        self.bridges = set()
+        self.ifbs = set()
+        self.ops = {}
+        self.batches = 0
+
+    def _count(self, op):
+        self.ops[op] = self.ops.get(op, 0) + 1
+
+    def create_tap(self, name=None, multi_queue=False):
+        if multi_queue and not name:
+            raise ValueError('A multiqueue tap needs a name')
+        with self.lock:
+            if not name:
+                name = 'tap%d' % self.next_tap
+                self.next_tap += 1
+            self.taps.add(name)
+            self._count('create_tap')
+            if multi_queue:
+                self._count('create_tap_mq')
+        return name
+
+    def delete_tap(self, name, multi_queue=False):
+        with self.lock:
+            self.taps.discard(name)
+            self._count('delete_tap')
+
+    def add_bridge(self, name):
+        with self.lock:
+            self.bridges.add(name)
+            self._count('add_bridge')
+
+    def del_bridge(self, name):
+        with self.lock:
+            self.bridges.discard(name)
+            self._count('del_bridge')
+
+    def add_bridge_port(self, bridge, intf):
+        with self.lock:
+            self._count('add_bridge_port')
+
+    def del_bridge_port(self, bridge, intf):
+        with self.lock:
+            self._count('del_bridge_port')
+
+    def add_address(self, intf, cidr):
+        with self.lock:
+            self._count('add_address')
+
+    def add_ifb(self, name):
+        with self.lock:
+            self.ifbs.add(name)
+            self._count('add_ifb')
+
+    def del_ifb(self, name):
+        with self.lock:
+            self.ifbs.discard(name)
+            self._count('del_ifb')
+
+    def run_tc(self, commands):
+        with self.lock:
+            self._count('tc_batch')
+            self.ops['tc'] = self.ops.get('tc', 0) + len(commands)
+        return []
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            self.batches += 1
+        yield self
+
+    def get_stats(self):
+        """Returns the operation counters and the interfaces left over
+
+        :rtype dict
+        """
+        with self.lock:
+            return {'ops': dict(self.ops), 'batches': self.batches,
+                    'taps': len(self.taps), 'bridges': len(self.bridges),
+                    'ifbs': len(self.ifbs)}
+
+
+BACKENDS = {
+    'netlink': NetlinkBackend,
+    'cli': CommandLineBackend,
+    'dryrun': DryRunBackend,
+}
+
+_backend = None
+
+
+def set_backend(name='auto'):
+    """Selects the network backend used by vLab
+
+    :param name: 'netlink', 'cli', 'dryrun' or 'auto'. 'auto' uses netlink
+    when it is supported and falls back to the command line tools otherwise
+    :type name: str
+    :return The selected backend
+    :rtype NetBackend
+    """
+    global _backend
+    if name == 'auto':
+        name = 'netlink' if NetlinkBackend.is_supported() else 'cli'
+    if name not in BACKENDS:
+        raise ValueError('Unknown network backend: %s' % name)
+    _backend = BACKENDS[name]()
+    return _backend
+
+
+def get_backend():
+    """Returns the network backend in use, selecting one if needed
+
+    :rtype NetBackend
+    """
+    if _backend is None:
+        set_backend()
+    return _backend
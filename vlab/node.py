@@ -4,8 +4,9 @@ Node objects for vLab
 A Node can be seen as an abstraction for a node in a network topology. It can be
 a Host, a Switch or something.
 """
-from util import run
 from vmhandler import VmHandler
+from netbackend import get_backend
+from tracing import default_tracer
 
 
 class Node(object):
@@ -46,10 +47,17 @@ class Node(object):
 class Switch(Node):
     """A switch is basically a bridge"""
 
-    def __init__(self, s, l):
+    def __init__(self, s, topology):
+        """Creates a Switch
+
+        :param s: The switch config read from topo.json
+        :type s: dict
+        :param topology: The topology the switch is part of
+        :type topology: Topology
+        """
         Node.__init__(self)
         self.switch = s
-        self.links = l
+        self.topology = topology
         self.started = False
 
     def get_hostname(self):
@@ -60,8 +68,8 @@ class Switch(Node):
             print("%s already started" % (self.get_hostname()))
             return
         print 'Starting switch ' + self.get_hostname()
-        cmd = "brctl addbr " + self.get_hostname()
-        run(cmd)
+        with default_tracer.span(self.get_hostname(), 'bridge_create'):
+            get_backend().add_bridge(self.get_hostname())
         self.started = True
 
     def stop(self):
@@ -69,8 +77,7 @@ class Switch(Node):
             print("%s already stopped" % (self.get_hostname()))
             return
         print 'Stopping switch ' + self.get_hostname()
-        cmd = "brctl delbr " + self.get_hostname()
-        run(cmd)
+        get_backend().del_bridge(self.get_hostname())
         self.started = False
 
     def is_started(self):
@@ -78,37 +85,49 @@ class Switch(Node):
 
     def add_intf(self, intf):
         print "Adding interface " + intf
-        cmd = "brctl addif " + self.get_hostname() + " " + intf
-        run(cmd)
+        get_backend().add_bridge_port(self.get_hostname(), intf)
 
     def del_intf(self, intf):
-        print "Deleting interface " + self.int
-        cmd = "brctl delif " + self.get_hostname() + " " + intf
-        run(cmd)
+        print "Deleting interface " + intf
+        get_backend().del_bridge_port(self.get_hostname(), intf)
+
+    def get_peers(self):
+        """Returns the names of the nodes linked to this switch"""
+        return [link.get_peer(self.get_hostname())
+                for link in self.topology.get_links(self.get_hostname())]
+
+    def _get_link_intf(self, link):
+        """Returns the tap of the host at the other end of link, or None if
+        the peer is not a host"""
+        peer = link.get_peer(self.get_hostname())
+        if not self.topology.is_host(peer):
+            return None
+        return link.get_tap(peer)
+
+    def attach_link(self, link):
+        """Adds the interface of one link to this switch"""
+        intf = self._get_link_intf(link)
+        if intf is not None:
+            self.add_intf(intf)
+
+    def detach_link(self, link):
+        """Removes the interface of one link from this switch"""
+        intf = self._get_link_intf(link)
+        if intf is not None:
+            self.del_intf(intf)
 
-    #TODO: reduce duplicate code
     def add_links(self):
         print "Adding Links :"
-        for link in self.links:
-            src = link['src']
-            dst = link['dest']
-
-            if self.get_hostname() == src:
-                peer = dst
-            else:
-                peer = src
-            self.add_intf("tap" + "." + peer)
+        with default_tracer.span(self.get_hostname(), 'bridge_enslave'):
+            with get_backend().batch():
+                for link in self.topology.get_links(self.get_hostname()):
+                    self.attach_link(link)
 
     def del_links(self):
-        for link in self.links:
-            src = link['src']
-            dst = link['dest']
+        with get_backend().batch():
+            for link in self.topology.get_links(self.get_hostname()):
+                self.detach_link(link)
 
-            if self.get_hostname() == src:
-                peer = dst
-            else:
-                peer = src
-            self.del_intf("tap" + "." + peer)
 
 class Host(Node):
     """A Host is actually a node that runs in a Qemu VM"""
@@ -120,6 +139,17 @@ class Host(Node):
         """
         Node.__init__(self)
         self.vmhandler = vmhandler
+        self.starter = None
+
+    def set_starter(self, starter):
+        """Makes the commands of this Host start it first if it is not
+        running, by calling starter with the Host. Used for lazy starts.
+        None turns it off."""
+        self.starter = starter
+
+    def _ensure_started(self):
+        if self.starter is not None and not self.vmhandler.is_started():
+            self.starter(self)
 
     def start(self):
         if not self.vmhandler.is_started():
@@ -130,19 +160,54 @@ class Host(Node):
             self.vmhandler.stop_vm()
 
     def exec_cmd(self, line):
+        self._ensure_started()
         return self.vmhandler.send_cmd(line)
 
+    def exec_cmd_status(self, line):
+        """Runs a cmd on this Host and waits for its exit status
+        :return A tuple containing out lines, err lines and the exit status
+        :rtype tuple
+        """
+        self._ensure_started()
+        return self.vmhandler.send_cmd_status(line)
+
+    def stream_cmd(self, line):
+        """Runs a cmd on this Host, returning its output as it arrives
+        :return A stream of ('out'|'err', data) chunks. Its exit_status is set
+        once the iteration ends
+        :rtype CommandStream
+        """
+        self._ensure_started()
+        return self.vmhandler.stream_cmd(line)
+
     def get_hostname(self):
         return self.vmhandler.get_vm_name()
 
+    def get_topo_name(self):
+        """Returns the name of this Host in the topology config"""
+        return self.vmhandler.get_topo_name()
+
     def is_started(self):
         return self.vmhandler.is_started()
 
     def configure_interfaces(self):
         return self.vmhandler.configure_interfaces()
 
+    def add_link(self, link):
+        return self.vmhandler.add_link(link)
+
+    def remove_link(self, link):
+        return self.vmhandler.remove_link(link)
+
     def run_xterm(self):
+        self._ensure_started()
         return self.vmhandler.run_xterm()
 
     def get_mgmt_ip(self):
         return self.vmhandler.get_mgmt_ip()
+
+    def get_pid(self):
+        return self.vmhandler.get_pid()
+
+    def get_taps(self):
+        return self.vmhandler.get_taps()
@@ -0,0 +1,277 @@
+"""
+QMP client used for managing a Qemu VM
+
+A QmpClient keeps one connection to the QMP socket of a VM for its whole
+lifetime. Commands carry an id, so several of them can be sent before the
+replies are read, and asynchronous events are dispatched to handlers.
+
+Replies and events are read by the event loop, so the connections of all VMs
+share one thread.
+"""
+
+import json
+import socket
+import threading
+
+from util import connect_unix, read_until
+from eventloop import default_loop
+
+
+class QmpError(Exception):
+    """Raised when a QMP command fails or the connection is lost"""
+
+    def __init__(self, message, error_class=None):
+        """Creates a QmpError
+
+        :param error_class: The class of the error replied by Qemu, e.g.
+        'CommandNotFound', None if Qemu did not reply
+        :type error_class: str
+        """
+        Exception.__init__(self, message)
+        self.error_class = error_class
+
+
+class QmpReply(object):
+    """The pending reply of a QMP command"""
+
+    def __init__(self, command, on_timeout=None):
+        """Creates a QmpReply
+
+        :param on_timeout: Called if no reply came in time, e.g. to stop
+        waiting for it
+        :type on_timeout: function
+        """
+        self.command = command
+        self.on_timeout = on_timeout
+        self.result = None
+        self.error = None
+        self.error_class = None
+        self.done = threading.Event()
+
+    def set_result(self, result):
+        self.result = result
+        self.done.set()
+
+    def set_error(self, error, error_class=None):
+        self.error = error
+        self.error_class = error_class
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """Waits for the reply and returns its 'return' member
+
+        :raises QmpError: If the command failed or no reply came in time
+        """
+        if not self.done.wait(timeout):
+            if self.on_timeout is not None:
+                self.on_timeout()
+            raise QmpError('Timeout waiting for reply to %s' % self.command)
+        if self.error is not None:
+            raise QmpError(self.error, self.error_class)
+        return self.result
+
+
+class QmpClient(object):
+    """Long-lived connection to the QMP monitor of a VM"""
+    CONNECT_TIMEOUT = 10
+    CONNECT_RETRY_INTERVAL = 0.05
+    # Seconds a command waits for its reply, so a hung Qemu does not hang
+    # vLab
+    COMMAND_TIMEOUT = 30
+    # Human monitor commands that print nothing when they succeed, so any
+    # output is an error message. Other commands, e.g. info, print results.
+    HMP_SILENT_COMMANDS = ('netdev_add', 'device_add')
+
+    def __init__(self, path, loop=None):
+        """Creates a QmpClient. No connection is made until connect()
+
+        :param path: Path of the QMP UNIX socket
+        :type path: str
+        :param loop: The loop reading the connection
+        :type loop: EventLoop
+        """
+        self.path = path
+        self.loop = loop if loop is not None else default_loop
+        self.sock = None
+        self.buffer = ''
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {}
+        self.handlers = {}
+        self.connected = False
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """Connects to the QMP socket, waiting for Qemu to create it if
+        needed, and negotiates capabilities"""
+        try:
+            sock = connect_unix(self.path, timeout,
+                                QmpClient.CONNECT_RETRY_INTERVAL)
+        except socket.error, e:
+            raise QmpError('Cannot connect to %s: %s' % (self.path, e))
+
+        try:
+            greeting = json.loads(read_until(sock, '\n', timeout))
+        except (socket.error, ValueError), e:
+            sock.close()
+            raise QmpError('No QMP greeting on %s: %s' % (self.path, e))
+        if not isinstance(greeting, dict) or 'QMP' not in greeting:
+            sock.close()
+            raise QmpError('Unexpected QMP greeting: %s' % greeting)
+
+        self.sock = sock
+        self.buffer = ''
+        self.connected = True
+        self.loop.add_reader(sock, self._on_readable, sock)
+        self.execute('qmp_capabilities')
+
+    def _on_readable(self, sock):
+        """Reads the messages that arrived on sock and dispatches them. Runs
+        on the loop thread."""
+        try:
+            data = sock.recv(65536)
+        except socket.error:
+            data = ''
+        if not data:
+            self.loop.remove_reader(sock)
+            self._fail_pending('QMP connection to %s closed' % self.path)
+            return
+
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            if not line.strip():
+                continue
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        if 'event' in msg:
+            for handler in list(self.handlers.get(msg['event'], [])):
+                handler(msg)
+            return
+
+        with self.lock:
+            reply = self.pending.pop(msg.get('id'), None)
+        if reply is None:
+            return
+        if 'error' in msg:
+            reply.set_error('%s: %s' % (msg['error'].get('class'),
+                                        msg['error'].get('desc')),
+                            msg['error'].get('class'))
+        else:
+            reply.set_result(msg.get('return'))
+
+    def _fail_pending(self, error):
+        with self.lock:
+            self.connected = False
+            pending = self.pending.values()
+            self.pending = {}
+        for reply in pending:
+            reply.set_error(error)
+
+    def send(self, command, arguments=None):
+        """Sends a command without waiting for its reply
+
+        :param command: The QMP command name
+        :type command: str
+        :param arguments: The arguments of the command
+        :type arguments: dict
+        :return The pending reply
+        :rtype QmpReply
+        """
+        msg = {'execute': command}
+        if arguments:
+            msg['arguments'] = arguments
+        with self.lock:
+            if not self.connected:
+                raise QmpError('Not connected to %s' % self.path)
+            msg_id = self.next_id
+            self.next_id += 1
+            reply = QmpReply(command, lambda: self._forget(msg_id))
+            msg['id'] = msg_id
+            self.pending[msg_id] = reply
+            try:
+                self.sock.sendall(json.dumps(msg) + '\n')
+                return reply
+            except socket.error, e:
+                del self.pending[msg_id]
+                error = 'Cannot send %s to %s: %s' % (command, self.path, e)
+        # The connection is broken, no other reply will come
+        self._fail_pending(error)
+        raise QmpError(error)
+
+    def _forget(self, msg_id):
+        """Stops waiting for the reply of the command with id msg_id"""
+        with self.lock:
+            self.pending.pop(msg_id, None)
+
+    def execute(self, command, arguments=None, timeout=COMMAND_TIMEOUT):
+        """Sends a command and waits for its result"""
+        return self.send(command, arguments).wait(timeout)
+
+    def execute_many(self, commands, timeout=COMMAND_TIMEOUT):
+        """Sends all commands at once, then waits for all the results
+
+        :param commands: list of (command, arguments) pairs
+        :type commands: list(tuple)
+        :return The results, in the order of commands
+        :rtype list
+        """
+        replies = [self.send(command, arguments)
+                   for command, arguments in commands]
+        return [reply.wait(timeout) for reply in replies]
+
+    def hmp(self, command_line, timeout=COMMAND_TIMEOUT):
+        """Runs a human monitor command through QMP and returns its output
+
+        :raises QmpError: If a hot-plug command printed an error
+        """
+        output = self.execute('human-monitor-command',
+                              {'command-line': command_line}, timeout)
+        QmpClient._check_hmp(command_line, output)
+        return output
+
+    def hmp_many(self, command_lines, timeout=COMMAND_TIMEOUT):
+        """Runs several human monitor commands, pipelined
+
+        :raises QmpError: If a hot-plug command printed an error, once all
+        the commands ran
+        """
+        outputs = self.execute_many(
+            [('human-monitor-command', {'command-line': line})
+             for line in command_lines], timeout)
+        for command_line, output in zip(command_lines, outputs):
+            QmpClient._check_hmp(command_line, output)
+        return outputs
+
+    @staticmethod
+    def _check_hmp(command_line, output):
+        """HMP reports errors as output, not as QMP errors"""
+        words = command_line.split(None, 1)
+        if (words and words[0] in QmpClient.HMP_SILENT_COMMANDS and
+                output and output.strip()):
+            raise QmpError('%s: %s' % (words[0], output.strip()))
+
+    def on_event(self, event, handler):
+        """Registers handler to be called with every event of the given name,
+        e.g. SHUTDOWN, STOP or DEVICE_DELETED. Handlers run on the loop
+        thread and must not block."""
+        self.handlers.setdefault(event, []).append(handler)
+
+    def is_connected(self):
+        """Returns whether the connection is up"""
+        return self.connected
+
+    def close(self):
+        """Closes the connection"""
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.loop.remove_reader(self.sock, close=True)
+            self.sock = None
+        self._fail_pending('QMP connection to %s closed' % self.path)
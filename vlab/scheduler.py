@@ -0,0 +1,221 @@
+"""
+Launch scheduler for the VMs of a lab
+
+A LaunchScheduler decides when each VM of start_all may be spawned. At most
+max_booting VMs boot at once, which defaults to the number of CPUs, and a VM
+is only admitted when its max_ram fits in the memory available on the host,
+less a reserve and the max_ram of the VMs still booting. Waiting VMs are
+launched as earlier ones finish booting. A VM that cannot fit even with
+nothing booting is rejected instead of oversubscribing the host.
+
+The scheduler also decides the CPU affinity of every VM from the sched and
+cores options of its host in topo.json:
+  - cores, e.g. "2,3" or "2-5", pins the Qemu process to those cores
+  - sched 'rt' pins each vCPU thread to its own core instead, taken from
+    cores or, without them, handed out round-robin over the host cores, one
+    per vCPU
+    (core 0 is left to vLab and the rest of the host when there are others)
+  - sched 'host' or 'cfs' without cores leaves the VM unpinned
+"""
+
+import threading
+import multiprocessing
+
+
+class SchedulerError(Exception):
+    """Raised when a VM cannot be admitted"""
+    pass
+
+
+SIZE_UNITS = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+def parse_size(size):
+    """Returns the number of bytes of a size given like the Qemu -m option:
+    a number with an optional k, m, g or t suffix, in MiB without one
+
+    :type size: str or int
+    :rtype int
+    """
+    size = str(size).strip().lower()
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(float(size) * SIZE_UNITS['m'])
+
+
+def parse_cores(cores):
+    """Returns the list of cores given as '0,2-3' or as a list of numbers
+
+    :rtype list(int)
+    """
+    if cores is None or cores == '':
+        return []
+    if isinstance(cores, (list, tuple)):
+        return [int(c) for c in cores]
+    result = []
+    for part in str(cores).split(','):
+        first, sep, last = part.strip().partition('-')
+        if sep:
+            result += range(int(first), int(last) + 1)
+        elif first:
+            result.append(int(first))
+    return result
+
+
+def get_available_memory():
+    """Returns the memory available for new processes, in bytes, as
+    reported by /proc/meminfo, or None if it is not known"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            fields = dict((line.split(':')[0], int(line.split()[1]) * 1024)
+                          for line in f if len(line.split()) >= 2)
+    except (IOError, ValueError):
+        return None
+    if 'MemAvailable' in fields:
+        return fields['MemAvailable']
+    # Kernels older than 3.14
+    return sum(fields.get(name, 0) for name in ('MemFree', 'Buffers',
+                                                  'Cached'))
+
+
+class LaunchScheduler(object):
+    """Admission control and CPU placement for VM launches"""
+    DEFAULT_MEM_RESERVE = '512m'
+
+    def __init__(self, max_booting=None, mem_reserve=DEFAULT_MEM_RESERVE,
+                 cpus=None):
+        """Creates a LaunchScheduler
+
+        :param max_booting: How many VMs may boot at once. None or 0 is the
+        number of CPUs.
+        :type max_booting: int
+        :param mem_reserve: Memory left to the host, like '512m'
+        :type mem_reserve: str
+        :param cpus: The cores of the host, all of them by default
+        :type cpus: list(int)
+        """
+        if not cpus:
+            cpus = range(multiprocessing.cpu_count())
+        self.cpus = list(cpus)
+        self.max_booting = int(max_booting or len(self.cpus))
+        self.mem_reserve = parse_size(mem_reserve)
+        self.lock = threading.Lock()
+        self.queue = []
+        self.booting = {}
+        self.next_core = 0
+        self.stats = {'submitted': 0, 'admitted': 0, 'rejected': 0,
+                      'peak_booting': 0}
+
+    @staticmethod
+    def from_config(config_data):
+        """Creates the scheduler set by the 'scheduler' section of a vm
+        config
+
+        :type config_data: dict
+        :rtype LaunchScheduler
+        """
+        opts = config_data.get('scheduler', {})
+        return LaunchScheduler(
+            opts.get('max_booting'),
+            opts.get('mem_reserve', LaunchScheduler.DEFAULT_MEM_RESERVE),
+            parse_cores(opts.get('cpus')))
+
+    def get_affinity(self, sched, cores, vcpus=1):
+        """Returns how to pin a VM with the given sched and cores options
+
+        :param vcpus: The number of vCPUs of the VM, each of which gets its
+        own core with sched 'rt' when there are enough
+        :type vcpus: int
+        :return A tuple of the cores and of whether they are for the vCPU
+        threads rather than for the whole process. No cores means no pinning.
+        :rtype tuple
+        """
+        cores = parse_cores(cores)
+        if sched != 'rt':
+            return cores, False
+        if not cores:
+            spare = self.cpus[1:] or self.cpus
+            with self.lock:
+                cores = [spare[(self.next_core + i) % len(spare)]
+                         for i in xrange(min(vcpus, len(spare)))]
+                self.next_core += len(cores)
+        return cores, True
+
+    def submit(self, name, ram, booted, launch, reject):
+        """Queues the launch of a VM. Can be called from any thread.
+
+        :param name: The name of the VM
+        :type name: str
+        :param ram: The max_ram of the VM, like '128m'
+        :type ram: str
+        :param booted: The Future completed when the VM has booted or failed
+        :type booted: Future
+        :param launch: Called without arguments once the VM is admitted. It
+        may run on the event loop thread, so it must not block.
+        :param reject: Called with a SchedulerError if the VM cannot be
+        admitted
+        """
+        with self.lock:
+            self.queue.append((name, parse_size(ram), booted, launch, reject))
+            self.stats['submitted'] += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Admits the queued VMs that fit"""
+        while True:
+            with self.lock:
+                if not self.queue or len(self.booting) >= self.max_booting:
+                    return
+                name, ram, booted, launch, reject = self.queue[0]
+                error = self._check_memory(name, ram)
+                if error is None:
+                    self.queue.pop(0)
+                    self.booting[name] = ram
+                    self.stats['admitted'] += 1
+                    self.stats['peak_booting'] = max(
+                        self.stats['peak_booting'], len(self.booting))
+                elif self.booting:
+                    # Waits for the memory of a booting VM
+                    return
+                else:
+                    self.queue.pop(0)
+                    self.stats['rejected'] += 1
+
+            if error is not None:
+                reject(error)
+                continue
+            booted.add_done_callback(
+                lambda f, name=name: self._on_booted(name))
+            launch()
+
+    def _check_memory(self, name, ram):
+        """Returns a SchedulerError if ram does not fit, None otherwise. The
+        lock must be held."""
+        available = get_available_memory()
+        if available is None:
+            return None
+        free = available - self.mem_reserve - sum(self.booting.values())
+        if ram <= free:
+            return None
+        return SchedulerError(
+            'Not enough memory to start %s: %d MiB needed, %d MiB available'
+            % (name, ram >> 20, max(0, free) >> 20))
+
+    def _on_booted(self, name):
+        with self.lock:
+            self.booting.pop(name, None)
+        self._dispatch()
+
+    def get_queued(self):
+        """Returns how many VMs wait for admission"""
+        with self.lock:
+            return len(self.queue)
+
+    def get_stats(self):
+        """Returns the counters of the scheduler"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['booting'] = len(self.booting)
+            stats['waiting'] = len(self.queue)
+            stats['max_booting'] = self.max_booting
+        return stats
@@ -0,0 +1,150 @@
+"""
+Traffic shaping of links
+
+The opts of a link in topo.json may hold the MiniEdit link options: bw in
+Mbit/s, delay and jitter like '10ms', loss in percent and max_queue_size in
+packets. They are applied with tc to the host side taps of the link: a tbf
+qdisc for bw, with a netem qdisc under it for the rest.
+
+As with the TCLink of Mininet, both directions of a link are shaped, so its
+delay counts twice in the RTT. The root qdisc of a tap shapes the traffic
+sent to its VM. A host to host link has a tap at each end, which covers both
+directions. A host to switch link has one tap: the traffic its VM sends is
+redirected from the ingress of the tap to an ifb device, shaped the same
+way.
+
+The tc commands of many links are run by a single tc -batch process, so
+shaping hundreds of links costs one fork.
+"""
+
+import re
+
+
+class ShapingError(Exception):
+    """Raised for invalid link options or failed tc commands"""
+    pass
+
+
+SHAPING_OPTS = ('bw', 'delay', 'jitter', 'loss', 'max_queue_size')
+
+# tbf needs a bucket of at least one timer tick worth of traffic
+TBF_MIN_BURST = 15000
+TBF_HZ = 250
+TBF_LATENCY = '50ms'
+TIME_VALUE = re.compile(r'^\d+(\.\d+)?(us|ms|s)$')
+
+
+def get_ifb_name(tap):
+    """Returns the name of the ifb device shaping the traffic that the VM of
+    tap sends. It is as long as the tap name, so within IFNAMSIZ."""
+    return 'ifb' + tap[3:]
+
+
+def has_shaping(opts):
+    """Returns whether link opts ask for any shaping"""
+    return any(opts.get(name) not in (None, '') for name in SHAPING_OPTS)
+
+
+def _get_number(opts, name, minimum=0, maximum=None):
+    try:
+        value = float(opts[name])
+    except (TypeError, ValueError):
+        raise ShapingError('%s must be a number, not %r' % (name, opts[name]))
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ShapingError('%s is out of range: %s' % (name, opts[name]))
+    return value
+
+
+def _get_time(opts, name):
+    """Returns a tc time from a number of ms or a string like '10ms'"""
+    value = str(opts[name]).strip()
+    if TIME_VALUE.match(value):
+        return value
+    return '%gms' % _get_number(opts, name)
+
+
+def get_qdisc_commands(intf, opts):
+    """Returns the tc commands, without the leading 'tc', shaping intf as
+    set by link opts. intf must have its default qdisc.
+
+    :raises ShapingError: If an option is invalid
+    :rtype list(str)
+    """
+    opts = dict((name, opts[name]) for name in SHAPING_OPTS
+                if opts.get(name) not in (None, ''))
+    commands = []
+    parent = 'root'
+    if 'bw' in opts:
+        bw = _get_number(opts, 'bw', minimum=0.001)
+        burst = max(TBF_MIN_BURST, int(bw * 1e6 / 8 / TBF_HZ))
+        commands.append('qdisc add dev %s root handle 5: tbf rate %gmbit '
+                        'burst %d latency %s' % (intf, bw, burst,
+                                                 TBF_LATENCY))
+        parent = 'parent 5:1'
+
+    netem = ''
+    if 'delay' in opts or 'jitter' in opts:
+        netem += ' delay %s' % (_get_time(opts, 'delay')
+                                if 'delay' in opts else '0ms')
+        if 'jitter' in opts:
+            netem += ' %s' % _get_time(opts, 'jitter')
+    if 'loss' in opts:
+        netem += ' loss %g%%' % _get_number(opts, 'loss', maximum=100)
+    if 'max_queue_size' in opts:
+        netem += ' limit %d' % _get_number(opts, 'max_queue_size', minimum=1)
+    if netem:
+        commands.append('qdisc add dev %s %s handle 10: netem%s' %
+                        (intf, parent, netem))
+    return commands
+
+
+def get_ingress_commands(intf, ifb):
+    """Returns the tc commands redirecting the traffic received by intf to
+    the ifb device ifb
+
+    :rtype list(str)
+    """
+    return ['qdisc add dev %s handle ffff: ingress' % intf,
+            'filter add dev %s parent ffff: protocol all u32 match u32 0 0 '
+            'action mirred egress redirect dev %s' % (intf, ifb)]
+
+
+def apply_shaping(backend, changes, reset=False):
+    """Shapes interfaces with a single tc batch
+
+    :param backend: The network backend running tc
+    :type backend: NetBackend
+    :param changes: (interface, link opts, ifb) triples. The traffic
+    received by the interface is shaped too on ifb, an existing ifb device,
+    unless it is None.
+    :type changes: list(tuple)
+    :param reset: Whether the interfaces may already be shaped. Their qdiscs
+    are removed first.
+    :type reset: bool
+    :raises ShapingError: If an option is invalid or a tc command failed
+    """
+    commands = []
+    resets = set()
+    for intf, opts, ifb in changes:
+        if reset:
+            commands.append('qdisc del dev %s root' % intf)
+            # Numbered from 1, like tc does
+            resets.add(len(commands))
+            commands.append('qdisc del dev %s ingress' % intf)
+            resets.add(len(commands))
+            if ifb is not None:
+                commands.append('qdisc del dev %s root' % ifb)
+                resets.add(len(commands))
+        commands += get_qdisc_commands(intf, opts)
+        if ifb is not None:
+            commands += get_ingress_commands(intf, ifb)
+            commands += get_qdisc_commands(ifb, opts)
+    if not commands:
+        return
+
+    # Removing the qdisc of an interface that was not shaped fails
+    failed = [(number, error) for number, error in backend.run_tc(commands)
+              if number not in resets]
+    if failed:
+        raise ShapingError('; '.join('%s: %s' % (commands[number - 1], error)
+                                     for number, error in failed))
@@ -0,0 +1,165 @@
+"""
+Snapshot based fast boot
+
+A SnapshotManager boots one template VM per vm.json profile, lets it run the
+identity independent part of vm_init.sh and saves its state to an image with
+a Qemu migration to file. Hosts are then restored from that image with
+-incoming and receive their identity (hostname, management address, MAC) over
+their mgmt console, instead of booting a kernel each.
+
+The image is cached and rebuilt whenever the vm profile, the kernel image or
+the init script change. Qemu refuses to migrate a VM that has a virtio-9p
+export mounted, so a template whose root filesystem is on 9p cannot be saved;
+in that case cold boot is used. So are hosts whose settings change their Qemu
+command line, e.g. their number of vCPUs, as the image cannot be restored
+into them.
+"""
+
+import os
+import json
+import time
+import socket
+import hashlib
+import subprocess
+
+from vmconfig import VmConfig
+from qmp import QmpClient, QmpError
+from netbackend import get_backend
+from util import connect_unix, read_until
+
+
+class SnapshotError(Exception):
+    """Raised when the template image cannot be built"""
+    pass
+
+
+class SnapshotManager(object):
+    """Builds and caches the template image of a vm profile"""
+    SNAPSHOT_DIR = os.path.expanduser('~/.cache/vlab/snapshots')
+    # Printed by vm_init.sh when a template waits for its identity
+    READY_MARKER = 'vlab-template-ready'
+    BOOT_TIMEOUT = 120
+    MIGRATE_TIMEOUT = 60
+    MIGRATE_POLL_INTERVAL = 0.1
+
+    def __init__(self, config_data, snapshot_dir=None, initrd=None):
+        """Creates a SnapshotManager for a vm profile
+
+        :param config_data: Dict containing the info from the vm config file
+        :type config_data: dict
+        :param snapshot_dir: Where the template images are kept
+        :type snapshot_dir: str
+        :param initrd: The initramfs of the profile, if it uses one
+        :type initrd: str
+        """
+        self.config_data = config_data
+        self.snapshot_dir = os.path.expanduser(
+            snapshot_dir or config_data.get('snapshot_dir',
+                                            SnapshotManager.SNAPSHOT_DIR))
+        self.template = VmConfig(config_data,
+                                 {'options': {'hostname': 'template'},
+                                  'topology': None},
+                                 0, None)
+        self.template.set_initrd(initrd)
+        self.failed = False
+
+    def _get_key(self):
+        """Returns the hash identifying the current template. It covers the
+        vm profile, the kernel image and the init script."""
+        h = hashlib.sha1(json.dumps(self.config_data, sort_keys=True))
+        # The initramfs is named after the hash of its contents
+        h.update(str(self.template.initrd))
+        kernel = os.path.join(self.template.kernel_dir,
+                              self.template.kernel_image_name)
+        init = os.path.realpath(self.template.kernel_init_params['init'])
+        for path in (kernel, init):
+            st = os.stat(path)
+            h.update('%s %d %d' % (path, st.st_size, int(st.st_mtime)))
+        with open(init, 'rb') as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def accepts(self, config):
+        """Returns whether a VM can be restored from the template image of
+        config: its Qemu command line must only differ by the identity
+
+        :type config: VmConfig
+        :rtype bool
+        """
+        return (config.initrd == self.template.initrd and
+                config.get_smp() == self.template.get_smp() and
+                config.get_datapath() == self.template.get_datapath())
+
+    def get_image(self):
+        """Returns the path of the template image, building it if it is
+        missing or stale. Returns None if the image cannot be built, in which
+        case the VMs should be cold booted."""
+        if self.failed:
+            return None
+        try:
+            path = os.path.join(self.snapshot_dir, self._get_key() + '.img')
+            if not os.path.exists(path):
+                self._build_image(path)
+            return path
+        except (SnapshotError, QmpError, OSError, IOError,
+                socket.error), e:
+            print("ERROR: Cannot use snapshot boot, cold booting: %s" % e)
+            self.failed = True
+            return None
+
+    def _build_image(self, path):
+        """Boots the template VM, waits until it is ready for its identity and
+        migrates it to path"""
+        if not os.path.exists(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        print('Building template image ' + path)
+
+        tap = get_backend().create_tap()
+        process = None
+        qmp = QmpClient(self.template.get_qmp_socket_path())
+        try:
+            process = subprocess.Popen(self.template.get_commandline(tap),
+                                       close_fds=True)
+            console = connect_unix(self.template.get_mgmt_socket_path())
+            try:
+                read_until(console, SnapshotManager.READY_MARKER,
+                           SnapshotManager.BOOT_TIMEOUT)
+            finally:
+                console.close()
+
+            qmp.connect()
+            qmp.execute('stop')
+            tmp_path = path + '.tmp'
+            qmp.execute('migrate', {'uri': 'exec:cat > ' + tmp_path})
+            self._wait_migration(qmp)
+            os.rename(tmp_path, path)
+            qmp.execute('quit')
+        finally:
+            qmp.close()
+            if process is not None:
+                if process.poll() is None:
+                    process.terminate()
+                process.wait()
+            get_backend().delete_tap(tap)
+
+    @staticmethod
+    def _wait_migration(qmp):
+        deadline = time.time() + SnapshotManager.MIGRATE_TIMEOUT
+        while time.time() < deadline:
+            status = qmp.execute('query-migrate').get('status')
+            if status == 'completed':
+                return
+            if status in ('failed', 'cancelled'):
+                raise SnapshotError('Migration of the template %s' % status)
+            time.sleep(SnapshotManager.MIGRATE_POLL_INTERVAL)
+        raise SnapshotError('Migration of the template timed out')
+
+    @staticmethod
+    def get_identity_line(config):
+        """Returns the line read by a restored VM's init script, giving it
+        the identity of config"""
+        subnet = config.get_mgmt_subnet()
+        return '%s %s/%d %s %s %d\n' % (config.get_vm_name(), subnet.guest_ip,
+                                        subnet.prefixlen, subnet.host_ip,
+                                        config.get_mgmt_mac(),
+                                        config.get_vm_index())
@@ -0,0 +1,246 @@
+"""
+Pool of persistent SSH connections used for sending commands to VMs
+
+An SshPool keeps one authenticated paramiko Transport per VM open and opens a
+new channel on it for every command, so the handshake and key loading are paid
+only once per VM lifetime.
+"""
+
+import socket
+import select
+import threading
+
+from paramiko import RSAKey, SSHException
+
+from util import ssh_setup
+
+
+class SshPool(object):
+    """Per-host pool of authenticated SSH clients"""
+    KEEPALIVE_INTERVAL = 15
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, username='root', port=22, connect_host=None):
+        """Creates an empty SshPool
+
+        :param username: The user used for logging in on the VMs
+        :type username: str
+        :param port: The SSH port of the VMs
+        :type port: int
+        :param connect_host: If set, every VM is reached at this address
+        instead of its own, e.g. a local stand-in SSH server. Connections are
+        still pooled per VM.
+        :type connect_host: str
+        """
+        self.username = username
+        self.port = port
+        self.connect_host = connect_host
+        self.clients = {}
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.lock = threading.Lock()
+        self.host_locks = {}
+
+    def _load_key(self, key_filename):
+        """Returns the private key from key_filename, loading it only once"""
+        key = self.keys.get(key_filename)
+        if key is None:
+            key = RSAKey.from_private_key_file(key_filename)
+            self.keys[key_filename] = key
+        return key
+
+    def _connect(self, host, key_filename):
+        """Creates a new authenticated SSHClient for host"""
+        c = ssh_setup()
+        c.connect(self.connect_host or host, port=self.port,
+                  username=self.username,
+                  pkey=self._load_key(key_filename),
+                  timeout=SshPool.CONNECT_TIMEOUT,
+                  allow_agent=False, look_for_keys=False)
+        c.get_transport().set_keepalive(SshPool.KEEPALIVE_INTERVAL)
+        return c
+
+    def _get_host_lock(self, host):
+        with self.lock:
+            lock = self.host_locks.get(host)
+            if lock is None:
+                lock = threading.Lock()
+                self.host_locks[host] = lock
+            return lock
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get(self, host, key_filename):
+        """Returns a connected SSHClient for host, reusing an open one if
+        possible
+
+        :param host: The address of the VM
+        :type host: str
+        :param key_filename: Path to the private key used for authentication
+        :type key_filename: str
+        :rtype: SSHClient
+        """
+        # Connecting to different hosts may happen concurrently, only the
+        # users of the same host wait for each other
+        with self._get_host_lock(host):
+            client = self.clients.get(host)
+            if client is not None and SshPool._is_alive(client):
+                with self.lock:
+                    self.hits += 1
+                return client
+            if client is not None:
+                # The VM was restarted or the connection dropped
+                client.close()
+                with self.lock:
+                    self.reconnects += 1
+            client = self._connect(host, key_filename)
+            with self.lock:
+                self.misses += 1
+                self.clients[host] = client
+            return client
+
+    def _open_session(self, host, key_filename, window_size=None):
+        """Opens a new channel on the pooled connection to host. If the
+        pooled connection turns out to be dead, it is evicted and the channel
+        is opened on a fresh connection.
+
+        :rtype Channel
+        """
+        try:
+            client = self.get(host, key_filename)
+            return client.get_transport().open_session(
+                window_size=window_size)
+        except (SSHException, socket.error, EOFError):
+            self.evict(host)
+            client = self.get(host, key_filename)
+            return client.get_transport().open_session(
+                window_size=window_size)
+
+    def open_channel(self, host, key_filename, line, window_size=None):
+        """Starts line on host on a new channel of the pooled connection.
+        Only opening the channel is retried, a command that may have been
+        sent is not run twice.
+
+        :param window_size: The SSH window of the channel, which bounds how
+        much unread output is buffered locally
+        :type window_size: int
+        :return The channel running the command
+        :rtype Channel
+        """
+        channel = self._open_session(host, key_filename, window_size)
+        try:
+            channel.exec_command(line)
+        except Exception:
+            channel.close()
+            raise
+        return channel
+
+    def exec_command(self, host, key_filename, line):
+        """Runs line on host over a pooled connection, like open_channel
+
+        :return The stdin, stdout and stderr of the new channel
+        :rtype tuple
+        """
+        channel = self.open_channel(host, key_filename, line)
+        return (channel.makefile('wb', -1), channel.makefile('r', -1),
+                channel.makefile_stderr('r', -1))
+
+    def evict(self, host):
+        """Closes and forgets the connection to host, if any"""
+        with self.lock:
+            client = self.clients.pop(host, None)
+            self.host_locks.pop(host, None)
+        if client is not None:
+            client.close()
+
+    def close_all(self):
+        """Closes every pooled connection"""
+        with self.lock:
+            clients = self.clients.values()
+            self.clients = {}
+            self.host_locks = {}
+        for client in clients:
+            client.close()
+
+    def get_stats(self):
+        """Returns the pool counters
+
+        :return A dict with the hits, misses, reconnects and open connections
+        :rtype dict
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'reconnects': self.reconnects,
+                    'open': len(self.clients)}
+
+
+default_pool = SshPool()
+
+
+class CommandStream(object):
+    """Output of a command running on a channel, read as it arrives
+
+    Iterating yields ('out', data) and ('err', data) chunks. After the
+    iteration ends, exit_status holds the exit status of the command.
+    """
+    CHUNK_SIZE = 4096
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, channel, on_done=None):
+        """Creates a CommandStream
+
+        :param channel: The channel the command runs on
+        :param on_done: Called without arguments once, when the iteration
+        ends or the stream is closed
+        """
+        self.channel = channel
+        self.exit_status = None
+        self.on_done = on_done
+
+    def _done(self):
+        on_done, self.on_done = self.on_done, None
+        if on_done is not None:
+            on_done()
+
+    def __iter__(self):
+        try:
+            for chunk in self._read():
+                yield chunk
+        finally:
+            self._done()
+
+    def _read(self):
+        channel = self.channel
+        while True:
+            if channel.recv_ready():
+                data = channel.recv(CommandStream.CHUNK_SIZE)
+                if data:
+                    yield 'out', data
+            elif channel.recv_stderr_ready():
+                data = channel.recv_stderr(CommandStream.CHUNK_SIZE)
+                if data:
+                    yield 'err', data
+            elif channel.exit_status_ready() or channel.closed:
+                break
+            else:
+                select.select([channel], [], [], CommandStream.POLL_INTERVAL)
+
+        # Drain what arrived together with the exit status
+        while channel.recv_ready():
+            yield 'out', channel.recv(CommandStream.CHUNK_SIZE)
+        while channel.recv_stderr_ready():
+            yield 'err', channel.recv_stderr(CommandStream.CHUNK_SIZE)
+        # Set once the status arrived, even if the channel got closed right
+        # after it. -1 if it closed without one.
+        self.exit_status = channel.recv_exit_status()
+
+    def close(self):
+        """Cancels the command by closing its channel"""
+        self.channel.close()
+        self._done()
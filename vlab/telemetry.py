@@ -0,0 +1,247 @@
+"""
+Telemetry of a running lab
+
+A TelemetrySampler takes one pass over the whole lab every interval, on its
+own thread. For every VM it reads the CPU time and RSS of the Qemu process
+from /proc/<pid>/stat and /proc/<pid>/status, and for every VM tap and
+switch bridge it reads the counters in /sys/class/net/<intf>/statistics.
+Rates are computed from the previous pass. The last samples of every node
+are kept in a fixed-size ring buffer.
+
+Interface rates are seen from the host: what a tap receives is what its VM
+sends.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+COUNTERS = ('rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets')
+
+
+def read_process(pid):
+    """Returns the CPU time in seconds and the RSS in bytes of a process, or
+    None if it is gone"""
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            # The command name may hold spaces, the fields after it do not
+            fields = f.read().rsplit(')', 1)[1].split()
+        rss = 0
+        with open('/proc/%d/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    break
+    except (IOError, IndexError, ValueError):
+        return None
+    # utime and stime, the 14th and 15th fields of stat
+    return (int(fields[11]) + int(fields[12])) / float(CLK_TCK), rss
+
+
+def read_counters(intf):
+    """Returns the byte and packet counters of an interface, or None if it
+    is gone"""
+    counters = {}
+    try:
+        for name in COUNTERS:
+            with open('/sys/class/net/%s/statistics/%s' % (intf, name),
+                      'r') as f:
+                counters[name] = int(f.read())
+    except (IOError, ValueError):
+        return None
+    return counters
+
+
+class TelemetrySampler(object):
+    """Samples the resource usage of every node of a lab in the background
+    """
+    DEFAULT_INTERVAL = 1.0
+    DEFAULT_HISTORY = 300
+
+    def __init__(self, get_targets, interval=DEFAULT_INTERVAL,
+                 history=DEFAULT_HISTORY):
+        """Creates a TelemetrySampler. Nothing is sampled until start()
+
+        :param get_targets: Returns the nodes to sample as (name, kind, pid,
+        interfaces) tuples, pid being None for nodes without a process
+        :type get_targets: function
+        :param interval: Seconds between two passes
+        :type interval: float
+        :param history: Samples kept per node
+        :type history: int
+        """
+        self.get_targets = get_targets
+        self.interval = interval
+        self.history = history
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.kinds = {}
+        self.previous = {}
+        self.passes = 0
+        self.pass_time = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Starts sampling, if it is not running yet"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run,
+                                           name='vlab-telemetry')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stops sampling. The samples are kept."""
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self.stopped.set()
+            thread.join()
+
+    def is_running(self):
+        return self.thread is not None
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except Exception, e:
+                print('ERROR: telemetry pass failed: %s' % e)
+            self.stopped.wait(self.interval)
+
+    def sample(self):
+        """Takes one pass over all the nodes"""
+        now = time.time()
+        current = {}
+        samples = {}
+        for name, kind, pid, intfs in self.get_targets():
+            raw = {'time': now, 'pid': pid, 'cpu_time': None, 'rss': None,
+                   'intfs': {}}
+            if pid is not None:
+                process = read_process(pid)
+                if process is not None:
+                    raw['cpu_time'], raw['rss'] = process
+            for intf in intfs:
+                counters = read_counters(intf)
+                if counters is not None:
+                    raw['intfs'][intf] = counters
+            current[name] = raw
+            samples[name] = (kind, self._get_sample(raw,
+                                                    self.previous.get(name)))
+
+        with self.lock:
+            for name, (kind, sample) in samples.iteritems():
+                if name not in self.samples:
+                    self.samples[name] = deque(maxlen=self.history)
+                self.samples[name].append(sample)
+                self.kinds[name] = kind
+            self.previous = current
+            self.passes += 1
+            self.pass_time = time.time() - now
+
+    @staticmethod
+    def _get_sample(raw, prev):
+        """Returns the sample of one node from its counters of this pass and
+        of the previous one"""
+        sample = {'time': raw['time'], 'cpu': None, 'rss': raw['rss']}
+        for name in COUNTERS:
+            sample[name.replace('_bytes', '_bps').replace('_packets',
+                                                          '_pps')] = None
+        # A restarted VM has a new process and new counters
+        if prev is None or prev['pid'] != raw['pid']:
+            return sample
+        elapsed = raw['time'] - prev['time']
+        if elapsed <= 0:
+            return sample
+
+        if raw['cpu_time'] is not None and prev['cpu_time'] is not None:
+            sample['cpu'] = max(0.0, 100.0 * (raw['cpu_time'] -
+                                              prev['cpu_time']) / elapsed)
+        totals = dict((name, 0) for name in COUNTERS)
+        found = False
+        for intf, counters in raw['intfs'].iteritems():
+            old = prev['intfs'].get(intf)
+            if old is None:
+                continue
+            found = True
+            for name in COUNTERS:
+                totals[name] += max(0, counters[name] - old[name])
+        if found:
+            sample['rx_bps'] = totals['rx_bytes'] * 8 / elapsed
+            sample['tx_bps'] = totals['tx_bytes'] * 8 / elapsed
+            sample['rx_pps'] = totals['rx_packets'] / elapsed
+            sample['tx_pps'] = totals['tx_packets'] / elapsed
+        return sample
+
+    def get_latest(self):
+        """Returns the last sample of every node, with its kind
+
+        :rtype dict
+        """
+        with self.lock:
+            return dict((name, dict(samples[-1], kind=self.kinds[name]))
+                        for name, samples in self.samples.iteritems()
+                        if samples)
+
+    def get_history(self, name):
+        """Returns the samples kept for a node, oldest first
+
+        :rtype list(dict)
+        """
+        with self.lock:
+            return list(self.samples.get(name, []))
+
+    def get_stats(self):
+        """Returns the number of passes and the duration of the last one"""
+        with self.lock:
+            return {'passes': self.passes, 'pass_time': self.pass_time,
+                    'nodes': len(self.samples), 'interval': self.interval}
+
+    def to_json(self):
+        """Returns everything sampled as a JSON serializable dict"""
+        with self.lock:
+            return {'interval': self.interval,
+                    'nodes': dict((name, {'kind': self.kinds[name],
+                                          'samples': list(samples)})
+                                  for name, samples in
+                                  self.samples.iteritems())}
+
+    def export_json(self, path):
+        """Writes everything sampled to path as JSON"""
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f)
+
+    def format_top(self, sort='cpu', limit=None):
+        """Returns the last samples as a table, busiest first
+
+        :param sort: The column to sort by: cpu, rss, rx_bps or tx_bps
+        :type sort: str
+        """
+        def fmt(value, scale=1.0, spec='%10.1f'):
+            return spec % (value / scale) if value is not None else \
+                '%10s' % '-'
+
+        latest = self.get_latest()
+        names = sorted(latest, key=lambda n: (latest[n].get(sort) or 0, n),
+                       reverse=True)
+        if limit:
+            names = names[:limit]
+        lines = ['%-14s %-6s %10s %10s %10s %10s %10s %10s' %
+                 ('node', 'kind', 'cpu%', 'rss MiB', 'rx Mbit/s',
+                  'tx Mbit/s', 'rx pkt/s', 'tx pkt/s')]
+        for name in names:
+            s = latest[name]
+            lines.append('%-14s %-6s %s %s %s %s %s %s' % (
+                name, s['kind'], fmt(s['cpu']), fmt(s['rss'], 1 << 20),
+                fmt(s['rx_bps'], 1e6, '%10.3f'),
+                fmt(s['tx_bps'], 1e6, '%10.3f'),
+                fmt(s['rx_pps'], 1, '%10.0f'), fmt(s['tx_pps'], 1, '%10.0f')))
+        return '\n'.join(lines)
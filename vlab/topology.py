@@ -0,0 +1,226 @@
+"""
+In-memory topology graph of a lab
+
+The Topology indexes nodes and links so that the links of a node, or between
+two nodes, are found without scanning the whole link list. Every Link has an
+id, which names its TAP interfaces, hot-plugged devices and MAC addresses, so
+two links of the same host never collide.
+"""
+
+from collections import OrderedDict
+
+from addressing import AddressError
+
+
+class TopologyError(Exception):
+    """Raised for links between unknown nodes or missing links"""
+    pass
+
+
+class Link(object):
+    """A link between two nodes of the topology"""
+    # Interface names are limited to IFNAMSIZ - 1 characters
+    MAX_INTF_NAME = 15
+
+    def __init__(self, link_id, src, dst, opts):
+        """Creates a Link
+
+        :param link_id: Unique id of the link
+        :type link_id: int
+        :param src: Name of the source node
+        :type src: str
+        :param dst: Name of the destination node
+        :type dst: str
+        :param opts: The link options from topo.json
+        :type opts: dict
+        """
+        self.link_id = link_id
+        self.src = src
+        self.dst = dst
+        self.opts = dict(opts)
+        self.addresses = {}
+
+    def __repr__(self):
+        return 'Link(%d, %s, %s)' % (self.link_id, self.src, self.dst)
+
+    def get_endpoints(self):
+        """Returns the names of both ends of the link"""
+        return self.src, self.dst
+
+    def get_peer(self, name):
+        """Returns the name of the other end of the link"""
+        return self.dst if name == self.src else self.src
+
+    def _get_side(self, name):
+        if name not in (self.src, self.dst):
+            raise TopologyError('%s is not an end of %s' % (name, self))
+        return 0 if name == self.src else 1
+
+    def get_tap(self, name):
+        """Returns the name of the host TAP used by the end called name"""
+        tap = 'tap.%s.%d' % (name, self.link_id)
+        if len(tap) > Link.MAX_INTF_NAME:
+            tap = 'tap%d.%d' % (self.link_id, self._get_side(name))
+        return tap
+
+    def get_netdev_id(self, name):
+        """Returns the id of the Qemu netdev used by the end called name"""
+        return 'net%d.%d' % (self.link_id, self._get_side(name))
+
+    def get_device_id(self, name):
+        """Returns the id of the Qemu device used by the end called name"""
+        return 'dev%d.%d' % (self.link_id, self._get_side(name))
+
+    def get_mac(self, name):
+        """Returns the MAC address of the guest interface of the end called
+        name. The address is locally administered and derived from the link
+        id, so it identifies the interface inside the guest."""
+        value = (self.link_id << 1) | self._get_side(name)
+        return '02:76:6c:%02x:%02x:%02x' % ((value >> 16) & 0xff,
+                                            (value >> 8) & 0xff,
+                                            value & 0xff)
+
+    def get_address(self, name):
+        """Returns the test address of the end called name, as 'a.b.c.d/len'
+        """
+        return self.addresses.get(name)
+
+
+class Topology(object):
+    """Indexed graph of hosts, switches and links"""
+    HOST = 'host'
+    SWITCH = 'switch'
+
+    def __init__(self, allocator=None):
+        """Creates an empty Topology
+
+        :param allocator: Gives test addresses to the host ends of links
+        :type allocator: SegmentAllocator
+        """
+        self.allocator = allocator
+        self.nodes = {}
+        self.node_opts = {}
+        self.links = OrderedDict()
+        self.adjacency = {}
+        self.next_link_id = 0
+
+    def add_node(self, name, kind, opts=None):
+        """Adds a host or a switch. The ip option of a host is set aside
+        right away, so no link gets it by allocation.
+
+        :param kind: Topology.HOST or Topology.SWITCH
+        :type kind: str
+        """
+        self.nodes[name] = kind
+        self.node_opts[name] = dict(opts or {})
+        self.adjacency.setdefault(name, OrderedDict())
+        ip = self.node_opts[name].get('ip')
+        if kind == Topology.HOST and ip and self.allocator is not None:
+            self.allocator.claim(name, ip)
+
+    def is_host(self, name):
+        return self.nodes.get(name) == Topology.HOST
+
+    def is_switch(self, name):
+        return self.nodes.get(name) == Topology.SWITCH
+
+    def get_segment(self, link):
+        """Returns the name of the layer 2 segment link belongs to: the
+        switch at one of its ends, or the link itself for host to host
+        links"""
+        for name in link.get_endpoints():
+            if self.is_switch(name):
+                return name
+        return '-'.join(sorted(link.get_endpoints()))
+
+    def add_link(self, src, dst, opts=None):
+        """Adds a link and gives its host ends their test addresses. The
+        first link of a host uses the ip from its topology options, if any
+        and if it is in the subnet of the segment of the link.
+
+        :return The new link
+        :rtype Link
+        """
+        for name in (src, dst):
+            if name not in self.nodes:
+                raise TopologyError('Unknown node %s' % name)
+
+        link = Link(self.next_link_id, src, dst, opts or {})
+        self.next_link_id += 1
+
+        if self.allocator is not None:
+            try:
+                self._allocate_addresses(link)
+            except AddressError:
+                # The link is not added, nor are its addresses
+                self._release_addresses(link)
+                raise
+
+        self.links[link.link_id] = link
+        self.adjacency[src][link.link_id] = link
+        self.adjacency[dst][link.link_id] = link
+        return link
+
+    def _allocate_addresses(self, link):
+        """Gives the host ends of link, which is not added yet, their test
+        addresses"""
+        segment = self.get_segment(link)
+        for name in link.get_endpoints():
+            if not self.is_host(name):
+                continue
+            ip = self.node_opts[name].get('ip')
+            cidr = None
+            if ip and not self.adjacency[name]:
+                cidr = '%s/%d' % (ip, self.allocator.prefixlen)
+                if self.allocator.reserve(name, segment, cidr) is None:
+                    print('WARNING: %s: %s is not in the subnet of %s, '
+                          'allocating another address' %
+                          (name, ip, segment))
+                    self.allocator.release(name, cidr)
+                    cidr = None
+            if cidr is None:
+                cidr = self.allocator.allocate(name, segment)
+            link.addresses[name] = cidr
+
+    def _release_addresses(self, link):
+        """Releases the test addresses of link, which is not in the
+        topology anymore, and the subnet of its segment if no other link
+        uses it"""
+        for name, cidr in link.addresses.items():
+            self.allocator.release(name, cidr)
+        segment = self.get_segment(link)
+        for name in link.get_endpoints():
+            for other in self.adjacency[name].itervalues():
+                if self.get_segment(other) == segment:
+                    return
+        self.allocator.release_segment(segment)
+
+    def remove_link(self, link_id):
+        """Removes a link and releases its test addresses
+
+        :return The removed link
+        :rtype Link
+        """
+        link = self.links.pop(link_id, None)
+        if link is None:
+            raise TopologyError('No link with id %d' % link_id)
+        for name in link.get_endpoints():
+            self.adjacency[name].pop(link_id, None)
+        if self.allocator is not None:
+            self._release_addresses(link)
+        return link
+
+    def get_link(self, link_id):
+        return self.links.get(link_id)
+
+    def get_links(self, name=None):
+        """Returns the links of node name, or all links if name is None, in
+        the order they were added"""
+        if name is None:
+            return self.links.values()
+        return self.adjacency.get(name, {}).values()
+
+    def find_links(self, a, b):
+        """Returns the links between the nodes a and b"""
+        return [link for link in self.get_links(a)
+                if link.get_peer(a) == b]
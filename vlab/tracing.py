@@ -0,0 +1,102 @@
+"""
+Timing spans for the phases of starting a lab
+
+A Tracer records named spans (tap creation, Qemu spawn, guest init phases,
+monitor hot-plug, ...) on one track per node. The spans can be exported in the
+Chrome trace-event format, viewable in chrome://tracing or Perfetto, or
+summarized per phase.
+"""
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """Thread-safe collector of timing spans"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.tracks = {}
+
+    @contextmanager
+    def span(self, track, name, **args):
+        """Records the time spent in the with block as a span
+
+        :param track: The node the span belongs to, e.g. the VM name
+        :type track: str
+        :param name: The phase, e.g. 'qemu_spawn'
+        :type name: str
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(track, name, start, time.time(), args)
+
+    def add_span(self, track, name, start, end, args=None):
+        """Records a span with known start and end times"""
+        with self.lock:
+            if track not in self.tracks:
+                self.tracks[track] = len(self.tracks) + 1
+            self.spans.append((track, name, start, end, args or {}))
+
+    def get_spans(self):
+        """Returns the recorded (track, name, start, end, args) tuples"""
+        with self.lock:
+            return list(self.spans)
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+            self.tracks = {}
+
+    def to_chrome_trace(self):
+        """Returns the spans as a Chrome trace-event document
+
+        :rtype dict
+        """
+        with self.lock:
+            spans = list(self.spans)
+            tracks = dict(self.tracks)
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                   'args': {'name': track}}
+                  for track, tid in tracks.iteritems()]
+        for track, name, start, end, args in spans:
+            events.append({'name': name, 'cat': 'vlab', 'ph': 'X',
+                           'ts': int(start * 1e6),
+                           'dur': int((end - start) * 1e6),
+                           'pid': 1, 'tid': tracks[track], 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        """Writes the spans to path in the Chrome trace-event format"""
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def summary(self):
+        """Returns per phase statistics, slowest total first
+
+        :return A list of (name, count, total, mean, max) tuples, times in
+        seconds
+        :rtype list(tuple)
+        """
+        durations = {}
+        for _, name, start, end, _ in self.get_spans():
+            durations.setdefault(name, []).append(end - start)
+        rows = [(name, len(d), sum(d), sum(d) / len(d), max(d))
+                for name, d in durations.iteritems()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def format_summary(self):
+        """Returns the summary as a printable table"""
+        lines = ['%-20s %6s %10s %10s %10s' %
+                 ('phase', 'count', 'total(s)', 'mean(s)', 'max(s)')]
+        for row in self.summary():
+            lines.append('%-20s %6d %10.3f %10.3f %10.3f' % row)
+        return '\n'.join(lines)
+
+
+default_tracer = Tracer()
@@ -1,5 +1,10 @@
 """Utility functions for vLab"""
 
+import errno
+import socket
+import threading
+import time
+import Queue
 from subprocess import call
 from paramiko import SSHClient, AutoAddPolicy
 
@@ -16,3 +21,190 @@ def ssh_setup():
     c = SSHClient()
     c.set_missing_host_key_policy(AutoAddPolicy())
     return c
+
+
+class Future(object):
+    """The result of an operation that completes later, possibly on another
+    thread"""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def set_result(self, result):
+        """Completes the future with result. Only the first completion
+        counts.
+
+        :return Whether the future was completed by this call
+        :rtype bool
+        """
+        return self._complete(result, None)
+
+    def set_error(self, error):
+        """Completes the future with the exception error"""
+        return self._complete(None, error)
+
+    def _complete(self, result, error):
+        with self.lock:
+            if self.done.is_set():
+                return False
+            self.result = result
+            self.error = error
+            self.done.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once the future is complete. If it already
+        is, callback is called right away, on the calling thread."""
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def is_done(self):
+        return self.done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the future to complete and returns its result. Re-raises
+        its exception, if any"""
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Task(Future):
+    """The pending result of a function submitted to a WorkerPool"""
+
+    def __init__(self, func, args):
+        Future.__init__(self)
+        self.func = func
+        self.args = args
+
+    def run(self):
+        """Runs the function, storing its result or the raised exception"""
+        try:
+            result = self.func(*self.args)
+        except Exception, e:
+            self.set_error(e)
+        else:
+            self.set_result(result)
+
+
+class WorkerPool(object):
+    """A fixed number of threads running submitted functions"""
+
+    def __init__(self, workers):
+        """Starts the worker threads
+
+        :param workers: Maximum number of functions running concurrently
+        :type workers: int
+        """
+        self.queue = Queue.Queue()
+        self.threads = []
+        for _ in xrange(max(1, workers)):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            task.run()
+            self.queue.task_done()
+
+    def submit(self, func, *args):
+        """Schedules func(*args) on one of the workers
+
+        :return The Task holding the result
+        :rtype Task
+        """
+        task = Task(func, args)
+        self.queue.put(task)
+        return task
+
+    def join(self):
+        """Waits for all submitted functions to finish"""
+        self.queue.join()
+
+    def shutdown(self, wait=True):
+        """Stops the workers once all submitted functions are done
+
+        :param wait: Whether to wait for them. Must be False when called from
+        one of the workers.
+        :type wait: bool
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        if wait:
+            for t in self.threads:
+                t.join()
+
+
+def parallel_map(func, items, workers):
+    """Runs func on every item using at most workers threads
+
+    :return A list of Tasks, in the same order as items
+    :rtype list(Task)
+    """
+    pool = WorkerPool(min(workers, len(items)))
+    tasks = [pool.submit(func, item) for item in items]
+    pool.shutdown()
+    return tasks
+
+
+def connect_unix(path, timeout=10, retry_interval=0.05):
+    """Connects to a UNIX socket, waiting for it to be created. Useful for the
+    sockets of a Qemu process that was just started.
+
+    :param path: Path of the socket
+    :type path: str
+    :param timeout: Seconds to wait for the socket
+    :type timeout: float
+    :return The connected socket
+    :rtype socket.socket
+    :raises socket.error: If the socket cannot be connected in time
+    """
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return sock
+        except socket.error, e:
+            sock.close()
+            if (e.errno not in (errno.ENOENT, errno.ECONNREFUSED) or
+                    time.time() > deadline):
+                raise
+            time.sleep(retry_interval)
+
+
+def read_until(sock, marker, timeout):
+    """Reads from sock until marker shows up in the data
+
+    :return The data read, up to and including marker
+    :rtype str
+    :raises socket.timeout: If marker did not show up in time
+    """
+    deadline = time.time() + timeout
+    data = ''
+    while marker not in data:
+        sock.settimeout(max(0.01, deadline - time.time()))
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise socket.error('Connection closed before %r' % marker)
+        data += chunk
+    sock.settimeout(None)
+    return data[:data.index(marker) + len(marker)]
@@ -5,82 +5,455 @@ It instantiates VmConfigLoader and creates the nodes that are then started
 """
 
 import socket
+import threading
+import time
+from fnmatch import fnmatchcase
 
 from vmconfig import VmConfigLoader
 from vmhandler import VmHandler
 from node import Switch, Host
+from sshpool import default_pool
+from topology import TopologyError
+from snapshot import SnapshotManager
+from scheduler import LaunchScheduler
+from lifecycle import IdleMonitor
+from vmpool import get_pool
+from measure import PairMeasurement, MeasureError
+from shaping import SHAPING_OPTS, has_shaping, get_qdisc_commands, \
+    apply_shaping, get_ifb_name
+from telemetry import TelemetrySampler
+from tracing import default_tracer
+from util import Future, WorkerPool, parallel_map
+from netbackend import set_backend, get_backend
+
+
+class VmExitError(Exception):
+    """Raised when a VM exits before it has booted"""
+    pass
 
 
 class Vlab(object):
     """Network emulation with hosts spawned in Qemu"""
-    LISTEN_PORT = 20000
-    BACKLOG = 10
+    MAX_WORKERS = 16
+    FANOUT_WORKERS = 32
+
+    def __init__(self, vm_file='../configs/vm.json',
+                 topo_file='../configs/topo.json'):
+        """Creates the lab described by the given config files
 
-    def __init__(self):
-        self.vm_config_loader = VmConfigLoader()
+        :param vm_file: File where the configs related to Qemu are found
+        :type vm_file: str
+        :param topo_file: File where configs related to topology are found
+        :type topo_file: str
+        """
+        self.vm_config_loader = VmConfigLoader(vm_file, topo_file)
         self.configs = []
         self.topo = {}
+        self.topology = None
+        self.snapshots = None
+        self.vm_pool = None
+        self.scheduler = None
         self.hosts = []
         self.switches = []
 
-        self.notifysocket = None
-        self.start_boot_listener()
         self.name_to_host = {}
+        self.topo_name_to_host = {}
+        self.name_to_switch = {}
+        self.ready_lock = threading.Lock()
+        self.ready_nodes = set()
+        self.linked_switches = set()
+        self.boot_futures = {}
+        # The ifb devices shaping the traffic sent by VMs, see shaping.py
+        self.ifbs = set()
+        self.telemetry = TelemetrySampler(self.get_telemetry_targets)
+        self.lifecycle = None
+        self.idle_monitor = None
+        self.running = False
+        # Hosts being started on demand, by name, to the Future of their batch
+        self.start_lock = threading.Lock()
+        self.starting = {}
 
         self.init_configs()
 
-    def start_boot_listener(self):
-        """Creates a socket to listen for boot signal"""
-        self.notifysocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.notifysocket.bind(('0.0.0.0', Vlab.LISTEN_PORT))
-        self.notifysocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.notifysocket.listen(Vlab.BACKLOG)
+    def _expect_boot(self, host):
+        """Returns a Future set when host sends its boot notification
+
+        :rtype Future
+        """
+        booted = Future()
+        with self.ready_lock:
+            self.boot_futures[host.get_hostname()] = booted
+        return booted
+
+    def _on_boot(self, host):
+        """Completes the boot Future of host. Runs on the loop thread."""
+        with self.ready_lock:
+            booted = self.boot_futures.pop(host.get_hostname(), None)
+        if booted is None:
+            print("ERROR: Unexpected boot notification from %s" %
+                  host.get_hostname())
+            return
+        booted.set_result(time.time())
 
-    def _wait_vm(self):
-        """Wait a vm to boot. Returns the vmname that was sent from host"""
-        client, addr = self.notifysocket.accept()
+    def _fail_boot(self, host, booted, error):
+        if booted.set_error(error):
+            with self.ready_lock:
+                if self.boot_futures.get(host.get_hostname()) is booted:
+                    del self.boot_futures[host.get_hostname()]
 
-        message = client.recv(128)
-        print message,
+    def _start_host(self, host, booted):
+        """Starts host. booted fails if the host cannot be started or its
+        Qemu exits before the boot notification."""
+        try:
+            host.start()
+        except Exception, e:
+            self._fail_boot(host, booted, e)
+            return
 
-        client.close()
+        def on_exit(exited):
+            self._fail_boot(host, booted, VmExitError(
+                '%s exited with code %s before booting' %
+                (host.get_hostname(), exited.result)))
+        host.vmhandler.get_exit_future().add_done_callback(on_exit)
 
-        msgparams = message.split(" ")
-        return msgparams[0]
+    def get_tracer(self):
+        """Returns the Tracer holding the timing spans of this lab"""
+        return default_tracer
 
     def start_all(self):
-        """Start All the VMs"""
-        for i in xrange(len(self.configs)):
-            self._start_vm_at(i)
-        for s in self.switches:
-            s.start()
-
-        booted = 0
-        while booted < len(self.configs):
-            vmname = self._wait_vm()
-            booted += 1
-
-            for vm in self.hosts:
-                if vm.get_hostname() == vmname:
-                    vm.configure_interfaces()
-
-        #add links to switches
-        for s in self.switches:
+        """Starts all the VMs and waits until they are booted and configured
+        """
+        errors = self.start_all_async().wait()
+        for name, error in errors:
+            print("ERROR: %s: %s" % (name, error))
+
+    def start_all_async(self):
+        """Starts all the VMs without waiting for them
+
+        Starting the VMs, handling their boot notifications and configuring
+        their interfaces overlap across hosts, using at most MAX_WORKERS
+        threads. The LaunchScheduler bounds how many VMs boot at once and
+        admits them against the available memory. A switch gets its links
+        added as soon as all of its peers are configured.
+
+        :return A Future set once every host is configured or has failed, to
+        the list of (host name, error) of the failed ones
+        :rtype Future
+        """
+        started = Future()
+        pool = WorkerPool(Vlab.MAX_WORKERS)
+        pool.submit(self._start_all, pool, started)
+        return started
+
+    def _start_all(self, pool, started):
+        try:
+            with get_backend().batch():
+                for s in self.switches:
+                    s.start()
+            with self.ready_lock:
+                self.ready_nodes = set()
+                self.linked_switches = set()
+            self._prepare_boot_image()
+        except Exception, e:
+            pool.shutdown(wait=False)
+            started.set_error(e)
+            return
+
+        self.running = True
+        if self.idle_monitor is not None:
+            self.idle_monitor.start()
+        if self.lifecycle['lazy_start']:
+            print('Lazy start: the VMs start on first use')
+            pool.shutdown(wait=False)
+            started.set_result([])
+            return
+        self._start_hosts(self.hosts, pool, started)
+
+    def _start_hosts(self, hosts, pool, started):
+        """Starts hosts through the launch scheduler and configures them as
+        they boot. Once all are configured or have failed, the shaping of
+        their links is applied and started is set to the list of (host name,
+        error) of the failed ones. pool is shut down then."""
+        remaining = [len(hosts)]
+        errors = []
+        names = set(host.get_topo_name() for host in hosts)
+
+        def finish(host, error):
+            with self.ready_lock:
+                remaining[0] -= 1
+                if error is not None:
+                    errors.append((host.get_hostname(), error))
+                last = remaining[0] == 0
+            if last:
+                pool.shutdown(wait=False)
+                try:
+                    self.shape_links([link for link in
+                                      self.topology.get_links()
+                                      if has_shaping(link.opts) and
+                                      names.intersection(
+                                          link.get_endpoints())])
+                except Exception, e:
+                    errors.append(('shaping', e))
+                started.set_result(errors)
+
+        if not hosts:
+            pool.shutdown(wait=False)
+            started.set_result(errors)
+            return
+
+        for host in hosts:
+            booted = self._expect_boot(host)
+            # Runs on the loop thread, which must not block
+            booted.add_done_callback(
+                lambda f, host=host: pool.submit(self._configure_booted,
+                                                 host, f, finish))
+            self.scheduler.submit(
+                host.get_hostname(), host.vmhandler.config.get_max_ram(),
+                booted,
+                lambda host=host, booted=booted: pool.submit(
+                    self._start_host, host, booted),
+                lambda e, host=host, booted=booted: self._fail_boot(
+                    host, booted, e))
+
+    def _configure_booted(self, host, booted, finish):
+        error = booted.error
+        if error is None:
+            try:
+                self._configure_host(host)
+            except Exception, e:
+                error = e
+        finish(host, error)
+
+    def get_boot_status(self):
+        """Returns how many hosts are still booting, waiting for the
+        scheduler to launch them, configured, and paused for being idle
+
+        :return A dict with the keys booting, queued, ready, paused and total
+        :rtype dict
+        """
+        queued = self.scheduler.get_queued()
+        paused = len([host for host in self.hosts
+                      if host.vmhandler.is_idle_paused()])
+        with self.ready_lock:
+            return {'booting': len(self.boot_futures) - queued,
+                    'queued': queued,
+                    'ready': len([name for name in self.ready_nodes
+                                  if name in self.topo_name_to_host]),
+                    'paused': paused,
+                    'total': len(self.hosts)}
+
+    def _get_neighbourhood(self, names):
+        """Returns the hosts among names, the hosts linked to them and the
+        hosts on the switches among or linked to them: all the hosts that
+        must run for the links of names to work
+
+        :param names: Topology names of hosts or switches
+        :type names: list(str)
+        :rtype list(Host)
+        """
+        switches = set(name for name in names if name in self.name_to_switch)
+        found = set(name for name in names if name in self.topo_name_to_host)
+        for name in list(found):
+            for link in self.topology.get_links(name):
+                peer = link.get_peer(name)
+                if peer in self.name_to_switch:
+                    switches.add(peer)
+                else:
+                    found.add(peer)
+        for switch in switches:
+            found.update(self.name_to_switch[switch].get_peers())
+        return [self.topo_name_to_host[name] for name in sorted(found)
+                if name in self.topo_name_to_host]
+
+    def ensure_started(self, names):
+        """Starts the hosts needed by names that are not running yet and waits
+        until they are configured. Concurrent calls share the starts.
+
+        :param names: Topology names of hosts or switches
+        :type names: list(str)
+        :return The (host name, error) of the hosts that failed to start
+        :rtype list(tuple)
+        """
+        batch = []
+        waits = []
+        with self.start_lock:
+            for host in self._get_neighbourhood(names):
+                name = host.get_hostname()
+                if name in self.starting:
+                    waits.append(self.starting[name])
+                elif not host.is_started():
+                    batch.append(host)
+            if batch:
+                started = Future()
+                for host in batch:
+                    self.starting[host.get_hostname()] = started
+                waits.append(started)
+
+        if batch:
+            print('Starting on demand: %s' %
+                  ' '.join(host.get_hostname() for host in batch))
+            start = time.time()
+
+            def done(f):
+                with self.start_lock:
+                    for host in batch:
+                        self.starting.pop(host.get_hostname(), None)
+                default_tracer.add_span('lab', 'start_on_demand', start,
+                                        time.time(), {'hosts': len(batch)})
+            started.add_done_callback(done)
+            self._start_hosts(batch, WorkerPool(Vlab.MAX_WORKERS), started)
+
+        errors = []
+        for f in set(waits):
+            errors += f.wait()
+        return errors
+
+    def _start_on_demand(self, host):
+        """Starts host and its peers on its first use, in lazy mode"""
+        if not self.running:
+            return
+        for name, error in self.ensure_started([host.get_topo_name()]):
+            print("ERROR: %s: %s" % (name, error))
+
+    def _configure_host(self, host):
+        """Configures the interfaces of a booted host, then adds the links of
+        every switch whose peers are all ready"""
+        host.configure_interfaces()
+
+        with self.ready_lock:
+            self.ready_nodes.add(host.get_topo_name())
+            switches = [s for s in self.switches
+                        if s.get_hostname() not in self.linked_switches and
+                        self._peers_ready(s)]
+            for s in switches:
+                self.linked_switches.add(s.get_hostname())
+
+        for s in switches:
             s.add_links()
 
-    def stop_all(self):
-        """Stop All the VMs"""
-        for i in xrange(len(self.configs)):
-            self.stop_vm_at(i)
-        for s in self.switches:
-            s.stop()
+    def _peers_ready(self, switch):
+        """Returns whether all hosts linked to switch are configured"""
+        for peer in switch.get_peers():
+            if peer in self.topo_name_to_host and peer not in self.ready_nodes:
+                return False
+        return True
+
+    def stop_all(self, timeout=VmHandler.SHUTDOWN_TIMEOUT):
+        """Stops all the VMs at once
+
+        Every guest is asked to power off through the monitor. Qemu is told
+        to quit for the VMs still running after VmHandler.POWERDOWN_GRACE
+        seconds, and the ones still running after timeout seconds are
+        killed. The bridge ports, taps and bridges are then all removed in a
+        single backend batch.
+
+        :param timeout: Seconds the VMs get to exit
+        :type timeout: float
+        :return A dict per started VM with the keys name, time (seconds from
+        the power off request to the exit of Qemu) and killed
+        :rtype list(dict)
+        """
+        self.telemetry.stop()
+        self.running = False
+        if self.idle_monitor is not None:
+            self.idle_monitor.stop()
+        hosts = [host for host in self.hosts if host.is_started()]
+        with default_tracer.span('lab', 'stop_all', hosts=len(hosts)):
+            if hosts:
+                deadline = time.time() + timeout
+                with default_tracer.span('lab', 'powerdown'):
+                    parallel_map(
+                        lambda host: host.vmhandler.request_powerdown(),
+                        hosts, Vlab.MAX_WORKERS)
+                # Single deadlines, so the waits do not add up
+                grace = time.time() + min(timeout, VmHandler.POWERDOWN_GRACE)
+                running = [host for host in hosts if not
+                           host.vmhandler.wait_exit(grace - time.time())]
+                if running:
+                    with default_tracer.span('lab', 'quit',
+                                             hosts=len(running)):
+                        for host in running:
+                            host.vmhandler.request_quit()
+                        running = [host for host in running if not
+                                   host.vmhandler.wait_exit(
+                                       deadline - time.time())]
+                if running:
+                    with default_tracer.span('lab', 'kill',
+                                             hosts=len(running)):
+                        for host in running:
+                            host.vmhandler.kill()
+                        deadline = time.time() + VmHandler.KILL_TIMEOUT
+                        for host in running:
+                            host.vmhandler.wait_exit(deadline - time.time())
+            self._teardown_network(hosts)
+
+        return [{'name': host.get_hostname(),
+                 'time': host.vmhandler.get_shutdown_time(),
+                 'killed': host.vmhandler.was_killed()} for host in hosts]
+
+    def _teardown_network(self, hosts):
+        """Releases the stopped hosts and removes their taps and ifb
+        devices, the links of the switches and the bridges with one backend
+        batch. A failed removal is reported without stopping the others."""
+        stopped = set(host.get_topo_name() for host in hosts)
+        taps = []
+        for host in hosts:
+            taps += host.vmhandler.release()
+        with self.ready_lock:
+            # The ports of a switch can only be released while all the taps
+            # it was linked to exist
+            linked = [s for s in self.switches
+                      if s.get_hostname() in self.linked_switches and
+                      all(peer in stopped or
+                          peer not in self.topo_name_to_host
+                          for peer in s.get_peers())]
+            self.linked_switches = set()
+            self.ready_nodes = set()
+
+        with default_tracer.span('lab', 'network_teardown', taps=len(taps)):
+            backend = get_backend()
+            # The backend sends a large batch in chunks, and still sends the
+            # rest of it when a request fails, so nothing is left behind
+            try:
+                with backend.batch():
+                    for s in linked:
+                        s.del_links()
+                    for tap, multi_queue in taps:
+                        backend.delete_tap(tap, multi_queue)
+                    self._remove_ifbs([tap for tap, _ in taps])
+                    for s in self.switches:
+                        if s.is_started():
+                            s.stop()
+            except (OSError, IOError, socket.error), e:
+                print("ERROR: Network teardown: %s" % e)
 
     def init_configs(self):
         """Read and init the configs"""
         self.vm_config_loader.read_config()
         self.vm_config_loader.create_vm_configs()
+        self.vm_config_loader.compile_plans()
         self.configs = self.vm_config_loader.get_configs()
         self.topo = self.vm_config_loader.get_topo_config()
+        self.topology = self.vm_config_loader.get_topology()
+        set_backend(self.vm_config_loader.get_net_backend_name())
+        self.scheduler = LaunchScheduler.from_config(
+            self.vm_config_loader.get_vm_config_data())
+        self.lifecycle = self.vm_config_loader.get_lifecycle()
+        if self.lifecycle['idle_pause'] > 0:
+            self.idle_monitor = IdleMonitor(
+                lambda: [host.vmhandler for host in self.hosts
+                         if host.is_started()],
+                self.lifecycle['idle_pause'])
+        pool = self.vm_config_loader.get_pool()
+        if pool['size'] > 0:
+            print('Keeping %d VMs booted in the pool' % pool['size'])
+            self.vm_pool = get_pool(
+                self.vm_config_loader.get_vm_config_data(), pool['size'],
+                pool['max_booting'], self.vm_config_loader.get_initrd())
+        if self.vm_config_loader.get_boot_mode() == 'snapshot':
+            self.snapshots = SnapshotManager(
+                self.vm_config_loader.get_vm_config_data(),
+                initrd=self.vm_config_loader.get_initrd())
         self._create_hosts()
         self._create_switches()
 
@@ -88,18 +461,227 @@ class Vlab(object):
         """Creates the Hosts for each VmHandler instance"""
         for config in self.configs:
             vmhandler = VmHandler(config)
+            vmhandler.set_pool(self.vm_pool)
+            vmhandler.set_affinity(*self.scheduler.get_affinity(
+                config.get_sched(), config.get_cores(), config.get_smp()))
             host = Host(vmhandler)
+            vmhandler.on_boot(lambda host=host: self._on_boot(host))
+            if self.lifecycle['lazy_start']:
+                host.set_starter(self._start_on_demand)
             self.hosts.append(host)
             self.name_to_host[host.get_hostname()] = host
+            self.topo_name_to_host[host.get_topo_name()] = host
 
     def _create_switches(self):
         for s in self.topo['switches']:
-            l = self.vm_config_loader.get_links()[s['opts']['hostname']]
-            switch = Switch(s, l)
+            switch = Switch(s, self.topology)
             self.switches.append(switch)
+            self.name_to_switch[switch.get_hostname()] = switch
+
+    def _get_topo_node(self, name):
+        """Returns the Host or Switch called name in the topology"""
+        host = self.topo_name_to_host.get(name)
+        if host is not None:
+            return host
+        return self.name_to_switch[name]
+
+    def add_link(self, src, dst, opts=None):
+        """Adds a link to the topology. If the lab is running, the link is set
+        up right away, touching only its two ends.
+
+        :param src: Topology name of one end
+        :type src: str
+        :param dst: Topology name of the other end
+        :type dst: str
+        :return The new link
+        :rtype Link
+        """
+        if self.lifecycle['lazy_start'] and self.running:
+            # Started before the link exists, which is then hot-plugged
+            for name, error in self.ensure_started([src, dst]):
+                print("ERROR: %s: %s" % (name, error))
+        link = self.topology.add_link(src, dst, opts)
+        ends = [self._get_topo_node(name) for name in link.get_endpoints()]
+        touched = []
+        try:
+            # Taps are created by the hosts, so they go first
+            for node in ends:
+                if isinstance(node, Host) and node.is_started():
+                    touched.append(node)
+                    node.add_link(link)
+            for node in ends:
+                if isinstance(node, Switch) and node.is_started():
+                    touched.append(node)
+                    node.attach_link(link)
+            if has_shaping(link.opts):
+                self.shape_links([link])
+        except Exception:
+            # Leaves neither the link nor half of it behind
+            self._unplug_link(link, touched)
+            self._remove_ifbs(self._get_link_tap_names(link))
+            self.topology.remove_link(link.link_id)
+            raise
+        return link
+
+    @staticmethod
+    def _unplug_link(link, nodes):
+        """Undoes the set up of link on nodes after a failed add_link. Errors
+        are only printed, so that the original one is raised."""
+        for node in reversed(nodes):
+            try:
+                if isinstance(node, Switch):
+                    node.detach_link(link)
+                else:
+                    node.vmhandler.unplug_link(link)
+            except Exception, e:
+                print("ERROR: %s: cannot undo %s: %s" %
+                      (node.get_hostname(), link, e))
 
-    def _start_vm_at(self, index):
-        self.hosts[index].start()
+    def del_link(self, src, dst):
+        """Removes the most recent link between src and dst, tearing it down
+        on its two ends if the lab is running
+
+        :return The removed link
+        :rtype Link
+        """
+        links = self.topology.find_links(src, dst)
+        if not links:
+            raise TopologyError('No link between %s and %s' % (src, dst))
+        link = links[-1]
+        ends = [self._get_topo_node(name) for name in link.get_endpoints()]
+        for node in ends:
+            if isinstance(node, Switch) and node.is_started():
+                node.detach_link(link)
+        for node in ends:
+            if isinstance(node, Host) and node.is_started():
+                node.remove_link(link)
+        self._remove_ifbs(self._get_link_tap_names(link))
+        return self.topology.remove_link(link.link_id)
+
+    def _get_link_tap_names(self, link):
+        """Returns the names of the host taps of link, existing or not"""
+        return [link.get_tap(name) for name in link.get_endpoints()
+                if name in self.topo_name_to_host]
+
+    def _get_link_taps(self, link):
+        """Returns the host taps of link that exist"""
+        taps = []
+        for name in link.get_endpoints():
+            host = self.topo_name_to_host.get(name)
+            if host is not None and host.vmhandler.has_test_interface(
+                    link.get_tap(name)):
+                taps.append(link.get_tap(name))
+        return taps
+
+    def shape_links(self, links, reset=False):
+        """Applies the shaping options of links to their existing taps, with
+        a single tc batch
+
+        :param reset: Whether the taps may be shaped already
+        :type reset: bool
+        :raises ShapingError: If an option is invalid or tc failed
+        """
+        changes = []
+        added = []
+        removed = []
+        with self.ready_lock:
+            for link in links:
+                # The taps at both ends of a host to host link shape one
+                # direction each, a single tap needs an ifb for the other
+                single = len(self._get_link_tap_names(link)) == 1
+                for tap in self._get_link_taps(link):
+                    ifb = get_ifb_name(tap) if single else None
+                    if ifb is not None and not has_shaping(link.opts):
+                        if ifb in self.ifbs:
+                            removed.append(tap)
+                        ifb = None
+                    elif ifb is not None and ifb not in self.ifbs:
+                        added.append(ifb)
+                    changes.append((tap, link.opts, ifb))
+
+        backend = get_backend()
+        with default_tracer.span('lab', 'shaping', links=len(changes)):
+            if added:
+                try:
+                    with backend.batch():
+                        for ifb in added:
+                            backend.add_ifb(ifb)
+                finally:
+                    # Also the ones that failed, so that they are removed
+                    with self.ready_lock:
+                        self.ifbs.update(added)
+            apply_shaping(backend, changes, reset)
+            # Once their taps no longer redirect to them
+            self._remove_ifbs(removed)
+
+    def _remove_ifbs(self, taps):
+        """Removes the ifb devices of taps, for those that have one. Errors
+        are printed."""
+        with self.ready_lock:
+            ifbs = [get_ifb_name(tap) for tap in taps
+                    if get_ifb_name(tap) in self.ifbs]
+            self.ifbs.difference_update(ifbs)
+        if not ifbs:
+            return
+        backend = get_backend()
+        try:
+            with backend.batch():
+                for ifb in ifbs:
+                    backend.del_ifb(ifb)
+        except (OSError, IOError, socket.error), e:
+            print("ERROR: Cannot remove ifb devices: %s" % e)
+
+    def shape(self, src, dst, opts, clear=False):
+        """Changes the shaping options of the links between src and dst, or
+        of every link if src is 'all', and applies them to the running lab
+
+        :param opts: Shaping options to set, e.g. {'delay': '50ms'}. A None
+        value removes an option.
+        :type opts: dict
+        :param clear: Whether to remove all shaping options first
+        :type clear: bool
+        :return The changed links
+        :rtype list(Link)
+        :raises ShapingError: If an option is invalid or tc failed
+        """
+        if src == 'all':
+            links = list(self.topology.get_links())
+        else:
+            links = self.topology.find_links(src, dst)
+            if not links:
+                raise TopologyError('No link between %s and %s' % (src, dst))
+
+        updated = []
+        for link in links:
+            link_opts = dict(link.opts)
+            if clear:
+                for name in SHAPING_OPTS:
+                    link_opts.pop(name, None)
+            for name, value in opts.iteritems():
+                if value is None:
+                    link_opts.pop(name, None)
+                else:
+                    link_opts[name] = value
+            # Fails on invalid options before any link is changed
+            get_qdisc_commands('-', link_opts)
+            updated.append(link_opts)
+        for link, link_opts in zip(links, updated):
+            link.opts = link_opts
+
+        self.shape_links(links, reset=True)
+        return links
+
+    def _prepare_boot_image(self):
+        """In snapshot boot mode, makes sure the template image exists and
+        tells the hosts that can be restored from it to do so. The others
+        are cold booted."""
+        if self.snapshots is None:
+            return
+        hosts = [host for host in self.hosts
+                 if self.snapshots.accepts(host.vmhandler.config)]
+        image = self.snapshots.get_image() if hosts else None
+        for host in self.hosts:
+            host.vmhandler.set_boot_image(image if host in hosts else None)
 
     def index_in_bounds(self, index):
         """Returns whether index is in bounds of hosts array"""
@@ -110,12 +692,15 @@ class Vlab(object):
         :param index: The index of the VM to be started
         :type index: int
         """
-        self._start_vm_at(index)
-        vmname = self._wait_vm()
         vm = self.hosts[index]
-        if not vmname == vm.get_hostname():
-            print("ERROR: Got %s, but expected %s" %
-                  (vmname, self.hosts[index].get_hostname()))
+        booted = self._expect_boot(vm)
+        self._prepare_boot_image()
+        self._start_host(vm, booted)
+        try:
+            booted.wait()
+        except VmExitError, e:
+            print("ERROR: %s" % e)
+            return
         vm.configure_interfaces()
 
     def stop_vm_at(self, index):
@@ -123,7 +708,10 @@ class Vlab(object):
         :param index: The index of the VM to be started
         :type index: int
         """
-        self.hosts[index].stop()
+        host = self.hosts[index]
+        taps = host.get_taps()
+        host.stop()
+        self._remove_ifbs(taps)
 
     def _run_xterm(self, hostname):
         host = self.get_host_by_name(hostname)
@@ -140,6 +728,181 @@ class Vlab(object):
         else:
             self._run_xterm(hostname)
 
+    def get_scheduler_stats(self):
+        """Returns the counters of the launch scheduler"""
+        return self.scheduler.get_stats()
+
+    def get_telemetry_targets(self):
+        """Returns the running hosts and switches as targets of the
+        telemetry sampler: (name, kind, pid, interfaces) tuples"""
+        targets = [(host.get_hostname(), 'vm', host.get_pid(),
+                    host.get_taps())
+                   for host in self.hosts if host.is_started()]
+        targets += [(s.get_hostname(), 'switch', None, [s.get_hostname()])
+                    for s in self.switches if s.is_started()]
+        return targets
+
+    def get_telemetry(self):
+        """Returns the telemetry sampler of the lab, which samples the VMs and
+        switches once started
+
+        :rtype TelemetrySampler
+        """
+        return self.telemetry
+
+    def get_pool_stats(self):
+        """Returns the counters of the pool of pre-booted VMs, or None if the
+        lab has no pool"""
+        if self.vm_pool is None:
+            return None
+        return self.vm_pool.get_stats()
+
+    def get_ssh_stats(self):
+        """Returns the hit/miss counters of the SSH connection pool"""
+        return default_pool.get_stats()
+
+    def select_hosts(self, selector):
+        """Returns the hosts matched by selector
+
+        :param selector: 'all', or a comma separated list of host names or
+        shell-style patterns, e.g. 'h1,h3' or 'h*'. Both VM names and topology
+        names are matched.
+        :type selector: str
+        :return The matching hosts, in start order
+        :rtype list(Host)
+        """
+        if selector == 'all':
+            return list(self.hosts)
+        patterns = selector.split(',')
+        return [host for host in self.hosts
+                if any(fnmatchcase(host.get_hostname(), p) or
+                       fnmatchcase(host.get_topo_name(), p)
+                       for p in patterns)]
+
+    def substitute_names(self, line):
+        """Replaces the node names in line with their management ip"""
+        names = self.get_vm_names()
+        return ' '.join(self.get_host_by_name(arg).get_mgmt_ip()
+                        if arg in names else arg
+                        for arg in line.split(' '))
+
+    def exec_on(self, hosts, line):
+        """Runs line on all the given hosts concurrently, using at most
+        FANOUT_WORKERS threads
+
+        :param hosts: The hosts on which line is run
+        :type hosts: list(Host)
+        :return One dict per host, in the order of hosts, with the keys name,
+        out, err, status, duration and error
+        :rtype list(dict)
+        """
+        def run_on(host):
+            start = time.time()
+            result = {'name': host.get_hostname(), 'out': [], 'err': [],
+                      'status': None, 'error': None}
+            try:
+                result['out'], result['err'], result['status'] = \
+                    host.exec_cmd_status(line)
+            except Exception, e:
+                result['error'] = e
+            result['duration'] = time.time() - start
+            return result
+
+        if not hosts:
+            return []
+        return [task.result for task in
+                parallel_map(run_on, hosts, Vlab.FANOUT_WORKERS)]
+
+    def get_node(self, name):
+        """Returns the Host called name, by VM or topology name
+
+        :raises KeyError: If there is no such host
+        """
+        host = self.name_to_host.get(name) or self.topo_name_to_host.get(name)
+        if host is None:
+            raise KeyError(name)
+        return host
+
+    def get_test_ip(self, host, peer):
+        """Returns the test address on which peer reaches host: the one of
+        the link of host on a segment that peer is also on, if any
+
+        :type host: Host
+        :type peer: Host
+        :rtype str
+        :raises MeasureError: If host has no test address
+        """
+        name = host.get_topo_name()
+        peer_segments = set(self.topology.get_segment(link) for link in
+                            self.topology.get_links(peer.get_topo_name()))
+        links = [link for link in self.topology.get_links(name)
+                 if link.get_address(name)]
+        if not links:
+            raise MeasureError('%s has no test address' % name)
+        shared = [link for link in links
+                  if self.topology.get_segment(link) in peer_segments]
+        return (shared or links)[0].get_address(name).split('/')[0]
+
+    def measure(self, pairs, duration=5, count=20):
+        """Measures throughput, RTT and loss between pairs of hosts. Pairs
+        sharing a host are measured one after the other, so that the result
+        of a pair is not the one of several measurements competing for the
+        same links. Pairs without a common host run at once, on at most
+        FANOUT_WORKERS threads.
+
+        :param pairs: (source, destination) host names, VM or topology ones
+        :type pairs: list(tuple)
+        :param duration: Seconds of iperf traffic per pair, 0 to only ping
+        :type duration: int
+        :param count: Number of pings per pair
+        :type count: int
+        :return One result dict per pair, in order, see PairMeasurement.run
+        :rtype list(dict)
+        :raises KeyError: If a host does not exist
+        """
+        measurements = []
+        for i, (src, dst) in enumerate(pairs):
+            src, dst = self.get_node(src), self.get_node(dst)
+            measurements.append(PairMeasurement(
+                src, dst, self.get_test_ip(dst, src),
+                PairMeasurement.BASE_PORT + i, duration, count))
+        results = {}
+        for batch in Vlab._get_disjoint_batches(measurements):
+            tasks = parallel_map(lambda m: m.run(), batch,
+                                 Vlab.FANOUT_WORKERS)
+            for m, task in zip(batch, tasks):
+                results[m] = task.result
+        return [results[m] for m in measurements]
+
+    @staticmethod
+    def _get_disjoint_batches(measurements):
+        """Splits measurements into batches in which no host is in two
+        measurements, putting each into the first batch it fits in
+
+        :rtype list(list(PairMeasurement))
+        """
+        batches = []
+        for m in measurements:
+            ends = set([m.src, m.dst])
+            for batch, hosts in batches:
+                if not ends & hosts:
+                    break
+            else:
+                batch, hosts = [], set()
+                batches.append((batch, hosts))
+            batch.append(m)
+            hosts.update(ends)
+        return [batch for batch, _ in batches]
+
+    def get_switch_pairs(self, switch):
+        """Returns every pair of hosts linked to switch, by topology name
+
+        :rtype list(tuple)
+        """
+        hosts = [peer for peer in self.name_to_switch[switch].get_peers()
+                 if peer in self.topo_name_to_host]
+        return [(a, b) for i, a in enumerate(hosts) for b in hosts[i + 1:]]
+
     def get_vm_names(self):
         """Returns a list of all VM names"""
         return [host.get_hostname() for host in self.hosts]
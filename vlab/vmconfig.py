@@ -7,25 +7,48 @@ file
 """
 
 import json
-import subprocess
 import os
 import shlex
 import random
 import binascii
+import hashlib
+from collections import namedtuple
+
+from addressing import ManagementAllocator, SegmentAllocator
+from topology import Topology
+from initramfs import InitramfsBuilder
+
+
+# Everything needed to launch a VM, except its management interface which
+# depends on the TAP created on each start. argv and mgmt_netdev are tuples.
+LaunchPlan = namedtuple('LaunchPlan',
+                        ['vm_name', 'argv', 'home_dir', 'mgmt_netdev'])
+
+# Data path options, from the 'datapath' section of the vm config, overridden
+# by the options of a host and then of a link in topo.json
+DATAPATH_OPTS = ('vhost', 'queues', 'offloads')
+
 
 class VmConfig(object):
     """Holds data necessary to start a VM"""
 
-    def __init__(self, config_data, host_config, vm_index):
+    def __init__(self, config_data, host_config, vm_index, mgmt_subnet,
+                 vm_name=None):
         """Creates VmConfig object.
 
         :param config_data: Dict containing the info from the vm config file
         :type config_data: dict
         :param vm_index: Index of this VmConfig object
         :type vm_index: int
+        :param mgmt_subnet: The management subnet of this VM
+        :type mgmt_subnet: MgmtSubnet
+        :param vm_name: The name of the VM, base_name followed by vm_index
+        if not given
+        :type vm_name: str
         """
         self.vm_index = vm_index
-        self.vm_name = config_data['base_name'] + str(self.vm_index)
+        self.vm_name = vm_name or (config_data['base_name'] +
+                                   str(self.vm_index))
         self.qemu_binary = config_data['qemu_binary']
         self.misc_params = config_data['misc_params']
         self.max_ram = config_data['max_ram']
@@ -34,8 +57,16 @@ class VmConfig(object):
         self.kernel_init_params = dict(
             config_data['kernel_image']['init_params'])
         self.properties = list(config_data['properties'])
+        self.rootfs_backend = config_data.get('rootfs', {}).get('backend',
+                                                                '9p')
+        self.datapath = dict(config_data.get('datapath', {}))
+        self.initrd = None
         self.host = host_config
+        self.mgmt_subnet = mgmt_subnet
+        self.mgmt_mac = self._get_random_mac()
         self.home_dir = ""
+        self.plan = None
+        self.runtime_dir = None
 
     def get_commandline(self, mgmt_tap_name):
         """Gets the command line needed for starting up the VM
@@ -45,13 +76,55 @@ class VmConfig(object):
         :return: the command line required to run Qemu as list of strings
         :rtype: list(str)
         """
-        directory = '/tmp/' + self.vm_name
+        plan = self.get_plan()
+        directory = self.get_runtime_dir()
         if not os.path.exists(directory):
             os.makedirs(directory)
-        return ([self.qemu_binary, '-m', str(self.max_ram)] +
+        return list(plan.argv) + self._get_mgmt_intf_line(mgmt_tap_name)
+
+    def get_restore_commandline(self, mgmt_tap_name, image_path):
+        """Gets the command line restoring the VM from a template image
+
+        :param mgmt_tap_name: The name of the TAP interface created on host
+        :type mgmt_tap_name: str
+        :param image_path: The image saved from the template VM
+        :type image_path: str
+        :rtype: list(str)
+        """
+        return (self.get_commandline(mgmt_tap_name) +
+                ['-incoming', 'exec:cat ' + image_path])
+
+    def compile_plan(self):
+        """Builds the launch plan of this VM from its config
+
+        :rtype LaunchPlan
+        """
+        argv = ([self.qemu_binary, '-m', str(self.max_ram),
+                 '-smp', str(self.get_smp())] +
                 self._get_misc_params() +
                 self._get_chardev_lines() + self._get_fsdev_lines() +
-                self._get_kernel_line() + self._get_mgmt_intf_line(mgmt_tap_name))
+                self._get_kernel_line())
+        mgmt_prop = self._get_mgmt_prop()
+        return LaunchPlan(self.vm_name, tuple(argv), self.home_dir,
+                          (mgmt_prop['type'], mgmt_prop['id'],
+                           mgmt_prop['device_type']))
+
+    def get_plan(self):
+        """Returns the launch plan of this VM, compiling it on first use
+
+        :rtype LaunchPlan
+        """
+        if self.plan is None:
+            self.set_plan(self.compile_plan())
+        return self.plan
+
+    def set_plan(self, plan):
+        """Uses a previously compiled launch plan for this VM
+
+        :type plan: LaunchPlan
+        """
+        self.plan = plan
+        self.home_dir = plan.home_dir
 
     def get_vm_index(self):
         """Returns the index of this VM"""
@@ -61,6 +134,109 @@ class VmConfig(object):
         """Returns the name of this VM"""
         return self.vm_name
 
+    def get_mgmt_subnet(self):
+        """Returns the management subnet of this VM
+
+        :rtype MgmtSubnet
+        """
+        return self.mgmt_subnet
+
+    def get_topo_name(self):
+        """Returns the name of this VM in the topology config"""
+        return self.host['options']['hostname']
+
+    def get_max_ram(self):
+        """Returns the memory of the VM, as given to Qemu with -m"""
+        return self.max_ram
+
+    def get_sched(self):
+        """Returns the sched option of this VM's host: 'host', 'cfs' or
+        'rt'"""
+        return self.host['options'].get('sched', 'host')
+
+    def get_cores(self):
+        """Returns the cores option of this VM's host, e.g. '1,2', if any"""
+        return self.host['options'].get('cores')
+
+    def get_smp(self):
+        """Returns the number of vCPUs of the VM, from the smp option of its
+        host or else of the datapath section of the vm config"""
+        smp = int(self.host['options'].get('smp',
+                                           self.datapath.get('smp', 1)))
+        if smp < 1:
+            raise ValueError('%s: smp must be at least 1' % self.vm_name)
+        return smp
+
+    def get_datapath(self, link=None):
+        """Returns the data path options of the management interface, or of
+        the interface of link
+
+        :return A dict with vhost (bool), queues (int, 1 for a single queue
+        tap) and offloads (virtio-net-pci property to bool)
+        :rtype dict
+        """
+        opts = {'vhost': False, 'queues': 1, 'offloads': {}}
+        sources = [self.datapath, self.host['options']]
+        if link is not None:
+            sources.append(link.opts)
+        for source in sources:
+            for name in DATAPATH_OPTS:
+                if name == 'offloads':
+                    opts['offloads'].update(source.get('offloads', {}))
+                elif source.get(name) not in (None, ''):
+                    opts[name] = source[name]
+
+        # 'auto' is one queue pair per vCPU
+        if opts['queues'] == 'auto':
+            opts['queues'] = self.get_smp()
+        opts['queues'] = int(opts['queues'])
+        if opts['queues'] < 1:
+            raise ValueError('%s: queues must be at least 1' % self.vm_name)
+        opts['vhost'] = opts['vhost'] in (True, 'on', 'true', 1)
+        opts['offloads'] = dict(
+            (name, value in (True, 'on', 'true', 1))
+            for name, value in opts['offloads'].iteritems())
+        if link is None:
+            # The management interface does not need the queues
+            opts['queues'] = 1
+        return opts
+
+    @staticmethod
+    def _get_datapath_params(datapath):
+        """Returns the netdev and device parameters of data path options
+
+        :return A tuple of the two parameter strings, starting with ','
+        :rtype tuple
+        """
+        netdev = ''
+        device = ''
+        if datapath['vhost']:
+            netdev += ',vhost=on'
+        if datapath['queues'] > 1:
+            # A vector per queue for rx and tx, plus config and control
+            netdev += ',queues=%d' % datapath['queues']
+            device += ',mq=on,vectors=%d' % (2 * datapath['queues'] + 2)
+        for name in sorted(datapath['offloads']):
+            device += ',%s=%s' % (name, 'on' if datapath['offloads'][name]
+                                  else 'off')
+        return netdev, device
+
+    def get_links(self):
+        """Returns the current links of this VM
+
+        :rtype list(Link)
+        """
+        return self.host['topology'].get_links(self.get_topo_name())
+
+    def uses_initramfs(self):
+        """Returns whether the root filesystem is an initramfs instead of the
+        host root exported over 9p"""
+        return self.rootfs_backend == 'initramfs'
+
+    def set_initrd(self, path):
+        """Sets the initramfs image loaded with -initrd"""
+        self.initrd = path
+
     def get_home_dir(self):
         """Returns the path of this VM home directory"""
         return self.home_dir
@@ -69,6 +245,36 @@ class VmConfig(object):
         """Returns the path of this VM's private SSH key"""
         return self.get_home_dir() + '/root/.ssh/id_rsa'
 
+    def get_mgmt_mac(self):
+        """Returns the MAC address of the management interface"""
+        return self.mgmt_mac
+
+    def get_runtime_dir(self):
+        """Returns the directory of the sockets of the running Qemu"""
+        return self.runtime_dir or '/tmp/' + self.vm_name
+
+    def set_runtime_dir(self, path):
+        """Makes the socket paths point to the directory of another Qemu, e.g.
+        of the pooled VM this VM took over. None goes back to the VM's own.
+        """
+        self.runtime_dir = path
+
+    def get_mgmt_socket_path(self):
+        """Returns the path of this VM's mgmt console socket"""
+        return self.get_runtime_dir() + '/vm-mgmt-console.socket'
+
+    def get_qmp_socket_path(self):
+        """Returns the path of this VM's QMP monitor socket"""
+        return self.get_runtime_dir() + '/vm-qmp.socket'
+
+    def get_agent_socket_path(self):
+        """Returns the path of this VM's guest agent socket, or None if the
+        vm config has no agent port"""
+        if not any(prop['dev'] == 'chardev' and prop['id'] == 'agent'
+                   for prop in self.properties):
+            return None
+        return self.get_runtime_dir() + '/vm-agent.socket'
+
     def _get_misc_params(self):
         return shlex.split(self.misc_params)
 
@@ -79,6 +285,9 @@ class VmConfig(object):
             if prop['dev'] != 'fsdev':
                 continue
 
+            if prop['id'] == 'fsdev-root' and self.uses_initramfs():
+                continue
+
             path = prop['path']
             if prop['id'] == 'fsdev-home':
                 if not os.path.exists(path):
@@ -106,14 +315,21 @@ class VmConfig(object):
             if prop['dev'] != 'chardev':
                 continue
 
+            if prop['type'] == 'virtserialport':
+                chardev_lines += self._get_virtserialport_lines(prop)
+                continue
+
             chardev_props = 'chardev'
             path = '/tmp/' + self.vm_name
             if prop['id'] == 'mgmt':
                 chardev_props += ':mgmt'
-                path += '/vm-mgmt-console.socket'
+                path = self.get_mgmt_socket_path()
             elif prop['id'] == 'monitor':
                 chardev_props += '=monitor,mode=readline,default'
                 path += '/vm-monitor-console.socket'
+            elif prop['id'] == 'qmp':
+                chardev_props += '=qmp,mode=control'
+                path = self.get_qmp_socket_path()
 
             chardev_lines += ['-chardev',
                               ('socket,id=' + prop['id'] + ',path=' + path +
@@ -122,8 +338,35 @@ class VmConfig(object):
                               chardev_props]
         return chardev_lines
 
+    def _get_virtserialport_lines(self, prop):
+        """Returns the lines of a virtio-serial port, named in the guest after
+        the 'name' of prop"""
+        path = '/tmp/' + self.vm_name + '/vm-' + prop['id'] + '.socket'
+        if prop['id'] == 'agent':
+            path = self.get_agent_socket_path()
+        return ['-chardev',
+                'socket,id=' + prop['id'] + ',path=' + path + ',server,nowait',
+                '-device',
+                'virtio-serial-pci,id=serial-' + prop['id'],
+                '-device',
+                ('virtserialport,bus=serial-' + prop['id'] + '.0,chardev=' +
+                 prop['id'] + ',name=' + prop['name'])]
+
     def _get_kernel_line(self):
         """Returns the kernel parameters line"""
+        if self.uses_initramfs():
+            return ['-kernel',
+                    self.kernel_dir + '/' + self.kernel_image_name,
+                    '-initrd', self.initrd,
+                    '-append',
+                    ('rdinit=/init' +
+                     ' console=tty0' +
+                     ' console=' + self.kernel_init_params['console'] +
+                     ' uts=' + self.vm_name +
+                     ' vlab_rootfs=initramfs' +
+                     self._get_mgmt_params() +
+                     ' ' + self._get_init_script_args())]
+
         return ['-kernel',
                 self.kernel_dir + '/' + self.kernel_image_name,
                 '-append',
@@ -136,8 +379,19 @@ class VmConfig(object):
                  self._get_root_flags() +
                  ' ' + self.kernel_init_params['mode'] +
                  ' rootfstype=' + self.kernel_init_params['rootfstype'] +
+                 self._get_mgmt_params() +
                  ' ' + self._get_init_script_args())]
 
+    def _get_mgmt_params(self):
+        """Returns the kernel parameters telling the init script how to set up
+        the management interface. A VM without management subnet is a
+        template, which waits for its identity after booting."""
+        subnet = self.mgmt_subnet
+        if subnet is None:
+            return ' vlab_template=1'
+        return (' vlab_mgmt=%s/%d vlab_mgmt_host=%s' %
+                (subnet.guest_ip, subnet.prefixlen, subnet.host_ip))
+
     def _get_root_flags(self):
         """Returns the rootflags sent to kernel init"""
         rootflags = ' rootflags='
@@ -154,33 +408,41 @@ class VmConfig(object):
         """Returns the line corresponding with the management netdev
         interface"""
         # TODO: Use a MAC address from the config, if it is available
-        mgmt_prop = next(
-            (prop for prop in self.properties if prop['dev'] == 'netdev'),
-            None)
+        netdev_type, netdev_id, device_type = self.get_plan().mgmt_netdev
+        netdev_params, device_params = self._get_datapath_params(
+            self.get_datapath())
         return ['-netdev',
-                ('type=' + mgmt_prop['type'] + ',id=' +
-                 mgmt_prop['id'] + ',ifname=' + mgmt_tap_name),
+                ('type=' + netdev_type + ',id=' +
+                 netdev_id + ',ifname=' + mgmt_tap_name + netdev_params),
                 '-device',
-                mgmt_prop['device_type'] + ',netdev=' + mgmt_prop['id'] +
-                ",mac=" + self._get_random_mac()]
+                device_type + ',netdev=' + netdev_id +
+                ",mac=" + self.mgmt_mac + device_params]
+
+    def _get_mgmt_prop(self):
+        """Returns the property describing the management netdev"""
+        return next(
+            (prop for prop in self.properties if prop['dev'] == 'netdev'),
+            None)
 
-    def get_network_interface(self, tap_name):
+    def get_network_interface(self, link):
+        """Returns the monitor commands hot-plugging the interface of this VM
+        on link"""
         net = next(
             (prop for prop in self.properties if prop['id'] == 'net'),
             None)
-        # TODO: Use a MAC address from the config, if it is available
-        netdev = net['id'] + tap_name
+        name = self.get_topo_name()
+        netdev = link.get_netdev_id(name)
+        netdev_params, device_params = self._get_datapath_params(
+            self.get_datapath(link))
         return ["netdev_add " + net['type'] + ",id=" + netdev +
-                ",ifname=" + tap_name,
+                ",ifname=" + link.get_tap(name) + netdev_params,
                 "device_add " + net['device_type'] + ",netdev=" + netdev +
-                ",mac=" + self._get_random_mac()]
+                ",id=" + link.get_device_id(name) +
+                ",mac=" + link.get_mac(name) + device_params]
 
     @staticmethod
     def _get_full_path(file_name):
-        p = subprocess.Popen(['readlink', '-f', file_name], stdout=subprocess
-                             .PIPE)
-        output, err = p.communicate()
-        return output[0:-1]
+        return os.path.realpath(file_name)
 
     @staticmethod
     def _get_random_mac():
@@ -190,6 +452,11 @@ class VmConfig(object):
 
 class VmConfigLoader(object):
     """Loads config from file and stores it in a dict to be used in VmHandler"""
+    PLAN_CACHE_DIR = os.path.expanduser('~/.cache/vlab')
+    # Plan files kept in the cache, the most recently used ones
+    PLAN_CACHE_SIZE = 16
+    # Bump when the layout of LaunchPlan or of the generated argv changes
+    PLAN_VERSION = 4
 
     def __init__(self, vm_file='../configs/vm.json',
                  topo_file='../configs/topo.json'):
@@ -207,13 +474,15 @@ class VmConfigLoader(object):
         self.topo_config_data = {}
         self.host_names = []
         self.switch_names = []
-        self.links = {}
+        self.topology = None
+        self.initrd = None
+        self.mgmt_allocator = None
+        self.test_allocator = None
 
     def read_config(self):
         """Reads the config files and stores them accordingly"""
         with open(self.vm_file, 'r') as f:
             self.vm_config_data = json.load(f)
-            print self.vm_config_data
 
         with open(self.topo_file, 'r') as f:
             self.topo_config_data = json.load(f)
@@ -227,21 +496,17 @@ class VmConfigLoader(object):
     def create_vm_configs(self):
         """Generates the VmConfigs"""
 
-        links = {}
+        self._create_allocators()
+        topology = Topology(self.test_allocator)
+        for host in self.topo_config_data['hosts']:
+            topology.add_node(host['opts']['hostname'], Topology.HOST,
+                              host['opts'])
+        for switch in self.topo_config_data['switches']:
+            topology.add_node(switch['opts']['hostname'], Topology.SWITCH,
+                              switch['opts'])
         for link in self.topo_config_data['links']:
-            src = link['src']
-            dst = link['dest']
-            if not src in links:
-                links[src] = [link]
-            else:
-                links[src].append(link)
-
-            if not dst in links:
-                links[dst] = [link]
-            else:
-                links[dst].append(link)
-
-        self.links = links
+            topology.add_link(link['src'], link['dest'], link.get('opts'))
+        self.topology = topology
 
         sorted_hosts = sorted(self.topo_config_data['hosts'], key=lambda k: int(k['number']))
 
@@ -249,15 +514,120 @@ class VmConfigLoader(object):
             host_data = sorted_hosts[i]
             hostname = host_data['opts']['hostname']
             host_config = {'options': host_data['opts'],
-                           'links': links[hostname]}
+                           'topology': topology}
 
-            print(host_config)
+            print('%s: %s' % (hostname, topology.get_links(hostname)))
 
-            # TODO: Fix kernel bug that makes intf with ip 10.0.0.2 to be sent on lo
-            # instead of eth0 (inside vm)
-            config = VmConfig(self.vm_config_data, host_config, i + 1)
+            vm_name = self.vm_config_data['base_name'] + str(i + 1)
+            mgmt_subnet = self.mgmt_allocator.allocate(vm_name, i)
+            config = VmConfig(self.vm_config_data, host_config, i + 1,
+                              mgmt_subnet)
             self.vm_configs.append(config)
 
+    def _create_allocators(self):
+        """Creates the address allocators as set in the vm config"""
+        addressing = self.vm_config_data.get('addressing', {})
+        self.mgmt_allocator = ManagementAllocator(
+            addressing.get('mgmt_pool', '172.16.0.0/12'),
+            int(addressing.get('mgmt_prefixlen', 30)))
+        self.test_allocator = SegmentAllocator(
+            addressing.get('test_pool', '10.0.0.0/8'),
+            int(addressing.get('test_prefixlen', 24)))
+
+    def _prepare_rootfs(self):
+        """Builds the initramfs if the vm config asks for it and hands it to
+        every VmConfig"""
+        rootfs = self.vm_config_data.get('rootfs', {})
+        if rootfs.get('backend', '9p') != 'initramfs':
+            return
+        home = next(prop['path'] for prop in self.vm_config_data['properties']
+                    if prop['id'] == 'fsdev-home')
+        builder = InitramfsBuilder(
+            rootfs, os.path.join(home, 'etc'),
+            self.vm_config_data['kernel_image']['init_params']['init'])
+        self.initrd = builder.get_image()
+        for config in self.vm_configs:
+            config.set_initrd(self.initrd)
+
+    def _get_plans_key(self):
+        """Returns the hash identifying the plans of the current configs. The
+        working directory is part of it because relative paths in the configs
+        are resolved against it."""
+        h = hashlib.sha1(str(VmConfigLoader.PLAN_VERSION))
+        h.update(os.getcwd())
+        h.update(str(self.initrd))
+        for path in (self.vm_file, self.topo_file):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    def compile_plans(self, cache_dir=PLAN_CACHE_DIR):
+        """Sets the launch plan of every VmConfig, loading them from the cache
+        if the configs did not change since they were compiled. Note:
+        create_vm_configs must be called first."""
+        self._prepare_rootfs()
+        path = os.path.join(cache_dir,
+                            'plans-' + self._get_plans_key() + '.json')
+        plans = VmConfigLoader._load_plans(path)
+        if plans is not None and all(config.get_vm_name() in plans
+                                     for config in self.vm_configs):
+            # The configs did not change, but the home folder may be gone
+            for plan in plans.itervalues():
+                if plan.home_dir and not os.path.exists(plan.home_dir):
+                    raise IOError('Vmrootfs folder does not exist: %s' %
+                                  plan.home_dir)
+            for config in self.vm_configs:
+                config.set_plan(plans[config.get_vm_name()])
+            # Marks the file as recently used
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            return
+
+        plans = [config.get_plan() for config in self.vm_configs]
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict((plan.vm_name, plan._asdict()) for plan in plans),
+                      f)
+        os.rename(tmp_path, path)
+        VmConfigLoader._prune_plans(cache_dir)
+
+    @staticmethod
+    def _load_plans(path):
+        """Returns the plans of a cache file by VM name, or None if the file
+        is missing, unreadable or corrupt"""
+        try:
+            with open(path, 'r') as f:
+                cached = json.load(f)
+            return dict((name, LaunchPlan(name, tuple(p['argv']),
+                                          p['home_dir'],
+                                          tuple(p['mgmt_netdev'])))
+                        for name, p in cached.iteritems())
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    @staticmethod
+    def _prune_plans(cache_dir):
+        """Removes the plan files of the cache beyond the PLAN_CACHE_SIZE
+        most recently used ones"""
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.startswith('plans-') and name.endswith('.json'):
+                path = os.path.join(cache_dir, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        entries.sort(reverse=True)
+        for _, path in entries[VmConfigLoader.PLAN_CACHE_SIZE:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
     def get_configs(self):
         """Gets the list of the VmConfigs. Note: create_vm_configs must be
         :return A list of VmConfigs
@@ -265,6 +635,43 @@ class VmConfigLoader(object):
         """
         return self.vm_configs
 
+    def get_boot_mode(self):
+        """Returns how VMs are booted: 'cold' or 'snapshot'"""
+        return self.vm_config_data.get('boot_mode', 'cold')
+
+    def get_vm_config_data(self):
+        return self.vm_config_data
+
+    def get_lifecycle(self):
+        """Returns the lifecycle options of the vm config
+
+        :return A dict with the keys lazy_start (bool) and idle_pause
+        (seconds, 0 to never pause)
+        :rtype dict
+        """
+        opts = self.vm_config_data.get('lifecycle', {})
+        return {'lazy_start': bool(opts.get('lazy_start', False)),
+                'idle_pause': float(opts.get('idle_pause', 0))}
+
+    def get_pool(self):
+        """Returns the options of the pool of pre-booted VMs
+
+        :return A dict with the keys size (VMs kept ready, 0 for no pool)
+        and max_booting (VMs of the pool booting at once)
+        :rtype dict
+        """
+        opts = self.vm_config_data.get('pool', {})
+        return {'size': int(opts.get('size', 0)),
+                'max_booting': int(opts.get('max_booting', 2))}
+
+    def get_initrd(self):
+        """Returns the initramfs image, or None for a 9p root"""
+        return self.initrd
+
+    def get_net_backend_name(self):
+        """Returns the host network backend requested in the vm config"""
+        return self.vm_config_data.get('net_backend', 'auto')
+
     def get_topo_config(self):
         return self.topo_config_data
 
@@ -274,5 +681,11 @@ class VmConfigLoader(object):
     def get_host_names(self):
         return self.host_names
 
-    def get_links(self):
-        return self.links
+    def get_topology(self):
+        return self.topology
+
+    def get_mgmt_allocator(self):
+        return self.mgmt_allocator
+
+    def get_test_allocator(self):
+        return self.test_allocator
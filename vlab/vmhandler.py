@@ -6,71 +6,536 @@ import subprocess
 from subprocess import Popen
 import shlex
 import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from util import run
 
 from vmconfig import VmConfig
-from util import ssh_setup
+from sshpool import default_pool, CommandStream
+from qmp import QmpClient, QmpError
+from netbackend import get_backend
+from snapshot import SnapshotManager
+from console import MgmtConsole
+from agent import GuestAgent, AgentError
+from eventloop import default_loop
+from tracing import default_tracer
 
 
 class VmHandler(object):
     """A VmHandler provides primitives for handling a Qemu VM."""
+    # Bounds the output buffered for a streamed command that is not read
+    STREAM_WINDOW_SIZE = 256 * 1024
+    DEVICE_DEL_TIMEOUT = 5
+    # Seconds a guest gets to power off before Qemu is killed
+    SHUTDOWN_TIMEOUT = 10
+    # Seconds the guest gets to act on the power button before Qemu is told
+    # to quit. vm_init.sh does not handle the power button, so it only
+    # matters for guests whose init does.
+    POWERDOWN_GRACE = 1
+    KILL_TIMEOUT = 5
+    RESTORE_TIMEOUT = 30
+    RESTORE_POLL_INTERVAL = 0.05
+    # Written by vm_init.sh on the mgmt console once sshd is up
+    BOOT_MARKER = 'vlab-booted'
 
-    def __init__(self, config):
+    def __init__(self, config, ssh_pool=None):
         """Create VMHandler object
 
         :param config: VmConfig object corresponding to this VM
         :type config: VmConfig
+        :param ssh_pool: The pool of SSH connections used for send_cmd
+        :type ssh_pool: SshPool
         """
         self.config = config
+        self.ssh_pool = ssh_pool if ssh_pool is not None else default_pool
 
         self.tap = ''
         self.started = False
         self.vm_process = None
+        self.exited = None
+        self.spawn_time = None
+        self.stop_time = None
+        self.exit_time = None
+        self.killed = False
+        self.boot_image = None
+        self.vm_pool = None
+        self.pooled = False
+        self.cores = []
+        self.pin_vcpus = False
+        self.qmp = None
+        self.console = None
+        self.agent = None
+        self.boot_handlers = []
+        self.run_state = 'stopped'
         self.mgmt_ip = self._generate_mgmt_ip()
         self.test_interfaces = {}
+        self.pending_deletes = {}
         self.xterm_processes = []
+        # Guards the idle pause against concurrent uses of the VM
+        self.use_lock = threading.Lock()
+        self.active_uses = 0
+        self.last_used = None
+        self.idle_paused = False
+
+    def set_boot_image(self, image_path):
+        """Makes the next starts restore the VM from a template image instead
+        of booting it. None goes back to cold boot.
+
+        :param image_path: The image built by SnapshotManager
+        :type image_path: str
+        """
+        self.boot_image = image_path
+
+    def set_pool(self, pool):
+        """Makes the next starts take over a VM of pool when one is ready,
+        instead of booting the VM. None boots every start.
+
+        :type pool: VmPool
+        """
+        self.vm_pool = pool
+
+    def was_pooled(self):
+        """Returns whether the last start took over a VM of the pool"""
+        return self.pooled
+
+    def set_affinity(self, cores, pin_vcpus=False):
+        """Pins the VM to cores from its next start
+
+        :param cores: The cores, none to leave the VM unpinned
+        :type cores: list(int)
+        :param pin_vcpus: Whether each vCPU thread gets its own core, in
+        turn, instead of the whole Qemu process getting all of them
+        :type pin_vcpus: bool
+        """
+        self.cores = list(cores)
+        self.pin_vcpus = pin_vcpus
 
     def start_vm(self):
-        """Starts the VM. Handles the creation of tap interfaces as well"""
-        self.tap = self._create_tap_intf()
-        self._set_mgmt_tap_ip()
+        """Starts the VM, taking over a VM of its pool when one is ready.
+        Handles the creation of tap interfaces as well"""
+        name = self.get_vm_name()
+        pooled = None
+        if self.vm_pool is not None:
+            pooled = self.vm_pool.claim(self.config)
+        if pooled is not None:
+            self._take_over(pooled)
+        else:
+            self._spawn()
+        self.pooled = pooled is not None
+        self.stop_time = None
+        self.exit_time = None
+        self.killed = False
+        self.exited.add_done_callback(self._on_exit)
+        print 'Process is ' + str(self.vm_process.pid)
+        self.started = True
+        self.run_state = 'running'
+        self.idle_paused = False
+        self.last_used = time.time()
+
+        self.console.on_message(VmHandler.BOOT_MARKER, self._on_boot_message)
+        if not self.pooled:
+            self.console.connect()
 
-        cmd = self.config.get_commandline(self.tap)
+        agent_path = self.config.get_agent_socket_path()
+        if agent_path is not None:
+            self.agent = GuestAgent(agent_path)
+            self.agent.connect()
+
+        if self.cores and self.pin_vcpus:
+            with default_tracer.span(name, 'pin_vcpus'):
+                self._pin_vcpus()
+        elif self.cores and self.pooled:
+            # Qemu was not started under taskset: pins all of its threads
+            run('taskset -apc %s %d' % (','.join(str(c) for c in self.cores),
+                                        self.vm_process.pid))
+
+        if self.pooled:
+            with default_tracer.span(name, 'bind_identity'):
+                self._send_identity()
+        elif self.boot_image:
+            with default_tracer.span(name, 'restore'):
+                self._bind_identity()
+
+    def _spawn(self):
+        """Creates the management tap and spawns Qemu"""
+        name = self.get_vm_name()
+        self.config.set_runtime_dir(None)
+        with default_tracer.span(name, 'tap_create'):
+            self.tap = self._create_tap_intf()
+            self._set_mgmt_tap_ip()
+
+        if self.boot_image:
+            cmd = self.config.get_restore_commandline(self.tap,
+                                                      self.boot_image)
+        else:
+            cmd = self.config.get_commandline(self.tap)
+        if self.cores and not self.pin_vcpus:
+            cmd = ['taskset', '-c', ','.join(str(c) for c in self.cores)] + cmd
         print 'DEBUG: cmd=' + str(cmd)
         print 'Running ' + ' '.join(cmd)
-        self.vm_process = subprocess.Popen(cmd)
-        print 'Process is ' + str(self.vm_process.pid)
-        self.started = True
+        with default_tracer.span(name, 'qemu_spawn'):
+            self.spawn_time = time.time()
+            # VMs are started from several threads at once: without
+            # close_fds, Qemu would keep the pipes of the Popen calls running
+            # meanwhile, and these would wait for it to exit
+            self.vm_process = subprocess.Popen(cmd, close_fds=True)
+        self.exited = default_loop.watch_process(self.vm_process)
+        self.console = MgmtConsole(self.config.get_mgmt_socket_path())
+
+    def _take_over(self, pooled):
+        """Makes a VM of the pool this VM: its tap gets the management
+        address of this VM, and its Qemu and console are used from now on.
+        The identity is sent once the VM is set up.
+
+        :type pooled: PooledVm
+        """
+        name = self.get_vm_name()
+        print('%s: taking over %s' % (name, pooled.get_vm_name()))
+        self.config.set_runtime_dir(pooled.config.get_runtime_dir())
+        self.tap = pooled.tap
+        with default_tracer.span(name, 'tap_address'):
+            self._set_mgmt_tap_ip()
+        # The boot of the VM is what is left after it gets its identity
+        self.spawn_time = time.time()
+        self.vm_process = pooled.process
+        self.exited = pooled.exited
+        self.console = pooled.console
+
+    def trace_boot(self, notify_time, guest_times):
+        """Records the boot of this VM from the boot notification
+
+        :param notify_time: When the notification was received
+        :type notify_time: float
+        :param guest_times: Guest uptime in seconds at the end of each
+        vm_init.sh phase, in order, as (phase, uptime) pairs
+        :type guest_times: list(tuple)
+        """
+        if self.spawn_time is None:
+            return
+        name = self.get_vm_name()
+        default_tracer.add_span(name, 'boot', self.spawn_time, notify_time)
+        # Guest uptime counts from about when Qemu was spawned. A pooled VM
+        # was booted before it was taken over: its phases count from when it
+        # got its identity instead.
+        base = 0.0
+        if self.pooled:
+            base = dict(guest_times).get('identity', 0.0)
+        prev = base
+        for phase, uptime in guest_times:
+            if uptime <= base and self.pooled:
+                continue
+            default_tracer.add_span(name, 'guest_' + phase,
+                                    self.spawn_time + prev - base,
+                                    self.spawn_time + uptime - base)
+            prev = uptime
 
-    def stop_vm(self):
-        """Stops the VM. Also removes the created tap interfaces"""
-        self.vm_process.terminate()
-        self.vm_process.wait()
-        self._remove_tap_intf(self.tap)
+    def on_boot(self, handler):
+        """Registers handler to be called every time the VM reports on its
+        mgmt console that it has booted and sshd is up. Handlers run on the
+        event loop thread and must not block."""
+        self.boot_handlers.append(handler)
+
+    def _on_boot_message(self, params):
+        """Handles the boot message of vm_init.sh: the hostname followed by
+        the phase=uptime pairs of the guest boot"""
+        notify_time = time.time()
+        name = params[0] if params else ''
+        if name != self.get_vm_name():
+            print("ERROR: %s booted as %s" % (self.get_vm_name(), name))
+        print("%s booted!" % self.get_vm_name())
+
+        guest_times = []
+        for param in params[1:]:
+            phase, sep, uptime = param.partition('=')
+            if sep:
+                try:
+                    guest_times.append((phase, float(uptime)))
+                except ValueError:
+                    pass
+        self.trace_boot(notify_time, guest_times)
+        for handler in self.boot_handlers:
+            handler()
+
+    def _get_vcpu_threads(self):
+        """Returns the (vCPU index, thread id) pairs of the VM.
+        query-cpus-fast does not interrupt the vCPUs, unlike query-cpus,
+        which is only used by Qemu older than 2.12 that lacks it."""
+        qmp = self.get_qmp()
+        try:
+            return [(cpu['cpu-index'], cpu['thread-id'])
+                    for cpu in qmp.execute('query-cpus-fast')]
+        except QmpError, e:
+            if e.error_class != 'CommandNotFound':
+                raise
+        return [(cpu['CPU'], cpu['thread_id'])
+                for cpu in qmp.execute('query-cpus')]
+
+    def _pin_vcpus(self):
+        """Pins every vCPU thread of the VM to one of its cores, in turn"""
+        for index, thread_id in self._get_vcpu_threads():
+            core = self.cores[index % len(self.cores)]
+            run('taskset -pc %d %d' % (core, thread_id))
+
+    def _bind_identity(self):
+        """Waits for a restored VM to run and sends it its identity over the
+        mgmt console. The guest then finishes vm_init.sh as usual."""
+        qmp = self.get_qmp()
+        deadline = time.time() + VmHandler.RESTORE_TIMEOUT
+        while qmp.execute('query-status').get('status') != 'running':
+            if time.time() > deadline:
+                raise QmpError('%s was not restored in time' %
+                               self.get_vm_name())
+            time.sleep(VmHandler.RESTORE_POLL_INTERVAL)
+
+        self._send_identity()
+
+    def _send_identity(self):
+        """Sends the identity of this VM to the template waiting for it"""
+        self.console.send(SnapshotManager.get_identity_line(self.config))
+
+    def stop_vm(self, timeout=SHUTDOWN_TIMEOUT):
+        """Stops the VM: asks the guest to power off, tells Qemu to quit if
+        it is still running after POWERDOWN_GRACE seconds, kills it if it is
+        still running after timeout seconds, then removes the created tap
+        interfaces
+
+        :param timeout: Seconds the VM gets to exit
+        :type timeout: float
+        """
+        deadline = time.time() + timeout
+        self.request_powerdown()
+        if not self.wait_exit(min(timeout, VmHandler.POWERDOWN_GRACE)):
+            self.request_quit()
+            if not self.wait_exit(deadline - time.time()):
+                self.kill()
+                self.wait_exit(VmHandler.KILL_TIMEOUT)
+        for tap, multi_queue in self.release():
+            self._remove_tap_intf(tap, multi_queue)
+
+    def request_powerdown(self):
+        """Asks the guest to power off through the monitor, like a press on
+        its power button, without waiting for it
+
+        :return Whether the request was sent
+        :rtype bool
+        """
+        self.stop_time = time.time()
+        if self.exited is None or self.exited.is_done():
+            return False
+        try:
+            if self.idle_paused:
+                # A paused guest does not see the power button
+                self.get_qmp().send('cont')
+                self.idle_paused = False
+            self.get_qmp().send('system_powerdown')
+        except QmpError, e:
+            print("ERROR: %s: cannot request power off: %s" %
+                  (self.get_vm_name(), e))
+            return False
+        return True
+
+    def request_quit(self):
+        """Tells Qemu to exit right away through the monitor, like
+        terminate() but without a signal, without waiting for it
+
+        :return Whether the request was sent
+        :rtype bool
+        """
+        if self.exited is None or self.exited.is_done():
+            return False
+        try:
+            self.get_qmp().send('quit')
+        except QmpError, e:
+            print("ERROR: %s: cannot request quit: %s" %
+                  (self.get_vm_name(), e))
+            return False
+        return True
+
+    def wait_exit(self, timeout):
+        """Waits up to timeout seconds for Qemu to exit
+
+        :return Whether Qemu has exited
+        :rtype bool
+        """
+        if self.exited is None:
+            return True
+        self.exited.wait(max(0, timeout))
+        return self.exited.is_done()
+
+    def kill(self):
+        """Kills Qemu with SIGKILL"""
+        if self.exited is not None and self.exited.is_done():
+            return
+        self.killed = True
+        try:
+            self.vm_process.kill()
+        except OSError:
+            # Exited meanwhile
+            pass
+
+    def _on_exit(self, exited):
+        self.exit_time = time.time()
+
+    def get_shutdown_time(self):
+        """Returns the seconds from the power off request to the exit of
+        Qemu, or None if either is missing"""
+        if self.stop_time is None or self.exit_time is None:
+            return None
+        return max(0.0, self.exit_time - self.stop_time)
+
+    def was_killed(self):
+        """Returns whether the last stop had to kill Qemu"""
+        return self.killed
+
+    def release(self):
+        """Frees what the VM holds once Qemu has exited, except its taps,
+        which are returned to the caller to be removed, possibly in a batch
+        with those of other VMs
+
+        :return The (tap name, multi_queue) of every tap of the VM
+        :rtype list(tuple)
+        """
+        if not self.exited.is_done():
+            # Still there after SIGKILL: Qemu is stuck in the kernel
+            print("ERROR: %s: Qemu did not exit" % self.get_vm_name())
+        self._close_qmp()
+        if self.console is not None:
+            self.console.close()
+            self.console = None
+        if self.agent is not None:
+            self.agent.close()
+            self.agent = None
+        self.run_state = 'stopped'
+        self.ssh_pool.evict(self.mgmt_ip)
+        taps = [(self.tap, False)]
+        taps += [(intf, self._is_multi_queue(link))
+                 for intf, link in self.test_interfaces.items()]
         self.tap = ''
+        self.test_interfaces = {}
         self.started = False
-        self.clean_interfaces()
         self.kill_xterms()
+        return taps
 
     def is_started(self):
         """Returns whether the VM is currently started or not"""
         return self.started
 
+    def get_exit_future(self):
+        """Returns the Future set to the exit code of the Qemu process of
+        the last start, once it exits
+
+        :rtype Future
+        """
+        return self.exited
+
     def get_vm_name(self):
         """Returns the name of this VM"""
         return self.config.vm_name
 
+    def get_topo_name(self):
+        """Returns the name of this VM in the topology config"""
+        return self.config.get_topo_name()
+
     def send_cmd(self, line):
         """Sends a command to host to be executed"""
-        ssh_private_key = self.config.get_ssh_key_path()
-        c = ssh_setup()
-        c.connect(self.mgmt_ip, username='root', key_filename=ssh_private_key)
-        line = 'source ~/.bashrc; ' + line
-        stdin, stdout, stderr = c.exec_command(line)
-        out_lines = stdout.readlines()
-        err_lines = stderr.readlines()
-        c.close()
+        out_lines, err_lines, _ = self.send_cmd_status(line)
         return out_lines, err_lines
 
+    def send_cmd_status(self, line):
+        """Sends a command to host to be executed and waits for its exit
+        status. The guest agent runs it if it is up, SSH otherwise or if
+        the agent fails to run it.
+
+        :return A tuple containing out lines, err lines and the exit status
+        :rtype tuple
+        """
+        line = 'source ~/.bashrc; ' + line
+        with self.in_use():
+            agent = self.agent
+            if agent is not None and agent.is_ready():
+                try:
+                    return agent.run(line)
+                except AgentError, e:
+                    print("ERROR: %s: agent failed, using SSH: %s" %
+                          (self.get_vm_name(), e))
+
+            ssh_private_key = self.config.get_ssh_key_path()
+            stdin, stdout, stderr = self.ssh_pool.exec_command(
+                self.mgmt_ip, ssh_private_key, line)
+            out_lines = stdout.readlines()
+            err_lines = stderr.readlines()
+            status = stdout.channel.recv_exit_status()
+            return out_lines, err_lines, status
+
+    def stream_cmd(self, line):
+        """Starts a command on host and returns its output as a stream. The
+        VM counts as in use until the stream ends.
+
+        :return The stream of stdout/stderr chunks of the command
+        :rtype CommandStream
+        """
+        self._begin_use()
+        try:
+            ssh_private_key = self.config.get_ssh_key_path()
+            line = 'source ~/.bashrc; ' + line
+            channel = self.ssh_pool.open_channel(
+                self.mgmt_ip, ssh_private_key, line,
+                window_size=VmHandler.STREAM_WINDOW_SIZE)
+        except Exception:
+            self._end_use()
+            raise
+        return CommandStream(channel, on_done=self._end_use)
+
+    @contextmanager
+    def in_use(self):
+        """Marks the VM as in use for the duration of the with block,
+        resuming it first if it was paused for being idle"""
+        self._begin_use()
+        try:
+            yield self
+        finally:
+            self._end_use()
+
+    def _begin_use(self):
+        with self.use_lock:
+            if self.idle_paused:
+                with default_tracer.span(self.get_vm_name(), 'resume'):
+                    self.get_qmp().execute('cont')
+                self.idle_paused = False
+            # Counted once resumed: callers do not end a use that failed
+            self.active_uses += 1
+            self.last_used = time.time()
+
+    def _end_use(self):
+        with self.use_lock:
+            self.active_uses -= 1
+            self.last_used = time.time()
+
+    def pause_if_idle(self, idle_time):
+        """Pauses the guest with the monitor stop command if nothing used the
+        VM for idle_time seconds. The next use resumes it.
+
+        :return Whether the VM was paused by this call
+        :rtype bool
+        """
+        with self.use_lock:
+            if (not self.started or self.idle_paused or self.active_uses or
+                    self.last_used is None or
+                    time.time() - self.last_used < idle_time):
+                return False
+            # The sessions of an xterm do not go through vLab
+            if any(p.poll() is None for p in self.xterm_processes):
+                return False
+            self.get_qmp().execute('stop')
+            self.idle_paused = True
+            return True
+
+    def is_idle_paused(self):
+        """Returns whether the VM is paused for being idle"""
+        return self.idle_paused
+
     def run_xterm(self):
         """Starts an xterm on this host"""
         if not self.is_started():
@@ -82,8 +547,9 @@ class VmHandler(object):
                " root@" + self.get_mgmt_ip() + "\"")
         cmd = shlex.split(cmd)
         print("DEBUG: _run_xterm cmd= " + str(cmd))
-        process = Popen(cmd)
-        self.xterm_processes.append(process)
+        with self.in_use():
+            process = Popen(cmd)
+            self.xterm_processes.append(process)
 
     def kill_xterms(self):
         for p in self.xterm_processes:
@@ -97,79 +563,251 @@ class VmHandler(object):
         """Returns the management interface's ip"""
         return self.mgmt_ip
 
-    def configure_interface(self, link, link_idx):
+    def configure_interface(self, link):
         """Creates host test interface, adds it to the guest and configures IP address
 
-        :param link: Configuration options for a link read from topo.json
-        :type link: dict
-        :param link_idx: Test interface index
-        :type link_idx: int
+        :param link: The link the interface belongs to
+        :type link: Link
+        :return Whether the guest interface was configured successfully
+        :rtype bool
         """
-        tap_name = "tap." + self.config.host['options']['hostname']
-        tap = VmHandler._create_tap_intf(tap_name)
-        self.test_interfaces[tap] = link
-        netdev, device = self.config.get_network_interface(tap)
-        self.monitor_send_cmd(netdev)
-        self.monitor_send_cmd(device)
-        self.send_cmd("echo 1 > /sys/bus/pci/rescan")
+        with self.in_use():
+            results = self._configure_links([link])
+        return results.values()[0]
 
-        ip = self.config.host['options']['ip'].split('.')
-        ip[3] = str(int(ip[3]) + link_idx)
-        ipstr = ".".join(ip)
-        # Add one because eth0 is the management interface
-        intf_name = "eth" + str(link_idx + 1)
+    def configure_interfaces(self):
+        """Configures all the test interfaces of this VM in one batch
 
-        self.send_cmd("ip a a " + ipstr + "/24 dev " + intf_name)
-        self.send_cmd("ip link set " + intf_name + " up")
+        :return A dict mapping host tap names to whether the corresponding
+        guest interface was configured successfully
+        :rtype dict
+        """
+        links = [link for link in self.config.get_links()
+                 if link.get_tap(self.get_topo_name())
+                 not in self.test_interfaces]
+        print('%s: configuring %s' % (self.get_vm_name(), links))
+        with self.in_use():
+            return self._configure_links(links)
 
-    def configure_interfaces(self):
-        print(self.config.host)
-        i = 0
-        for link in self.config.host['links']:
-            self.configure_interface(link, i)
-            i = i + 1
+    def _configure_links(self, links):
+        """Creates the host taps for the given links, hot-plugs all of them
+        with a single monitor exchange and configures them in the guest with
+        a single command. Guest interfaces are found by their MAC address, so
+        the order in which the guest names them does not matter.
+
+        :param links: The links of this VM to be configured
+        :type links: list(Link)
+        :return A dict mapping host tap names to whether the corresponding
+        guest interface was configured successfully
+        :rtype dict
+        """
+        name = self.get_topo_name()
+        monitor_cmds = []
+        script = ["echo 1 > /sys/bus/pci/rescan"]
+        taps = []
+        for link in links:
+            queues = self.config.get_datapath(link)['queues']
+            tap = VmHandler._create_tap_intf(link.get_tap(name), queues > 1)
+            self.test_interfaces[tap] = link
+            monitor_cmds += self.config.get_network_interface(link)
+            taps.append(tap)
+
+            # The guest driver only uses one queue pair until told otherwise
+            channels = ''
+            if queues > 1:
+                channels = ('{ ethtool -L $i combined %d > /dev/null 2>&1; '
+                            'true; } && ' % queues)
+            script.append(
+                "i=$(grep -l %s /sys/class/net/*/address | cut -d/ -f5); "
+                "[ -n \"$i\" ] && ip a a %s dev $i && %sip link set $i up "
+                "&& echo '%s ok' || echo '%s failed'" %
+                (link.get_mac(name), link.get_address(name), channels, tap,
+                 tap))
+
+        if not monitor_cmds:
+            return {}
+
+        with default_tracer.span(self.get_vm_name(), 'monitor_hotplug'):
+            self.monitor_send_cmds(monitor_cmds)
+        with default_tracer.span(self.get_vm_name(), 'guest_configure'):
+            out_lines, err_lines = self.send_cmd("; ".join(script))
+
+        results = dict((tap, False) for tap in taps)
+        for ln in out_lines:
+            words = ln.split()
+            if len(words) == 2 and words[0] in results:
+                results[words[0]] = words[1] == 'ok'
+        for tap in taps:
+            if not results[tap]:
+                print("ERROR: %s: failed to configure the interface of %s: %s"
+                      % (self.get_vm_name(), tap, ''.join(err_lines)))
+        return results
+
+    def add_link(self, link):
+        """Hot-plugs the interface of a link added while the VM runs
+
+        :return Whether the guest interface was configured successfully
+        :rtype bool
+        """
+        return self.configure_interface(link)
+
+    def remove_link(self, link):
+        """Hot-unplugs the interface of link from the guest and removes its
+        tap"""
+        name = self.get_topo_name()
+        device_id = link.get_device_id(name)
+        deleted = threading.Event()
+        self.pending_deletes[device_id] = deleted
+        # The guest has to run to release the device
+        with self.in_use():
+            try:
+                self.monitor_send_cmd('device_del ' + device_id)
+                if not deleted.wait(VmHandler.DEVICE_DEL_TIMEOUT):
+                    print("ERROR: %s: %s was not released by the guest" %
+                          (self.get_vm_name(), device_id))
+            finally:
+                self.pending_deletes.pop(device_id, None)
+        self.monitor_send_cmd('netdev_del ' + link.get_netdev_id(name))
+
+        tap = link.get_tap(name)
+        self.test_interfaces.pop(tap, None)
+        VmHandler._remove_tap_intf(tap, self._is_multi_queue(link))
+
+    def unplug_link(self, link):
+        """Removes what exists of the device, netdev and tap of link after
+        its hot-plug failed partway. Unlike remove_link, the guest is not
+        waited for: a device it never got cannot be released."""
+        name = self.get_topo_name()
+        for command in ('device_del ' + link.get_device_id(name),
+                        'netdev_del ' + link.get_netdev_id(name)):
+            try:
+                self.monitor_send_cmd(command)
+            except (QmpError, socket.error), e:
+                print("ERROR: %s: %s: %s" % (self.get_vm_name(), command, e))
+        tap = link.get_tap(name)
+        if self.test_interfaces.pop(tap, None) is not None:
+            VmHandler._remove_tap_intf(tap, self._is_multi_queue(link))
+
+    def get_pid(self):
+        """Returns the pid of the Qemu process, or None if it is not
+        running"""
+        if not self.started or self.vm_process is None:
+            return None
+        return self.vm_process.pid
+
+    def get_taps(self):
+        """Returns the host taps of this VM: the management one first, then
+        the ones of its links"""
+        taps = [self.tap] if self.tap else []
+        return taps + list(self.test_interfaces)
+
+    def has_test_interface(self, tap):
+        """Returns whether the host tap of a link of this VM exists"""
+        return tap in self.test_interfaces
+
+    def _is_multi_queue(self, link):
+        """Returns whether the tap of link was created as a multiqueue tap"""
+        return self.config.get_datapath(link)['queues'] > 1
 
     def clean_interfaces(self):
-        for intf in self.test_interfaces:
-            VmHandler._remove_tap_intf(intf)
+        for intf, link in self.test_interfaces.items():
+            VmHandler._remove_tap_intf(intf, self._is_multi_queue(link))
+        self.test_interfaces = {}
+
+    def get_qmp(self):
+        """Returns the QMP client of this VM, connecting it on first use
+
+        :rtype QmpClient
+        """
+        if self.qmp is None or not self.qmp.is_connected():
+            # A lost connection keeps its socket open until closed
+            self._close_qmp()
+            qmp = QmpClient(self.config.get_qmp_socket_path())
+            qmp.on_event('SHUTDOWN', self._on_qmp_event)
+            qmp.on_event('STOP', self._on_qmp_event)
+            qmp.on_event('RESUME', self._on_qmp_event)
+            qmp.on_event('DEVICE_DELETED', self._on_qmp_event)
+            try:
+                qmp.connect()
+            except QmpError:
+                qmp.close()
+                raise
+            self.qmp = qmp
+        return self.qmp
+
+    def _close_qmp(self):
+        if self.qmp is not None:
+            self.qmp.close()
+            self.qmp = None
+
+    def _on_qmp_event(self, event):
+        """Tracks the guest run state from QMP events"""
+        name = event['event']
+        if name == 'SHUTDOWN':
+            self.run_state = 'shutdown'
+        elif name == 'STOP':
+            self.run_state = 'paused'
+        elif name == 'RESUME':
+            self.run_state = 'running'
+        elif name == 'DEVICE_DELETED':
+            deleted = self.pending_deletes.get(
+                event.get('data', {}).get('device'))
+            if deleted is not None:
+                deleted.set()
+        print("%s: QMP event %s %s" %
+              (self.get_vm_name(), name, event.get('data', '')))
+
+    def get_run_state(self):
+        """Returns the guest run state as last reported by Qemu"""
+        return self.run_state
 
     def monitor_send_cmd(self, command):
-        path = "/tmp/" + self.config.vm_name + "/vm-monitor-console.socket"
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        sock.connect(path)
-        sock.recv(128)
-        sock.send(command + "\n")
-        response = sock.recv(128)
-        sock.close()
-        return response
+        """Sends a human monitor command to Qemu
+
+        :return The monitor response
+        :rtype str
+        :raises QmpError: If Qemu did not reply in time, or a hot-plug
+        command failed
+        """
+        return self.get_qmp().hmp(command)
+
+    def monitor_send_cmds(self, commands):
+        """Sends several human monitor commands to Qemu. The commands are
+        pipelined over the QMP connection of this VM.
+
+        :param commands: The monitor commands
+        :type commands: list(str)
+        :return The monitor responses, in the order of commands
+        :rtype list(str)
+        :raises QmpError: If Qemu did not reply in time, or a hot-plug
+        command failed
+        """
+        return self.get_qmp().hmp_many(commands)
 
     @staticmethod
-    def _create_tap_intf(name=None):
+    def _create_tap_intf(name=None, multi_queue=False):
         """Create a TAP interface on host to be used inside VM
 
         :param name: The name requested for the new interface
         :type: str
+        :param multi_queue: Whether the tap gets a queue per vCPU
+        :type multi_queue: bool
         :return: The name of the newly created TAP interface
         :rtype: str
         """
-        cmd = ['tunctl', '-b']
-        if name:
-            cmd += ['-t', name]
-
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        output, err = p.communicate()
-        return output[0:-1]
+        return get_backend().create_tap(name, multi_queue)
 
     @staticmethod
-    def _remove_tap_intf(tap_name):
+    def _remove_tap_intf(tap_name, multi_queue=False):
         """Remove the tap interface from host"""
-        subprocess.call(['tunctl', '-d', tap_name])
+        get_backend().delete_tap(tap_name, multi_queue)
 
     def _set_mgmt_tap_ip(self):
         """Sets ip on tap linked to management interface"""
-        ip = '10.0.' + str(self.config.get_vm_index()) + '.1/24'
-        subprocess.call(['ip', 'addr', 'add', ip, 'dev', self.tap])
+        subnet = self.config.get_mgmt_subnet()
+        ip = '%s/%d' % (subnet.host_ip, subnet.prefixlen)
+        get_backend().add_address(self.tap, ip)
 
     def _generate_mgmt_ip(self):
         """Generates the ip of the management interface"""
-        return '10.0.' + str(self.config.get_vm_index()) + '.2'
+        return self.config.get_mgmt_subnet().guest_ip
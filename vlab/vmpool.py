@@ -0,0 +1,348 @@
+"""
+Pool of pre-booted VMs
+
+vmconfig writes the identity of a VM (hostname, management address, index)
+on its kernel command line, so a VM can only be booted once a lab asks for
+its host. A VmPool keeps generic VMs of a vm.json profile booted in the
+background instead: each is a template VM, as in snapshot.py, which ran the
+identity independent part of vm_init.sh and waits for an identity on its
+mgmt console. A host started while the pool has a ready VM takes it over
+(see VmHandler.start_vm): the management tap gets the address of the host,
+the guest reads its hostname, management address and MAC from the console
+and finishes vm_init.sh, and the test interfaces are hot-plugged as usual.
+Every VM taken makes the pool boot a replacement.
+
+The 'pool' section of the vm config holds:
+  - size: VMs kept ready, 0 for no pool
+  - max_booting: VMs of the pool booting at once
+
+A pooled VM is booted from the profile alone, so only hosts whose topo.json
+options do not change the Qemu command line can take one over: their smp
+and management data path options must be the ones of the profile. The
+others boot as usual.
+
+Pools live as long as the process, one per profile, so a lab started again
+or another lab of the same profile finds its VMs ready. close_pools() stops
+them.
+"""
+
+import json
+import time
+import hashlib
+import itertools
+import threading
+import subprocess
+from collections import deque
+
+from vmconfig import VmConfig
+from netbackend import get_backend
+from snapshot import SnapshotManager
+from console import MgmtConsole
+from eventloop import default_loop
+
+
+class PooledVm(object):
+    """A VM of a pool: its Qemu process, management tap and console"""
+
+    def __init__(self, config, tap, process, exited, console):
+        self.config = config
+        self.tap = tap
+        self.process = process
+        self.exited = exited
+        self.console = console
+        self.spawn_time = time.time()
+        self.ready_time = None
+
+    def get_vm_name(self):
+        return self.config.get_vm_name()
+
+
+class VmPool(object):
+    """Keeps VMs of a vm profile booted, ready to take an identity"""
+    DEFAULT_MAX_BOOTING = 2
+    # Seconds without boots after a pooled VM failed, so a broken profile
+    # does not respawn Qemu in a loop
+    RETRY_DELAY = 5
+    STOP_TIMEOUT = 5
+
+    def __init__(self, config_data, size, max_booting=DEFAULT_MAX_BOOTING,
+                 initrd=None):
+        """Creates a VmPool. Nothing is booted until start()
+
+        :param config_data: Dict containing the info from the vm config file
+        :type config_data: dict
+        :param size: VMs kept ready
+        :type size: int
+        :param max_booting: VMs of the pool booting at once
+        :type max_booting: int
+        :param initrd: The initramfs of the profile, if it uses one
+        :type initrd: str
+        """
+        self.config_data = config_data
+        self.size = size
+        self.max_booting = max(1, max_booting)
+        self.initrd = initrd
+        self.template = self._create_config(config_data['base_name'] +
+                                            '-pool')
+        self.counter = itertools.count(1)
+        self.lock = threading.Condition()
+        self.booting = []
+        self.ready = deque()
+        self.dead = []
+        self.claims = 0
+        self.misses = 0
+        self.failures = 0
+        self.last_failure = None
+        self.stopped = False
+        self.thread = None
+
+    def _create_config(self, name):
+        """Returns the config of a VM of the pool. Without a management
+        subnet, the VM boots as a template."""
+        config = VmConfig(self.config_data,
+                          {'options': {'hostname': name}, 'topology': None},
+                          0, None, vm_name=name)
+        config.set_initrd(self.initrd)
+        return config
+
+    def start(self):
+        """Starts filling the pool in the background, if it is not running
+        yet"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.thread = threading.Thread(target=self._run, name='vlab-pool')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stops filling the pool and stops the VMs left in it"""
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+            self.stopped = True
+            self.lock.notify_all()
+        if thread is not None:
+            thread.join()
+
+        with self.lock:
+            vms = list(self.ready) + self.booting
+            self.ready.clear()
+            self.booting = []
+        for vm in vms:
+            try:
+                vm.process.terminate()
+            except OSError:
+                pass
+        deadline = time.time() + VmPool.STOP_TIMEOUT
+        for vm in vms:
+            vm.exited.wait(max(0, deadline - time.time()))
+            if not vm.exited.is_done():
+                try:
+                    vm.process.kill()
+                except OSError:
+                    pass
+        with self.lock:
+            self.dead = []
+        self._release(vms)
+
+    def accepts(self, config):
+        """Returns whether a VM of this pool can take the identity of
+        config: its Qemu command line must only differ by the identity
+
+        :type config: VmConfig
+        :rtype bool
+        """
+        return (config.initrd == self.initrd and
+                config.get_smp() == self.template.get_smp() and
+                config.get_datapath() == self.template.get_datapath())
+
+    def claim(self, config):
+        """Takes a ready VM out of the pool for config, and has a replacement
+        booted
+
+        :type config: VmConfig
+        :return The VM, or None if none is ready or config does not fit
+        :rtype PooledVm
+        """
+        if not self.accepts(config):
+            return None
+        with self.lock:
+            vm = None
+            while self.ready:
+                vm = self.ready.popleft()
+                if not vm.exited.is_done():
+                    break
+                vm = None
+            if vm is None:
+                self.misses += 1
+            else:
+                self.claims += 1
+            self.lock.notify_all()
+            return vm
+
+    def get_stats(self):
+        """Returns the counters of the pool
+
+        :return A dict with the keys size, ready, booting, claims, misses
+        and failures
+        :rtype dict
+        """
+        with self.lock:
+            return {'size': self.size, 'ready': len(self.ready),
+                    'booting': len(self.booting), 'claims': self.claims,
+                    'misses': self.misses, 'failures': self.failures}
+
+    def wait_ready(self, timeout):
+        """Waits up to timeout seconds for the pool to be full
+
+        :return Whether the pool is full
+        :rtype bool
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            while len(self.ready) < self.size and not self.stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+            return len(self.ready) >= self.size
+
+    def _needs_vm(self):
+        return (len(self.ready) + len(self.booting) < self.size and
+                len(self.booting) < self.max_booting)
+
+    def _get_retry_wait(self):
+        """Returns the seconds left before a VM may be booted after the last
+        failure, 0 if it may be booted now"""
+        if self.last_failure is None:
+            return 0
+        return max(0, self.last_failure + VmPool.RETRY_DELAY - time.time())
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.stopped:
+                    if self.dead:
+                        break
+                    retry_wait = self._get_retry_wait()
+                    if self._needs_vm() and not retry_wait:
+                        break
+                    self.lock.wait(retry_wait or None)
+                if self.stopped:
+                    return
+                dead = self.dead
+                self.dead = []
+            if dead:
+                self._release(dead)
+                continue
+            try:
+                self._spawn()
+            except Exception, e:
+                print('ERROR: Cannot boot a pooled VM: %s' % e)
+                with self.lock:
+                    self.failures += 1
+                    self.last_failure = time.time()
+
+    def _spawn(self):
+        """Boots a VM of the pool"""
+        config = self._create_config('%s-pool%d' % (
+            self.config_data['base_name'], next(self.counter)))
+        tap = get_backend().create_tap()
+        try:
+            process = subprocess.Popen(config.get_commandline(tap),
+                                       close_fds=True)
+        except Exception:
+            get_backend().delete_tap(tap)
+            raise
+        vm = PooledVm(config, tap, process,
+                      default_loop.watch_process(process),
+                      MgmtConsole(config.get_mgmt_socket_path()))
+        vm.console.on_message(SnapshotManager.READY_MARKER,
+                              lambda params, vm=vm: self._on_ready(vm))
+        with self.lock:
+            self.booting.append(vm)
+        vm.exited.add_done_callback(lambda exited, vm=vm: self._on_exit(vm))
+        try:
+            vm.console.connect()
+        except Exception, e:
+            # Dropped from the pool once Qemu has exited
+            print('ERROR: %s: cannot connect to the console: %s' %
+                  (vm.get_vm_name(), e))
+            process.kill()
+
+    def _on_ready(self, vm):
+        """Moves a VM waiting for its identity to the ready ones. Runs on the
+        loop thread."""
+        with self.lock:
+            if vm not in self.booting:
+                return
+            self.booting.remove(vm)
+            vm.ready_time = time.time()
+            self.ready.append(vm)
+            self.lock.notify_all()
+
+    def _on_exit(self, vm):
+        """Drops a VM of the pool whose Qemu exited before being claimed.
+        Runs on the loop thread, so its tap is removed by the pool thread."""
+        with self.lock:
+            if vm in self.booting:
+                self.booting.remove(vm)
+            elif vm in self.ready:
+                self.ready.remove(vm)
+            else:
+                # Claimed, or stopped with the pool
+                return
+            print('ERROR: Pooled VM %s exited with code %s' %
+                  (vm.get_vm_name(), vm.exited.result))
+            self.failures += 1
+            self.last_failure = time.time()
+            self.dead.append(vm)
+            self.lock.notify_all()
+
+    @staticmethod
+    def _release(vms):
+        """Closes the consoles and removes the taps of VMs that exited"""
+        if not vms:
+            return
+        for vm in vms:
+            vm.console.close()
+        backend = get_backend()
+        with backend.batch():
+            for vm in vms:
+                backend.delete_tap(vm.tap)
+
+
+# The pools of the process, by vm profile
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(config_data, size, max_booting=VmPool.DEFAULT_MAX_BOOTING,
+             initrd=None):
+    """Returns the started pool of a vm profile, creating it on first use
+
+    :param config_data: Dict containing the info from the vm config file
+    :type config_data: dict
+    :rtype VmPool
+    """
+    h = hashlib.sha1(json.dumps(config_data, sort_keys=True))
+    h.update(str(initrd))
+    key = h.hexdigest()
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is None:
+            pool = VmPool(config_data, size, max_booting, initrd)
+            pools[key] = pool
+    pool.start()
+    return pool
+
+
+def close_pools():
+    """Stops all the pools and their VMs"""
+    with pools_lock:
+        closing = pools.values()
+        pools.clear()
+    for pool in closing:
+        pool.stop()